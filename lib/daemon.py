@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoManager daemon
+
+Keeps the flasher stub sessions of the SumoRobots open
+and takes commands on a local Unix socket, so station
+scripts do not start Python, connect and upload the stub
+for every command. The protocol is JSON-RPC 2.0 with one
+JSON object per line. Progress is streamed as progress
+notifications before the response of a command.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import json
+import stat
+import time
+import socket
+import base64
+import hashlib
+import contextlib
+import inspect
+import threading
+import traceback
+import socketserver
+
+# Local lib imports
+from lib.sumorobot import *
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+COMMAND_FAILED = -32000
+
+class Session:
+    """
+    A SumoRobot running the flasher stub. The stub is left running
+    between commands, one command at a time uses the session.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.esp = None
+        self.lock = threading.Lock()
+        self.connected = None
+        self.last_used = None
+
+    # Connect and start the flasher stub when not running yet
+    def loader(self):
+        if self.esp is None:
+            self.esp = prepare_sumorobot(self.port)
+            self.connected = time.time()
+        return self.esp
+
+    def close(self):
+        if self.esp is not None:
+            try:
+                self.esp._port.close()
+            except Exception:
+                pass
+            self.esp = None
+            self.connected = None
+
+    def status(self):
+        return {
+            'port': self.port,
+            'connected': self.esp is not None,
+            'chip': self.esp.CHIP_NAME if self.esp else None,
+            'since': self.connected,
+            'last_used': self.last_used,
+            'busy': self.lock.locked()}
+
+class Daemon:
+    """
+    Runs the JSON-RPC commands on the SumoRobot sessions. Every
+    command method takes the progress callback, which gets the
+    esptool ProgressEvents, and the named JSON-RPC params.
+    """
+    def __init__(self, firmware_path=None, download_path=None, stations=()):
+        self.firmware_path = firmware_path
+        self.download_path = download_path
+        self.stations = stations
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.download_lock = threading.Lock()
+        self.methods = {
+            'status': self.status,
+            'flash': self.flash,
+            'verify': self.verify,
+            'check': self.check,
+            'read': self.read,
+            'md5': self.md5,
+            'reset': self.reset}
+
+    def session(self, port):
+        with self.lock:
+            if port not in self.sessions:
+                self.sessions[port] = Session(port)
+            return self.sessions[port]
+
+    # Run function(session, esp) with the session of the port
+    def run(self, port, function):
+        session = self.session(port)
+        with session.lock:
+            try:
+                result = function(session, session.loader())
+                session.last_used = time.time()
+                return result
+            except Exception:
+                # The SumoRobot can be in any state, connect again next time
+                session.close()
+                raise
+
+    # Given SumoFirmware, the one given to the daemon or the latest one
+    def firmware(self, firmware, progress):
+        if firmware or self.firmware_path:
+            return firmware or self.firmware_path
+        # One download at a time, the others find it downloaded already
+        with self.download_lock:
+            return download_firmware(self.download_path, progress)
+
+    def status(self, progress):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {
+            'sessions': [session.status() for session in sessions],
+            'detected': [{'port': port, 'hub': hub} for port, hub in list_sumorobots(self.stations)]}
+
+    # Flash the SumoFirmware, unless the SumoRobot has it already
+    def flash(self, progress, port, firmware=None, backup=False, force=False):
+        firmware = self.firmware(firmware, progress)
+        def run(session, esp):
+            started = time.time()
+            if backup:
+                backup_sumorobot(esp, progress)
+            session.esp, flashed = update_firmware(esp, firmware, progress, force)
+            return {'port': port, 'firmware': firmware, 'flashed': flashed,
+                'seconds': round(time.time() - started, 3)}
+        return self.run(port, run)
+
+    def verify(self, progress, port, firmware=None):
+        firmware = self.firmware(firmware, progress)
+        def run(session, esp):
+            verify_firmware(esp, firmware)
+            return {'port': port, 'firmware': firmware, 'ok': True}
+        return self.run(port, run)
+
+    # Check the SumoFirmware on several SumoRobots at once, one MD5 per flash area
+    def check(self, progress, ports, firmware=None):
+        firmware = self.firmware(firmware, progress)
+        results = dict((port, {'port': port}) for port in ports)
+        # Sessions are locked in port order, so two checks can not lock each other out
+        sessions = [self.session(port) for port in sorted(results)]
+        with contextlib.ExitStack() as stack:
+            connected = []
+            for session in sessions:
+                stack.enter_context(session.lock)
+                try:
+                    connected.append((session, session.loader()))
+                except Exception as e:
+                    session.close()
+                    results[session.port]['error'] = str(e)
+            checks = check_sumorobots([esp for session, esp in connected], firmware)
+            for (session, esp), ok in zip(connected, checks):
+                if isinstance(ok, Exception):
+                    session.close()
+                    results[session.port]['error'] = str(ok)
+                else:
+                    session.last_used = time.time()
+                    results[session.port]['ok'] = ok
+        return {'firmware': firmware, 'sumorobots': [results[port] for port in ports]}
+
+    # Read flash into path, or return it base64 encoded
+    def read(self, progress, port, address, size, path=None):
+        def run(session, esp):
+            reporter = ProgressReporter(progress)
+            reporter.start('read', size)
+            data = esp.read_flash(address, size, lambda done, length: reporter.update(done))
+            reporter.finish()
+            result = {'port': port, 'address': address, 'size': len(data),
+                'md5': hashlib.md5(data).hexdigest()}
+            if path:
+                with open(path, 'wb') as f:
+                    f.write(data)
+                result['path'] = path
+            else:
+                result['data'] = base64.b64encode(data).decode()
+            return result
+        return self.run(port, run)
+
+    def md5(self, progress, port, address, size):
+        return self.run(port, lambda session, esp: {
+            'port': port, 'address': address, 'size': size, 'md5': esp.flash_md5sum(address, size)})
+
+    # Reset the SumoRobot into its firmware and end the session
+    def reset(self, progress, port):
+        def run(session, esp):
+            finish_sumorobot(esp)
+            session.esp = None
+            return {'port': port}
+        return self.run(port, run)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                with session.lock:
+                    session.close()
+
+    # Handle one JSON-RPC request line, send gets the messages to send back
+    def handle(self, line, send):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            send(error(None, PARSE_ERROR, 'Parse error: %s' % e))
+            return
+        if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+            send(error(request.get('id') if isinstance(request, dict) else None, INVALID_REQUEST, 'Invalid request'))
+            return
+
+        request_id = request.get('id')
+        method = self.methods.get(request['method'])
+        params = request.get('params', {})
+        if not method:
+            send(error(request_id, METHOD_NOT_FOUND, 'Unknown method %s' % request['method']))
+            return
+        def progress(event):
+            send({'jsonrpc': '2.0', 'method': 'progress', 'params': dict(event.as_dict(), id=request_id)})
+        try:
+            # Only named params, checked before running anything
+            inspect.signature(method).bind(progress, **params)
+        except TypeError as e:
+            send(error(request_id, INVALID_PARAMS, 'Invalid params: %s' % e))
+            return
+
+        try:
+            response = {'jsonrpc': '2.0', 'id': request_id, 'result': method(progress, **params)}
+        except Exception as e:
+            response = error(request_id, COMMAND_FAILED, str(e), {'details': traceback.format_exc()})
+        # Notifications get no response
+        if 'id' in request:
+            send(response)
+
+def error(id, code, message, data=None):
+    response = {'jsonrpc': '2.0', 'id': id, 'error': {'code': code, 'message': message}}
+    if data is not None:
+        response['error']['data'] = data
+    return response
+
+class Handler(socketserver.StreamRequestHandler):
+    # One client connection, its requests are handled in order
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.server.sumo_daemon.handle(line.decode('utf-8'), self.send)
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message, sort_keys=True).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+# Listen on the Unix socket path, returns the server running the Daemon
+def listen(path, firmware_path=None, download_path=None, stations=()):
+    if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+        raise OSError('Unix sockets are not supported on this platform')
+    # Remove the socket left behind by a daemon which did not stop cleanly, never anything else
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError('%s exists and is not a socket' % path)
+        with socket.socket(socket.AF_UNIX) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.remove(path)
+            else:
+                raise FileExistsError('A daemon is serving on %s already' % path)
+
+    # Only the local user can send commands, the socket is
+    # created without access for others to connect in between
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    server.sumo_daemon = Daemon(firmware_path, download_path, stations)
+    return server
+
+# Serve the daemon on the Unix socket path until interrupted
+def serve(path, firmware_path=None, download_path=None, stations=(), on_listen=None):
+    server = listen(path, firmware_path, download_path, stations)
+    try:
+        if on_listen:
+            on_listen(path)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.sumo_daemon.close()
+        os.remove(path)
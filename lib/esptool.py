@@ -25,11 +25,16 @@ import copy
 import hashlib
 import inspect
 import io
+import json
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os
 import shlex
 import struct
 import sys
 import time
+import zipfile
 import zlib
 import string
 
@@ -60,6 +65,11 @@ except ImportError:
           "Check the README for installation instructions." % (sys.VERSION, sys.executable))
     raise
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # optional, only used to speed up diffing large flash regions
+
 __version__ = "2.7-dev"
 
 MAX_UINT32 = 0xffffffff
@@ -74,6 +84,11 @@ MD5_TIMEOUT_PER_MB = 8                # timeout (per megabyte) for calculating m
 ERASE_REGION_TIMEOUT_PER_MB = 30      # timeout (per megabyte) for erasing a region
 MEM_END_ROM_TIMEOUT = 0.05            # special short timeout for ESP_MEM_END, as it may never respond
 DEFAULT_SERIAL_WRITE_TIMEOUT = 10     # timeout for serial port write
+WRITE_FLASH_RETRIES = 5               # times write_flash resumes an image after losing the connection
+WRITE_FLASH_BLOCK_RETRIES = 3         # times write_flash sends a rejected block again
+SERIAL_LATENCY_TIMER = 1              # latency timer (ms) of FTDI adapters after tune_serial_port
+SERIAL_BUFFER_SIZE = 0x10000          # driver buffer size after tune_serial_port, where it can be set
+COMPRESS_REGION_MIN = 0x40000         # smallest region write_flash --compress-jobs compresses on its own
 
 
 def timeout_per_mb(seconds_per_mb, size_bytes):
@@ -197,6 +212,16 @@ class ESPLoader(object):
     # Flash sector size, minimum unit of erase.
     FLASH_SECTOR_SIZE = 0x1000
 
+    # READ_FLASH frame size and number of unacknowledged frames the stub may send.
+    # The stub buffers one frame, so frames can't be bigger than a flash sector.
+    READ_FLASH_BLOCK_SIZE = FLASH_SECTOR_SIZE
+    READ_FLASH_MAX_IN_FLIGHT = 64
+    # Bounds and pacing for read_flash(adaptive=True)
+    READ_FLASH_MIN_BLOCK_SIZE = 0x100
+    READ_FLASH_MAX_IN_FLIGHT_LIMIT = 256
+    READ_FLASH_ADAPTIVE_WINDOWS = 4
+    READ_FLASH_ADAPTIVE_RETRIES = 5
+
     UART_DATA_REG_ADDR = 0x60000078
 
     # Memory addresses
@@ -206,6 +231,11 @@ class ESPLoader(object):
     # The number of bytes in the UART response that signify command status
     STATUS_BYTES_LENGTH = 2
 
+    # set by sync(), when a flasher stub answered instead of the ROM loader
+    sync_stub_detected = False
+    # set by connect(), when the reset with the esp32r0 delay worked (None: not reset)
+    esp32r0_delay = None
+
     def __init__(self, port=DEFAULT_PORT, baud=ESP_ROM_BAUD, trace_enabled=False):
         """Base constructor for ESPLoader bootloader interaction
 
@@ -244,7 +274,8 @@ class ESPLoader(object):
             raise FatalError("Failed to set baud rate %d. The driver may not support this rate." % baud)
 
     @staticmethod
-    def detect_chip(port=DEFAULT_PORT, baud=ESP_ROM_BAUD, connect_mode='default_reset', trace_enabled=False):
+    def detect_chip(port=DEFAULT_PORT, baud=ESP_ROM_BAUD, connect_mode='default_reset', trace_enabled=False,
+                    esp32r0_delay_first=False):
         """ Use serial access to detect the chip type.
 
         We use the UART's datecode register for this, it's mapped at
@@ -253,10 +284,10 @@ class ESPLoader(object):
         type.
 
         This routine automatically performs ESPLoader.connect() (passing
-        connect_mode parameter) as part of querying the chip.
+        connect_mode and esp32r0_delay_first parameters) as part of querying the chip.
         """
         detect_port = ESPLoader(port, baud, trace_enabled=trace_enabled)
-        detect_port.connect(connect_mode)
+        detect_port.connect(connect_mode, esp32r0_delay_first)
         try:
             print('Detecting chip type...', end='')
             sys.stdout.flush()
@@ -266,21 +297,51 @@ class ESPLoader(object):
                 if date_reg == cls.DATE_REG_VALUE:
                     # don't connect a second time
                     inst = cls(detect_port._port, baud, trace_enabled=trace_enabled)
+                    inst.esp32r0_delay = detect_port.esp32r0_delay
                     print(' %s' % inst.CHIP_NAME, end='')
                     return inst
         finally:
             print('')  # end line
         raise FatalError("Unexpected UART datecode value 0x%08x. Failed to autodetect chip type." % date_reg)
 
+    @staticmethod
+    def detect_stub(port=DEFAULT_PORT, bauds=(ESP_ROM_BAUD,), trace_enabled=False):
+        """ Look for a flasher stub left running on the chip, without resetting it
+
+        After a failed or aborted operation the chip is often still running the
+        stub, at one of the given baud rates. A single sync tells it apart from
+        the ROM loader. Returns a STUB_CLASS loader carrying on with the stub,
+        or None (closing the port if it was opened here).
+        """
+        probe = ESPLoader(port, bauds[0], trace_enabled=trace_enabled)
+        for baud in bauds:
+            try:
+                probe._set_port_baudrate(baud)
+                probe.flush_input()
+                probe.sync()
+                if not probe.sync_stub_detected:
+                    break  # the ROM loader is listening
+                date_reg = probe.read_reg(ESPLoader.UART_DATA_REG_ADDR)
+            except FatalError:
+                continue  # nothing answered at this baud rate
+            for cls in [ESP8266ROM, ESP32ROM]:
+                if date_reg == cls.DATE_REG_VALUE:
+                    print('Stub already running on %s, not uploading it again' % cls.CHIP_NAME)
+                    return cls.STUB_CLASS(cls(probe._port, baud, trace_enabled=trace_enabled))
+            break
+        if isinstance(port, basestring):
+            probe._port.close()
+        else:
+            probe.flush_input()
+        return None
+
     """ Read a SLIP packet from the serial port """
     def read(self):
         return next(self._slip_reader)
 
     """ Write bytes to the serial port while performing SLIP escaping """
     def write(self, packet):
-        buf = b'\xc0' \
-              + (packet.replace(b'\xdb',b'\xdb\xdd').replace(b'\xc0',b'\xdb\xdc')) \
-              + b'\xc0'
+        buf = slip_encode(packet)
         self.trace("Write %d bytes: %s", len(buf), HexFormatter(buf))
         self._port.write(buf)
 
@@ -318,8 +379,7 @@ class ESPLoader(object):
             if op is not None:
                 self.trace("command op=0x%02x data len=%s wait_response=%d timeout=%.3f data=%s",
                            op, len(data), 1 if wait_response else 0, timeout, HexFormatter(data))
-                pkt = struct.pack(b'<BBHI', 0x00, op, len(data), chk) + data
-                self.write(pkt)
+                self.write(command_packet(op, data, chk))
 
             if not wait_response:
                 return
@@ -329,13 +389,10 @@ class ESPLoader(object):
             # exceeded. This is needed for some esp8266s that
             # reply with more sync responses than expected.
             for retry in range(100):
-                p = self.read()
-                if len(p) < 8:
+                response = parse_response(self.read())
+                if response is None:
                     continue
-                (resp, op_ret, len_ret, val) = struct.unpack('<BBHI', p[:8])
-                if resp != 1:
-                    continue
-                data = p[8:]
+                op_ret, val, data = response
                 if op is None or op_ret == op:
                     return val, data
         finally:
@@ -352,7 +409,13 @@ class ESPLoader(object):
         Returns the "result" of a successful command.
         """
         val, data = self.command(op, data, chk, timeout=timeout)
+        return self.command_result(op_description, val, data)
 
+    def command_result(self, op_description, val, data):
+        """
+        Check the status bytes of a command response, throw an appropriate FatalError
+        if the command failed. Returns the "result" of a successful command.
+        """
         # things are a bit weird here, bear with us
 
         # the status bytes are the last 2/4 bytes in the data (depending on chip)
@@ -375,8 +438,13 @@ class ESPLoader(object):
         self._slip_reader = slip_reader(self._port, self.trace)
 
     def sync(self):
-        self.command(self.ESP_SYNC, b'\x07\x07\x12\x20' + 32 * b'\x55',
-                     timeout=SYNC_TIMEOUT)
+        val, _ = self.command(self.ESP_SYNC, b'\x07\x07\x12\x20' + 32 * b'\x55',
+                              timeout=SYNC_TIMEOUT)
+        # ROM loaders answer with a non-zero value and send more sync responses,
+        # a flasher stub still running from an earlier connection answers once with 0
+        self.sync_stub_detected = val == 0
+        if self.sync_stub_detected:
+            return
         for i in range(7):
             self.command()
 
@@ -449,20 +517,24 @@ class ESPLoader(object):
                 last_error = e
         return last_error
 
-    def connect(self, mode='default_reset'):
-        """ Try connecting repeatedly until successful, or giving up """
+    def connect(self, mode='default_reset', esp32r0_delay_first=False):
+        """ Try connecting repeatedly until successful, or giving up
+
+        Each try resets the chip without and with the esp32r0 delay, the delayed
+        reset first if esp32r0_delay_first. The one that worked is kept in
+        self.esp32r0_delay, to try it first the next time.
+        """
         print('Connecting...', end='')
         sys.stdout.flush()
         last_error = None
 
         try:
             for _ in range(7):
-                last_error = self._connect_attempt(mode=mode, esp32r0_delay=False)
-                if last_error is None:
-                    return
-                last_error = self._connect_attempt(mode=mode, esp32r0_delay=True)
-                if last_error is None:
-                    return
+                for esp32r0_delay in (True, False) if esp32r0_delay_first else (False, True):
+                    last_error = self._connect_attempt(mode=mode, esp32r0_delay=esp32r0_delay)
+                    if last_error is None:
+                        self.esp32r0_delay = esp32r0_delay
+                        return
         finally:
             print('')  # end 'Connecting...' line
         raise FatalError('Failed to connect to %s: %s' % (self.CHIP_NAME, last_error))
@@ -573,12 +645,24 @@ class ESPLoader(object):
             raise FatalError("Flash size '%s' is not supported by this chip type. Supported sizes: %s"
                              % (arg, ", ".join(self.FLASH_SIZES.keys())))
 
-    def run_stub(self, stub=None):
+    def run_stub(self, stub=None, baud=None):
+        """ Upload the flasher stub and start it, returns the stub loader
+
+        If baud is given and the ROM can change the baud rate (ESP32), the baud rate
+        is raised before the upload and the stub carries on at that rate. Otherwise
+        the stub is uploaded at the current rate and change_baud is left to the caller.
+        """
         if stub is None:
             if self.IS_STUB:
                 raise FatalError("Not possible for a stub to load another stub (memory likely to overlap.)")
             stub = self.STUB_CODE
 
+        if baud is not None and baud != self._port.baudrate:
+            try:
+                self.change_baud(baud)
+            except NotImplementedInROMError:
+                pass  # ESP8266 ROM, the stub has to change it
+
         # Upload
         print("Uploading stub...")
         for field in ['text', 'data']:
@@ -684,36 +768,121 @@ class ESPLoader(object):
         self.check_command("erase region", self.ESP_ERASE_REGION, struct.pack('<II', offset, size), timeout=timeout)
 
     @stub_function_only
-    def read_flash(self, offset, length, progress_fn=None):
-        # issue a standard bootloader command to trigger the read
+    def read_flash(self, offset, length, progress_fn=None, block_size=None, max_in_flight=None, adaptive=False):
+        """ Read 'length' bytes of flash starting at 'offset'.
+
+        block_size is the size of each SLIP frame sent by the stub and max_in_flight the
+        number of frames the stub may send before waiting for an acknowledgement. Both
+        default to READ_FLASH_BLOCK_SIZE / READ_FLASH_MAX_IN_FLIGHT.
+
+        If adaptive is set, the read is split into several READ_FLASH requests. The window
+        grows while requests complete cleanly and shrinks (and the request is retried)
+        after a timeout or a corrupt frame.
+        """
+        if block_size is None:
+            block_size = self.READ_FLASH_BLOCK_SIZE
+        if max_in_flight is None:
+            max_in_flight = self.READ_FLASH_MAX_IN_FLIGHT
+        if not 0 < block_size <= self.FLASH_SECTOR_SIZE:
+            raise FatalError("Read block size must be between 1 and 0x%x bytes" % self.FLASH_SECTOR_SIZE)
+        if max_in_flight < 1:
+            raise FatalError("At least one read block must be allowed in flight")
+
+        if not adaptive:
+            data = self._read_flash_request(offset, length, block_size, max_in_flight,
+                                            progress_fn and (lambda done: progress_fn(done, length)))
+            if progress_fn:
+                progress_fn(len(data), length)
+            return data
+
+        data = bytearray()
+        failures = 0
+        while len(data) < length:
+            # make each request a few windows long, so a failure only costs a small retry
+            chunk = min(length - len(data), block_size * max_in_flight * self.READ_FLASH_ADAPTIVE_WINDOWS)
+            done = len(data)
+            try:
+                data += self._read_flash_request(offset + done, chunk, block_size, max_in_flight,
+                                                 progress_fn and (lambda n: progress_fn(done + n, length)))
+            except FatalError as e:
+                failures += 1
+                if failures > self.READ_FLASH_ADAPTIVE_RETRIES:
+                    raise
+                self._read_flash_abort(chunk)
+                if max_in_flight > 1:
+                    max_in_flight //= 2
+                else:
+                    block_size = max(self.READ_FLASH_MIN_BLOCK_SIZE, block_size // 2)
+                self.trace("read_flash failed at 0x%08x (%s), now %d x 0x%x bytes in flight",
+                           offset + done, e, max_in_flight, block_size)
+                continue
+            failures = 0
+            if block_size < self.FLASH_SECTOR_SIZE:
+                block_size = min(self.FLASH_SECTOR_SIZE, block_size * 2)
+            else:
+                max_in_flight = min(self.READ_FLASH_MAX_IN_FLIGHT_LIMIT, max_in_flight * 2)
+        if progress_fn:
+            progress_fn(len(data), length)
+        return bytes(data)
+
+    def _read_flash_request(self, offset, length, block_size, max_in_flight, progress_fn=None):
+        """ Issue a single READ_FLASH request and collect the frames and digest the stub sends back """
+        # issue a standard bootloader command to trigger the read, the stub
+        # counts its window in bytes: it sends while fewer than that many
+        # bytes are not acknowledged
         self.check_command("read flash", self.ESP_READ_FLASH,
                            struct.pack('<IIII',
                                        offset,
                                        length,
-                                       self.FLASH_SECTOR_SIZE,
-                                       64))
+                                       block_size,
+                                       block_size * max_in_flight))
+        # acknowledge every half window instead of every frame, the stub
+        # only needs an ack before it runs out of frames it may send
+        ack_every = max(1, max_in_flight // 2)
+        unacked = 0
         # now we expect (length // block_size) SLIP frames with the data
-        data = b''
-        while len(data) < length:
-            p = self.read()
-            data += p
-            if len(data) < length and len(p) < self.FLASH_SECTOR_SIZE:
-                raise FatalError('Corrupt data, expected 0x%x bytes but received 0x%x bytes' % (self.FLASH_SECTOR_SIZE, len(p)))
-            self.write(struct.pack('<I', len(data)))
-            if progress_fn and (len(data) % 1024 == 0 or len(data) == length):
-                progress_fn(len(data), length)
-        if progress_fn:
-            progress_fn(len(data), length)
-        if len(data) > length:
-            raise FatalError('Read more than expected')
-        digest_frame = self.read()
+        data = bytearray()
+        saved_timeout = self._port.timeout
+        self._port.timeout = DEFAULT_TIMEOUT
+        try:
+            while len(data) < length:
+                p = self.read()
+                data += p
+                if len(data) < length and len(p) < block_size:
+                    raise FatalError('Corrupt data, expected 0x%x bytes but received 0x%x bytes' % (block_size, len(p)))
+                unacked += 1
+                if unacked >= ack_every or len(data) >= length:
+                    self.write(struct.pack('<I', len(data)))
+                    unacked = 0
+                if progress_fn and (len(data) % 1024 == 0 or len(data) == length):
+                    progress_fn(len(data))
+            if len(data) > length:
+                raise FatalError('Read more than expected')
+            digest_frame = self.read()
+        finally:
+            self._port.timeout = saved_timeout
         if len(digest_frame) != 16:
             raise FatalError('Expected digest, got: %s' % hexify(digest_frame))
         expected_digest = hexify(digest_frame).upper()
         digest = hashlib.md5(data).hexdigest().upper()
         if digest != expected_digest:
             raise FatalError('Digest mismatch: expected %s, got %s' % (expected_digest, digest))
-        return data
+        return bytes(data)
+
+    def _read_flash_abort(self, length):
+        """ Get the stub out of an interrupted READ_FLASH request
+
+        Acknowledging the whole request makes the stub finish sending its
+        current window and the digest, which are then discarded.
+        """
+        self.write(struct.pack('<I', length))
+        deadline = time.time() + DEFAULT_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(SYNC_TIMEOUT)
+            if self._port.inWaiting() == 0:
+                break
+            self._port.flushInput()
+        self.flush_input()
 
     def flash_spi_attach(self, hspi_arg):
         """Send SPI attach command to enable the SPI flash pins
@@ -1217,13 +1386,16 @@ class ESPBOOTLOADER(object):
     IMAGE_V2_SEGMENT = 4
 
 
-def LoadFirmwareImage(chip, filename):
+def LoadFirmwareImage(chip, filename, use_mmap=False):
     """ Load a firmware image. Can be for ESP8266 or ESP32. ESP8266 images will be examined to determine if they are
         original ROM firmware images (ESP8266ROMFirmwareImage) or "v2" OTA bootloader images.
 
+        If use_mmap is set, the file is memory mapped and segment data are views into the
+        mapping, so only the parts of the image which are actually used get read.
+
         Returns a BaseFirmwareImage subclass, either ESP8266ROMFirmwareImage (v1) or ESP8266V2FirmwareImage (v2).
     """
-    with open(filename, 'rb') as f:
+    def select_image_class(f):
         if chip.lower() == 'esp32':
             return ESP32FirmwareImage(f)
         else:  # Otherwise, ESP8266 so look at magic to determine the image type
@@ -1236,6 +1408,16 @@ def LoadFirmwareImage(chip, filename):
             else:
                 raise FatalError("Invalid image magic number: %d" % magic)
 
+    with open(filename, 'rb') as f:
+        if not use_mmap:
+            return select_image_class(f)
+        try:
+            # the mapping stays valid after the file is closed
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise FatalError("%s is empty" % filename)
+    return select_image_class(mapped)
+
 
 class ImageSegment(object):
     """ Wrapper class for a segment in an ESP image
@@ -1313,7 +1495,12 @@ class BaseFirmwareImage(object):
         file_offs = f.tell()
         (offset, size) = struct.unpack('<II', f.read(8))
         self.warn_if_unusual_segment(offset, size, is_irom_segment)
-        segment_data = f.read(size)
+        if isinstance(f, mmap.mmap):
+            # don't read memory mapped segments, refer to them
+            segment_data = memoryview(f)[file_offs + 8:file_offs + 8 + size]
+            f.seek(file_offs + 8 + len(segment_data))
+        else:
+            segment_data = f.read(size)
         if len(segment_data) < size:
             raise FatalError('End of file reading segment 0x%x, length %d (actual length %d)' % (offset, size, len(segment_data)))
         segment = ImageSegment(offset, segment_data, file_offs)
@@ -1341,8 +1528,8 @@ class BaseFirmwareImage(object):
             assert(len(self.elf_sha256) == self.SHA256_DIGEST_LEN)
             # offset relative to the data part
             patch_offset -= self.SEG_HEADER_LEN
-            segment_data = segment_data[0:patch_offset] + self.elf_sha256 + \
-                segment_data[patch_offset + self.SHA256_DIGEST_LEN:]
+            segment_data = b''.join([segment_data[0:patch_offset], self.elf_sha256,
+                                     segment_data[patch_offset + self.SHA256_DIGEST_LEN:]])
         return segment_data
 
     def save_segment(self, f, segment, checksum=None):
@@ -1578,6 +1765,8 @@ class ESP32FirmwareImage(BaseFirmwareImage):
         self.wp_drv = 0
 
         self.append_digest = True
+        self._calc_digest = None
+        self._digest_range = None
 
         if load_file is not None:
             start = load_file.tell()
@@ -1592,13 +1781,21 @@ class ESP32FirmwareImage(BaseFirmwareImage):
             if self.append_digest:
                 end = load_file.tell()
                 self.stored_digest = load_file.read(32)
-                load_file.seek(start)
-                calc_digest = hashlib.sha256()
-                calc_digest.update(load_file.read(end - start))
-                self.calc_digest = calc_digest.digest()  # TODO: decide what to do here?
+                if isinstance(load_file, mmap.mmap):
+                    # the mapping stays usable, so only hash it if the digest is asked for
+                    self._digest_range = (load_file, start, end)
+                else:
+                    self._calc_digest = sha256_file_range(load_file, start, end)
 
             self.verify()
 
+    @property
+    def calc_digest(self):
+        """ SHA-256 digest of the loaded image, calculated on first use for memory mapped images """
+        if self._calc_digest is None and self._digest_range is not None:
+            self._calc_digest = sha256_file_range(*self._digest_range)
+        return self._calc_digest
+
     def is_flash_addr(self, addr):
         return (ESP32ROM.IROM_MAP_START <= addr < ESP32ROM.IROM_MAP_END) \
             or (ESP32ROM.DROM_MAP_START <= addr < ESP32ROM.DROM_MAP_END)
@@ -1611,126 +1808,144 @@ class ESP32FirmwareImage(BaseFirmwareImage):
         pass  # TODO: add warnings for ESP32 segment offset/size combinations that are wrong
 
     def save(self, filename):
-        total_segments = 0
-        with io.BytesIO() as f:  # write file to memory first
-            self.write_common_header(f, self.segments)
+        # The segment count in the header is covered by the SHA-256 digest, so lay out all
+        # (padding) segments first, then stream them to the file updating digest & checksum
+        segments = self.layout_segments()
+
+        with open(filename, 'wb') as real_file:
+            f = DigestingWriter(real_file)
+            self.write_common_header(f, segments)
 
             # first 4 bytes of header are read by ROM bootloader for SPI
             # config, but currently unused
             self.save_extended_header(f)
 
             checksum = ESPLoader.ESP_CHECKSUM_MAGIC
-
-            # split segments into flash-mapped vs ram-loaded, and take copies so we can mutate them
-            flash_segments = [copy.deepcopy(s) for s in sorted(self.segments, key=lambda s:s.addr) if self.is_flash_addr(s.addr)]
-            ram_segments = [copy.deepcopy(s) for s in sorted(self.segments, key=lambda s:s.addr) if not self.is_flash_addr(s.addr)]
-
-            # check for multiple ELF sections that are mapped in the same flash mapping region.
-            # this is usually a sign of a broken linker script, but if you have a legitimate
-            # use case then let us know (we can merge segments here, but as a rule you probably
-            # want to merge them in your linker script.)
-            if len(flash_segments) > 0:
-                last_addr = flash_segments[0].addr
-                for segment in flash_segments[1:]:
-                    if segment.addr // self.IROM_ALIGN == last_addr // self.IROM_ALIGN:
-                        raise FatalError(("Segment loaded at 0x%08x lands in same 64KB flash mapping as segment loaded at 0x%08x. " +
-                                          "Can't generate binary. Suggest changing linker script or ELF to merge sections.") %
-                                         (segment.addr, last_addr))
-                    last_addr = segment.addr
-
-            def get_alignment_data_needed(segment):
-                # Actual alignment (in data bytes) required for a segment header: positioned so that
-                # after we write the next 8 byte header, file_offs % IROM_ALIGN == segment.addr % IROM_ALIGN
-                #
-                # (this is because the segment's vaddr may not be IROM_ALIGNed, more likely is aligned
-                # IROM_ALIGN+0x18 to account for the binary file header
-                align_past = (segment.addr % self.IROM_ALIGN) - self.SEG_HEADER_LEN
-                pad_len = (self.IROM_ALIGN - (f.tell() % self.IROM_ALIGN)) + align_past
-                if pad_len == 0 or pad_len == self.IROM_ALIGN:
-                    return 0  # already aligned
-
-                # subtract SEG_HEADER_LEN a second time, as the padding block has a header as well
-                pad_len -= self.SEG_HEADER_LEN
-                if pad_len < 0:
-                    pad_len += self.IROM_ALIGN
-                return pad_len
-
-            # try to fit each flash segment on a 64kB aligned boundary
-            # by padding with parts of the non-flash segments...
-            while len(flash_segments) > 0:
-                segment = flash_segments[0]
-                pad_len = get_alignment_data_needed(segment)
-                if pad_len > 0:  # need to pad
-                    if len(ram_segments) > 0 and pad_len > self.SEG_HEADER_LEN:
-                        pad_segment = ram_segments[0].split_image(pad_len)
-                        if len(ram_segments[0].data) == 0:
-                            ram_segments.pop(0)
-                    else:
-                        pad_segment = ImageSegment(0, b'\x00' * pad_len, f.tell())
-                    checksum = self.save_segment(f, pad_segment, checksum)
-                    total_segments += 1
-                else:
-                    # write the flash segment
-                    assert (f.tell() + 8) % self.IROM_ALIGN == segment.addr % self.IROM_ALIGN
-                    checksum = self.save_flash_segment(f, segment, checksum)
-                    flash_segments.pop(0)
-                    total_segments += 1
-
-            # flash segments all written, so write any remaining RAM segments
-            for segment in ram_segments:
-                checksum = self.save_segment(f, segment, checksum)
-                total_segments += 1
-
-            if self.secure_pad:
-                # pad the image so that after signing it will end on a a 64KB boundary.
-                # This ensures all mapped flash content will be verified.
-                if not self.append_digest:
-                    raise FatalError("secure_pad only applies if a SHA-256 digest is also appended to the image")
-                align_past = (f.tell() + self.SEG_HEADER_LEN) % self.IROM_ALIGN
-                # 16 byte aligned checksum (force the alignment to simplify calculations)
-                checksum_space = 16
-                # after checksum: SHA-256 digest + (to be added by signing process) version, signature + 12 trailing bytes due to alignment
-                space_after_checksum = 32 + 4 + 64 + 12
-                pad_len = (self.IROM_ALIGN - align_past - checksum_space - space_after_checksum) % self.IROM_ALIGN
-                pad_segment = ImageSegment(0, b'\x00' * pad_len, f.tell())
-
-                checksum = self.save_segment(f, pad_segment, checksum)
-                total_segments += 1
+            for addr, parts in segments:
+                checksum = self.save_segment_parts(f, addr, parts, checksum)
 
             # done writing segments
             self.append_checksum(f, checksum)
             image_length = f.tell()
 
             if self.secure_pad:
+                space_after_checksum = 32 + 4 + 64 + 12
                 assert ((image_length + space_after_checksum) % self.IROM_ALIGN) == 0
 
-            # kinda hacky: go back to the initial header and write the new segment count
-            # that includes padding segments. This header is not checksummed
-            f.seek(1)
-            try:
-                f.write(chr(total_segments))
-            except TypeError:  # Python 3
-                f.write(bytes([total_segments]))
-
             if self.append_digest:
-                # calculate the SHA256 of the whole file and append it
-                f.seek(0)
-                digest = hashlib.sha256()
-                digest.update(f.read(image_length))
-                f.write(digest.digest())
+                # append the SHA256 of the whole file
+                real_file.write(f.sha256.digest())
 
-            with open(filename, 'wb') as real_file:
-                real_file.write(f.getvalue())
+    def layout_segments(self):
+        """ Work out the segments to write into the image, in order.
 
-    def save_flash_segment(self, f, segment, checksum=None):
-        """ Save the next segment to the image file, return next checksum value if provided """
-        segment_end_pos = f.tell() + len(segment.data) + self.SEG_HEADER_LEN
+        Returns a list of (load address, [data buffers]) pairs. Flash-mapped segments are
+        placed on 64kB aligned offsets by padding with parts of the RAM-loaded segments
+        (or zeroes.) Buffers are memoryviews of the original segment data where possible,
+        the segments themselves are left unchanged.
+        """
+        # split segments into flash-mapped vs ram-loaded
+        flash_segments = [s for s in sorted(self.segments, key=lambda s:s.addr) if self.is_flash_addr(s.addr)]
+        ram_segments = [(s.addr, memoryview(s.data)) for s in sorted(self.segments, key=lambda s:s.addr) if not self.is_flash_addr(s.addr)]
+
+        # check for multiple ELF sections that are mapped in the same flash mapping region.
+        # this is usually a sign of a broken linker script, but if you have a legitimate
+        # use case then let us know (we can merge segments here, but as a rule you probably
+        # want to merge them in your linker script.)
+        if len(flash_segments) > 0:
+            last_addr = flash_segments[0].addr
+            for segment in flash_segments[1:]:
+                if segment.addr // self.IROM_ALIGN == last_addr // self.IROM_ALIGN:
+                    raise FatalError(("Segment loaded at 0x%08x lands in same 64KB flash mapping as segment loaded at 0x%08x. " +
+                                      "Can't generate binary. Suggest changing linker script or ELF to merge sections.") %
+                                     (segment.addr, last_addr))
+                last_addr = segment.addr
+
+        layout = []
+        # file position after the common and extended headers
+        pos = [8 + 16]
+
+        def add_segment(addr, *parts):
+            layout.append((addr, parts))
+            pos[0] += self.SEG_HEADER_LEN + sum(len(p) for p in parts)
+
+        def get_alignment_data_needed(segment):
+            # Actual alignment (in data bytes) required for a segment header: positioned so that
+            # after we write the next 8 byte header, file_offs % IROM_ALIGN == segment.addr % IROM_ALIGN
+            #
+            # (this is because the segment's vaddr may not be IROM_ALIGNed, more likely is aligned
+            # IROM_ALIGN+0x18 to account for the binary file header
+            align_past = (segment.addr % self.IROM_ALIGN) - self.SEG_HEADER_LEN
+            pad_len = (self.IROM_ALIGN - (pos[0] % self.IROM_ALIGN)) + align_past
+            if pad_len == 0 or pad_len == self.IROM_ALIGN:
+                return 0  # already aligned
+
+            # subtract SEG_HEADER_LEN a second time, as the padding block has a header as well
+            pad_len -= self.SEG_HEADER_LEN
+            if pad_len < 0:
+                pad_len += self.IROM_ALIGN
+            return pad_len
+
+        # try to fit each flash segment on a 64kB aligned boundary
+        # by padding with parts of the non-flash segments...
+        while len(flash_segments) > 0:
+            segment = flash_segments[0]
+            pad_len = get_alignment_data_needed(segment)
+            if pad_len > 0:  # need to pad
+                if len(ram_segments) > 0 and pad_len > self.SEG_HEADER_LEN:
+                    addr, data = ram_segments[0]
+                    add_segment(addr, data[:pad_len])
+                    ram_segments[0] = (addr + pad_len, data[pad_len:])
+                    if len(ram_segments[0][1]) == 0:
+                        ram_segments.pop(0)
+                else:
+                    add_segment(0, b'\x00' * pad_len)
+            else:
+                # write the flash segment
+                assert (pos[0] + 8) % self.IROM_ALIGN == segment.addr % self.IROM_ALIGN
+                add_segment(segment.addr, memoryview(segment.data), self.flash_segment_padding(pos[0], len(segment.data)))
+                flash_segments.pop(0)
+
+        # flash segments all laid out, so add any remaining RAM segments
+        for addr, data in ram_segments:
+            add_segment(addr, data)
+
+        if self.secure_pad:
+            # pad the image so that after signing it will end on a a 64KB boundary.
+            # This ensures all mapped flash content will be verified.
+            if not self.append_digest:
+                raise FatalError("secure_pad only applies if a SHA-256 digest is also appended to the image")
+            align_past = (pos[0] + self.SEG_HEADER_LEN) % self.IROM_ALIGN
+            # 16 byte aligned checksum (force the alignment to simplify calculations)
+            checksum_space = 16
+            # after checksum: SHA-256 digest + (to be added by signing process) version, signature + 12 trailing bytes due to alignment
+            space_after_checksum = 32 + 4 + 64 + 12
+            pad_len = (self.IROM_ALIGN - align_past - checksum_space - space_after_checksum) % self.IROM_ALIGN
+            add_segment(0, b'\x00' * pad_len)
+
+        return layout
+
+    def flash_segment_padding(self, file_pos, data_len):
+        """ Return the zero padding to append to a flash segment whose header is written at file_pos """
+        segment_end_pos = file_pos + data_len + self.SEG_HEADER_LEN
         segment_len_remainder = segment_end_pos % self.IROM_ALIGN
         if segment_len_remainder < 0x24:
             # Work around a bug in ESP-IDF 2nd stage bootloader, that it didn't map the
             # last MMU page, if an IROM/DROM segment was < 0x24 bytes over the page boundary.
-            segment.data += b'\x00' * (0x24 - segment_len_remainder)
-        return self.save_segment(f, segment, checksum)
+            return b'\x00' * (0x24 - segment_len_remainder)
+        return b''
+
+    def save_segment_parts(self, f, addr, parts, checksum):
+        """ Save a segment made up of several data buffers to the image file, return next checksum value """
+        segment_len = sum(len(p) for p in parts)
+        if f.tell() <= self.elf_sha256_offset < f.tell() + segment_len:
+            # only join the buffers if the ELF SHA256 digest has to be patched in
+            parts = [self.maybe_patch_segment_data(f, b''.join(parts))]
+        f.write(struct.pack('<II', addr, segment_len))
+        for data in parts:
+            f.write(data)
+            checksum = ESPLoader.checksum(data, checksum)
+        return checksum
 
     def load_extended_header(self, load_file):
         def split_byte(n):
@@ -1777,11 +1992,35 @@ class ELFFile(object):
 
     LEN_SEC_HEADER = 0x28
 
-    def __init__(self, name):
-        # Load sections from the ELF file
+    # Where parsed section tables are cached, if ELFFile is created with use_cache=True
+    CACHE_DIR = os.environ.get('ESPTOOL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'esptool'))
+
+    def __init__(self, name, use_cache=False):
+        # Map the ELF file, section data is only read from it when used
         self.name = name
+        self._sha256 = None
         with open(self.name, 'rb') as f:
-            self._read_elf_file(f)
+            self._stat = os.fstat(f.fileno())
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise FatalError("Failed to read a valid ELF header from %s: file is empty" % self.name)
+
+        cached = self._read_cache() if use_cache else None
+        if cached is not None:
+            self.entrypoint = cached['entrypoint']
+            section_table = cached['sections']
+            if cached['sha256'] is not None:
+                self._sha256 = binascii.unhexlify(cached['sha256'])
+        else:
+            section_table = self._read_elf_file(self._mmap)
+        self._section_table = section_table
+        self._use_cache = use_cache
+        if use_cache and cached is None:
+            self._write_cache()
+
+        data = memoryview(self._mmap)
+        self.sections = [ELFSection(name.encode('utf-8'), lma, data[offs:offs + size]) for (name, lma, offs, size) in section_table]
 
     def get_section(self, section_name):
         for s in self.sections:
@@ -1790,6 +2029,7 @@ class ELFFile(object):
         raise ValueError("No section %s in ELF file" % section_name)
 
     def _read_elf_file(self, f):
+        """ Parse the ELF header and section headers. Returns the table of sections to load. """
         # read the ELF file header
         LEN_FILE_HEADER = 0x34
         try:
@@ -1808,9 +2048,10 @@ class ELFFile(object):
             raise FatalError("%s has unexpected section header entry size 0x%x (not 0x28)" % (self.name, shentsize, self.LEN_SEC_HEADER))
         if shnum == 0:
             raise FatalError("%s has 0 section headers" % (self.name))
-        self._read_sections(f, shoff, shnum, shstrndx)
+        return self._read_sections(f, shoff, shnum, shstrndx)
 
     def _read_sections(self, f, section_header_offs, section_header_count, shstrndx):
+        """ Returns a (name, load address, file offset, size) tuple for each section to load """
         f.seek(section_header_offs)
         len_bytes = section_header_count * self.LEN_SEC_HEADER
         section_header = f.read(len_bytes)
@@ -1837,26 +2078,57 @@ class ELFFile(object):
         f.seek(sec_offs)
         string_table = f.read(sec_size)
 
-        # build the real list of ELFSections by reading the actual section names from the
-        # string table section, and actual data for each section from the ELF file itself
+        # look up the actual section names in the string table section,
+        # section data is taken from the ELF file when it's used
         def lookup_string(offs):
             raw = string_table[offs:]
-            return raw[:raw.index(b'\x00')]
+            return raw[:raw.index(b'\x00')].decode('utf-8')
 
-        def read_data(offs,size):
-            f.seek(offs)
-            return f.read(size)
+        return [(lookup_string(n_offs), lma, offs, size) for (n_offs, _type, lma, size, offs) in prog_sections
+                if lma != 0 and size > 0]
 
-        prog_sections = [ELFSection(lookup_string(n_offs), lma, read_data(offs, size)) for (n_offs, _type, lma, size, offs) in prog_sections
-                         if lma != 0 and size > 0]
-        self.sections = prog_sections
+    def _cache_path(self):
+        key = hashlib.sha1(os.path.abspath(self.name).encode('utf-8')).hexdigest()
+        return os.path.join(self.CACHE_DIR, 'elf-%s.json' % key)
+
+    def _read_cache(self):
+        """ Return the cached parse results for this file, or None if there are none or the file has changed """
+        try:
+            with open(self._cache_path(), 'r') as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if cached.get('version') != __version__ or cached.get('path') != os.path.abspath(self.name) \
+                or cached.get('mtime') != self._stat.st_mtime or cached.get('size') != self._stat.st_size:
+            return None
+        return cached
+
+    def _write_cache(self):
+        cached = {
+            'version': __version__,
+            'path': os.path.abspath(self.name),
+            'mtime': self._stat.st_mtime,
+            'size': self._stat.st_size,
+            'entrypoint': self.entrypoint,
+            'sections': self._section_table,
+            'sha256': None if self._sha256 is None else hexify(self._sha256, False),
+        }
+        # the cache only saves time, so don't fail because of it
+        try:
+            if not os.path.isdir(self.CACHE_DIR):
+                os.makedirs(self.CACHE_DIR)
+            with open(self._cache_path(), 'w') as f:
+                json.dump(cached, f)
+        except (IOError, OSError):
+            pass
 
     def sha256(self):
-        # return SHA256 hash of the input ELF file
-        sha256 = hashlib.sha256()
-        with open(self.name, 'rb') as f:
-            sha256.update(f.read())
-        return sha256.digest()
+        # return SHA256 hash of the input ELF file, hashing the mapped file only once
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self._mmap).digest()
+            if self._use_cache:
+                self._write_cache()
+        return self._sha256
 
 
 def slip_reader(port, trace_function):
@@ -1866,45 +2138,184 @@ def slip_reader(port, trace_function):
     Designed to avoid too many calls to serial.read(1), which can bog
     down on slow systems.
     """
-    partial_packet = None
-    in_escape = False
+    decoder = SlipDecoder(trace_function)
     while True:
         waiting = port.inWaiting()
         read_bytes = port.read(1 if waiting == 0 else waiting)
         if read_bytes == b'':
-            waiting_for = "header" if partial_packet is None else "content"
+            waiting_for = "header" if decoder.idle else "content"
             trace_function("Timed out waiting for packet %s", waiting_for)
             raise FatalError("Timed out waiting for packet %s" % waiting_for)
         trace_function("Read %d bytes: %s", len(read_bytes), HexFormatter(read_bytes))
-        for b in read_bytes:
-            if type(b) is int:
-                b = bytes([b])  # python 2/3 compat
+        try:
+            for packet in decoder.feed(read_bytes):
+                yield packet
+        except FatalError:
+            trace_function("Read invalid data: %s", HexFormatter(read_bytes))
+            trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
+            raise
+
+
+class SlipDecoder(object):
+    """
+    Incremental SLIP decoder, independent of where the bytes come from.
+
+    feed() takes whatever has been received so far and yields every packet
+    completed by it, keeping partial packets for the next call. Raises
+    FatalError on invalid data, after yielding the packets before it.
+    """
+    def __init__(self, trace_function=None):
+        self._trace = trace_function
+        self._packet = None  # escaped content of the current packet, None between packets
+
+    @property
+    def idle(self):
+        """ True when not part-way through a packet """
+        return self._packet is None
+
+    def reset(self):
+        self._packet = None
+
+    def feed(self, data):
+        data = bytes(data)
+        pos = 0
+        while pos < len(data):
+            if self._packet is None:  # waiting for packet header
+                if data[pos:pos + 1] != b'\xc0':
+                    raise FatalError('Invalid head of packet (0x%s)' % hexify(data[pos:pos + 1]))
+                self._packet = b''
+                pos += 1
+                continue
+            end = data.find(b'\xc0', pos)
+            if end < 0:
+                self._packet += data[pos:]
+                break
+            packet = slip_unescape(self._packet + data[pos:end])
+            self._packet = None
+            pos = end + 1
+            if self._trace:
+                self._trace("Received full packet: %s", HexFormatter(packet))
+            yield packet
+
+
+def slip_encode(packet):
+    """ Frame a packet for sending, performing SLIP escaping """
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+def slip_unescape(content):
+    """ Undo the SLIP escaping of the content of a received packet """
+    if b'\xdb' not in content:
+        return content
+    parts = content.split(b'\xdb')
+    result = [parts[0]]
+    for part in parts[1:]:
+        if part[:1] == b'\xdc':
+            result.append(b'\xc0' + part[1:])
+        elif part[:1] == b'\xdd':
+            result.append(b'\xdb' + part[1:])
+        else:
+            raise FatalError('Invalid SLIP escape (0xdb, 0x%s)' % hexify(part[:1]))
+    return b''.join(result)
+
+
+def command_packet(op, data=b'', chk=0):
+    """ Build the (unframed) packet of a bootloader command """
+    return struct.pack(b'<BBHI', 0x00, op, len(data), chk) + data
+
+
+def parse_response(packet):
+    """ Split a bootloader response packet into (op, val, data), or return None if it isn't a response """
+    if len(packet) < 8:
+        return None
+    (resp, op_ret, len_ret, val) = struct.unpack('<BBHI', packet[:8])
+    if resp != 1:
+        return None
+    return op_ret, val, packet[8:]
+
+
+def serial_low_latency(port):
+    """ Whether the low latency flag of the serial driver is set, None where it can't be read """
+    try:
+        import array
+        import fcntl
+        import termios
+        buf = array.array('i', [0] * 32)
+        fcntl.ioctl(port.fd, termios.TIOCGSERIAL, buf)
+        return bool(buf[4] & 0x2000)  # ASYNC_LOW_LATENCY
+    except (ImportError, AttributeError, TypeError, IOError, OSError):
+        return None
+
+
+def tune_serial_port(port):
+    """ Lower the latency of a serial port, which sets the round trip time of small commands
+
+    Best effort, as drivers and permissions differ. On Linux this sets the low latency
+    flag of the serial driver (ASYNC_LOW_LATENCY through the TIOCSSERIAL ioctl) and lowers
+    the latency timer of FTDI adapters to SERIAL_LATENCY_TIMER ms. Where pyserial can set
+    the driver buffer sizes (Windows), they are raised to SERIAL_BUFFER_SIZE. Ports opened
+    by URL (rfc2217://, socket://, loop://) are not local serial ports and are left alone.
+
+    Returns a list describing the changes made, empty when everything was tuned already.
+    """
+    changes = []
+    device = getattr(port, 'port', None)
+    if isinstance(device, basestring) and '://' in device:
+        return changes
+
+    if hasattr(port, 'set_low_latency_mode') and serial_low_latency(port) is False:
+        try:
+            port.set_low_latency_mode(True)
+        except (ValueError, IOError, OSError):
+            pass  # the driver doesn't support it
+        # Some drivers accept the flag without keeping it
+        if serial_low_latency(port):
+            changes.append('low latency mode')
+
+    # FTDI adapters wait up to their latency timer (16 ms by default) before sending a short reply
+    if isinstance(device, basestring) and sys.platform.startswith('linux'):
+        path = '/sys/bus/usb-serial/devices/%s/latency_timer' % os.path.basename(os.path.realpath(device))
+        try:
+            with open(path, 'r') as f:
+                timer = int(f.read())
+            if timer > SERIAL_LATENCY_TIMER:
+                with open(path, 'w') as f:
+                    f.write('%d' % SERIAL_LATENCY_TIMER)
+                changes.append('latency timer %d -> %d ms' % (timer, SERIAL_LATENCY_TIMER))
+        except (IOError, OSError, ValueError):
+            pass  # not an FTDI adapter, or not allowed to change it
+
+    # The buffer sizes can't be read back, the port remembers setting them
+    if hasattr(port, 'set_buffer_size') and getattr(port, '_tuned_buffer_size', None) != SERIAL_BUFFER_SIZE:
+        try:
+            port.set_buffer_size(rx_size=SERIAL_BUFFER_SIZE, tx_size=SERIAL_BUFFER_SIZE)
+            port._tuned_buffer_size = SERIAL_BUFFER_SIZE
+            changes.append('%d byte driver buffers' % SERIAL_BUFFER_SIZE)
+        except (ValueError, IOError, OSError):
+            pass
+    return changes
+
+
+def measure_round_trip(esp, samples=10):
+    """ Median round trip time of a small command (read_reg), in seconds """
+    times = []
+    for _ in range(samples):
+        t = time.time()
+        esp.read_reg(ESPLoader.UART_DATA_REG_ADDR)
+        times.append(time.time() - t)
+    return sorted(times)[len(times) // 2]
 
-            if partial_packet is None:  # waiting for packet header
-                if b == b'\xc0':
-                    partial_packet = b""
-                else:
-                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
-                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
-                    raise FatalError('Invalid head of packet (0x%s)' % hexify(b))
-            elif in_escape:  # part-way through escape sequence
-                in_escape = False
-                if b == b'\xdc':
-                    partial_packet += b'\xc0'
-                elif b == b'\xdd':
-                    partial_packet += b'\xdb'
-                else:
-                    trace_function("Read invalid data: %s", HexFormatter(read_bytes))
-                    trace_function("Remaining data in serial buffer: %s", HexFormatter(port.read(port.inWaiting())))
-                    raise FatalError('Invalid SLIP escape (0xdb, 0x%s)' % (hexify(b)))
-            elif b == b'\xdb':  # start of escape sequence
-                in_escape = True
-            elif b == b'\xc0':  # end of packet
-                trace_function("Received full packet: %s", HexFormatter(partial_packet))
-                yield partial_packet
-                partial_packet = None
-            else:  # normal byte in packet
-                partial_packet += b
+
+def tune_latency(esp, samples=10):
+    """ Tune the serial port of the loader with tune_serial_port, reporting the round trip
+    time before and after. Returns the (before, after) round trip times in seconds.
+    """
+    before = measure_round_trip(esp, samples)
+    changes = tune_serial_port(esp._port)
+    after = measure_round_trip(esp, samples) if changes else before
+    print('Command round trip %.1f ms -> %.1f ms (%s)' % (before * 1000, after * 1000,
+                                                        ', '.join(changes) or 'tuned already or not possible'))
+    return before, after
 
 
 def arg_auto_int(x):
@@ -1980,10 +2391,156 @@ class HexFormatter(object):
             return hexify(self._s, False)
 
 
+class DigestingWriter(object):
+    """
+    Wrapper around a file opened for writing which keeps a running SHA-256
+    digest of everything written through it.
+
+    Seeking forward (as align_file_position does) writes zero bytes, so the
+    result is the same as writing into a seekable buffer and hashing that,
+    without holding the whole file in memory.
+    """
+    def __init__(self, f):
+        self._f = f
+        self._pos = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        self._f.write(data)
+        self._pos += len(data)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            offset -= self._pos
+        elif whence != 1:
+            raise io.UnsupportedOperation("DigestingWriter can't seek relative to the end")
+        if offset < 0:
+            raise io.UnsupportedOperation("DigestingWriter can only seek forward")
+        self.write(b'\x00' * offset)
+
+
+class ProgressEvent(object):
+    """
+    One progress report of a long running operation.
+
+    phase names what is being done ('write', 'read', 'backup'...), done and
+    total are counted in (uncompressed) bytes. rate is the throughput since
+    the previous event and average_rate the throughput since the phase started,
+    both in bytes per second. eta is the estimated number of seconds left, or
+    None until it can be estimated.
+    """
+    def __init__(self, phase, done, total, elapsed, rate, average_rate, eta):
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.elapsed = elapsed
+        self.rate = rate
+        self.average_rate = average_rate
+        self.eta = eta
+
+    @property
+    def percent(self):
+        return 100 * self.done // self.total if self.total else 100
+
+    @property
+    def finished(self):
+        return self.done >= self.total
+
+    def as_dict(self):
+        return dict(phase=self.phase, done=self.done, total=self.total, percent=self.percent,
+                    elapsed=self.elapsed, rate=self.rate, average_rate=self.average_rate, eta=self.eta)
+
+
+class ProgressReporter(object):
+    """
+    Coalesces the progress updates of a long running operation into
+    ProgressEvents, passing at most one every interval seconds to callback.
+
+    update() is cheap enough to call for every block in a hot loop: it only
+    reads the clock unless an event is due. The start and the end of every
+    phase are always reported. If callback is None nothing is reported.
+    """
+    def __init__(self, callback, interval=0.2):
+        self.callback = callback
+        self.interval = interval
+        self.phase = None
+        self.total = 0
+        self.done = 0
+
+    def start(self, phase, total):
+        self.phase = phase
+        self.total = total
+        self.done = 0
+        self._start = self._last_time = time.time()
+        self._last_done = 0
+        self._next = self._start + self.interval
+        self._report(self._start)
+
+    def update(self, done):
+        self.done = done
+        if self.callback is None:
+            return
+        now = time.time()
+        if now >= self._next or (done >= self.total and self._last_done < self.total):
+            self._report(now)
+
+    def advance(self, count):
+        self.update(self.done + count)
+
+    def finish(self):
+        if self.done < self.total:
+            self.update(self.total)
+
+    def _report(self, now):
+        if self.callback is None:
+            return
+        elapsed = now - self._start
+        rate = (self.done - self._last_done) / (now - self._last_time) if now > self._last_time else 0.0
+        average_rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / average_rate if average_rate > 0 else None
+        self._last_time = now
+        self._last_done = self.done
+        self._next = now + self.interval
+        self.callback(ProgressEvent(self.phase, self.done, self.total, elapsed, rate, average_rate, eta))
+
+
+def print_progress(event):
+    """ ProgressReporter callback showing progress on the console, on a single line """
+    if event.done == 0 and not event.finished:
+        return  # other messages are usually printed while starting
+    msg = '\r%s %d of %d bytes (%d %%)' % (event.phase.capitalize(), event.done, event.total, event.percent)
+    if event.rate > 0:
+        msg += ', %.1f kbit/s' % (event.rate * 8 / 1000)
+    if event.eta is not None and not event.finished:
+        msg += ', %d s left' % event.eta
+    print(msg.ljust(79), end='\n' if event.finished else '')
+    sys.stdout.flush()
+
+
+def sha256_file_range(f, start, end, chunk_size=0x10000):
+    """ Return the SHA-256 digest of bytes start to end of file f, read a chunk at a time """
+    digest = hashlib.sha256()
+    f.seek(start)
+    while start < end:
+        chunk = f.read(min(chunk_size, end - start))
+        if len(chunk) == 0:
+            break
+        digest.update(chunk)
+        start += len(chunk)
+    f.seek(end)
+    return digest.digest()
+
+
 def pad_to(data, alignment, pad_character=b'\xFF'):
     """ Pad to the next alignment boundary """
     pad_mod = len(data) % alignment
     if pad_mod != 0:
+        if isinstance(data, memoryview):
+            data = data.tobytes()  # can't extend a view, pad a copy
         data += pad_character * (alignment - pad_mod)
     return data
 
@@ -2003,7 +2560,174 @@ class FatalError(RuntimeError):
         'result' as a string formatted argument.
         """
         message += " (result was %s)" % hexify(result)
-        return FatalError(message)
+        error = FatalError(message)
+        error.result = result
+        return error
+
+
+class FlashChunkStore(object):
+    """
+    Content addressed store for flash backups.
+
+    Flash contents are kept in CHUNK_SIZE chunks, one file per chunk named by
+    its MD5 digest (the same digest flash_md5sum returns), so a chunk which is
+    identical on several devices or in several backups is only stored once.
+    Each backup is a JSON manifest listing the digests of its chunks.
+    """
+    CHUNK_SIZE = 0x10000
+
+    def __init__(self, path):
+        self.path = path
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.path, 'chunks', digest[:2], digest)
+
+    def _backup_dir(self, device):
+        return os.path.join(self.path, 'backups', device)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self._chunk_path(digest))
+
+    def add_chunk(self, data):
+        """ Store a chunk (unless already stored), returns its digest """
+        digest = hashlib.md5(data).hexdigest()
+        path = self._chunk_path(digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # write under a temporary name, so an interrupted write can't leave a bad chunk
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(path + '.tmp', path)
+        return digest
+
+    def read_chunk(self, digest):
+        try:
+            with open(self._chunk_path(digest), 'rb') as f:
+                data = f.read()
+        except IOError:
+            raise FatalError("Chunk %s is missing from %s" % (digest, self.path))
+        if hashlib.md5(data).hexdigest() != digest:
+            raise FatalError("Chunk %s in %s is corrupt" % (digest, self.path))
+        return data
+
+    def add_backup(self, device, backup):
+        """ Save a backup manifest for a device, returns the backup name """
+        backup_dir = self._backup_dir(device)
+        if not os.path.isdir(backup_dir):
+            os.makedirs(backup_dir)
+        backup['name'] = name = time.strftime('%Y%m%d-%H%M%S')
+        suffix = 1
+        while os.path.exists(os.path.join(backup_dir, backup['name'] + '.json')):
+            backup['name'] = '%s-%d' % (name, suffix)
+            suffix += 1
+        with open(os.path.join(backup_dir, backup['name'] + '.json'), 'w') as f:
+            json.dump(backup, f, indent=2)
+        return backup['name']
+
+    def load_backup(self, device, name=None):
+        """ Load a backup manifest, either a manifest file name, a backup name of this
+        device or (if name is None) the latest backup of this device """
+        if name is not None and os.path.isfile(name):
+            path = name
+        else:
+            backup_dir = self._backup_dir(device)
+            if name is None:
+                names = sorted(n for n in os.listdir(backup_dir) if n.endswith('.json')) if os.path.isdir(backup_dir) else []
+                if len(names) == 0:
+                    raise FatalError("No backups of %s in %s" % (device, self.path))
+                name = names[-1][:-len('.json')]
+            path = os.path.join(backup_dir, name + '.json')
+            if not os.path.isfile(path):
+                raise FatalError("No backup %s of %s in %s" % (name, device, self.path))
+        with open(path, 'r') as f:
+            return json.load(f)
+
+
+class FlashPart(object):
+    """
+    An image to write to flash at offset, with its MD5 digest and (optionally)
+    its zlib compressed payload, ready to be streamed to the loader.
+    """
+    def __init__(self, offset, image, md5=None, compressed=None, name=None):
+        self.offset = offset
+        self.image = image
+        self.md5 = md5 if md5 is not None else hashlib.md5(image).hexdigest()
+        self.compressed = compressed
+        self.name = name if name is not None else '0x%08x' % offset
+
+    def compress(self):
+        if self.compressed is None:
+            self.compressed = zlib.compress(self.image, 9)
+        return self.compressed
+
+
+class FlashBundle(object):
+    """
+    Several images to flash in one loader session, saved as a zip archive.
+
+    The archive holds a JSON manifest listing the offset, size and MD5 digest of
+    each part, and each part's image already zlib compressed, as it is sent to
+    the loader. Images are padded to 4 bytes when added.
+    """
+    VERSION = 1
+    MANIFEST = 'bundle.json'
+
+    def __init__(self, parts=None):
+        self.parts = parts if parts is not None else []
+
+    def add(self, offset, image, name=None):
+        part = FlashPart(offset, pad_to(image, 4), name=name)
+        part.compress()
+        self.parts.append(part)
+        return part
+
+    def save(self, filename):
+        manifest = {'version': self.VERSION, 'parts': []}
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED) as z:
+            for i, part in enumerate(sorted(self.parts, key=lambda p: p.offset)):
+                payload = 'part%d.zlib' % i
+                z.writestr(payload, part.compress())
+                manifest['parts'].append({'name': part.name, 'offset': part.offset, 'size': len(part.image),
+                                          'md5': part.md5, 'payload': payload})
+            z.writestr(self.MANIFEST, json.dumps(manifest, indent=2))
+
+    @classmethod
+    def load(cls, filename):
+        """ Load a bundle, checking every part against its digest """
+        try:
+            with zipfile.ZipFile(filename, 'r') as z:
+                manifest = json.loads(z.read(cls.MANIFEST).decode('utf-8'))
+                if manifest.get('version') != cls.VERSION:
+                    raise FatalError("%s is a version %s flash bundle, only version %d is supported" %
+                                     (filename, manifest.get('version'), cls.VERSION))
+                parts = []
+                for entry in manifest['parts']:
+                    compressed = z.read(entry['payload'])
+                    image = zlib.decompress(compressed)
+                    if len(image) != entry['size'] or hashlib.md5(image).hexdigest() != entry['md5']:
+                        raise FatalError("Part %s of flash bundle %s is corrupt" % (entry['name'], filename))
+                    parts.append(FlashPart(entry['offset'], image, entry['md5'], compressed, entry['name']))
+        except (zipfile.BadZipfile, KeyError, ValueError, zlib.error) as e:
+            raise FatalError("%s is not a valid flash bundle: %s" % (filename, e))
+        return cls(parts)
+
+    @classmethod
+    def is_bundle(cls, filename):
+        try:
+            with zipfile.ZipFile(filename, 'r') as z:
+                return cls.MANIFEST in z.namelist()
+        except (zipfile.BadZipfile, IOError):
+            return False
+
+    def addr_filename(self):
+        """ The parts as (address, file) pairs, as the addr_filename argument of the operations """
+        pairs = []
+        for part in self.parts:
+            argfile = io.BytesIO(part.image)
+            argfile.name = part.name
+            pairs.append((part.offset, argfile))
+        return pairs
 
 
 class NotImplementedInROMError(FatalError):
@@ -2109,83 +2833,46 @@ def _update_image_flash_params(esp, address, args, image):
 
 
 def write_flash(esp, args):
-    # set args.compress based on default behaviour:
-    # -> if either --compress or --no-compress is set, honour that
-    # -> otherwise, set --compress unless --no-stub is set
-    if args.compress is None and not args.no_compress:
-        args.compress = not args.no_stub
+    _set_compress_default(args)
+    sources, bundle = _flash_sources(args)
+    if len(sources) == 0:
+        raise FatalError("Nothing to write, pass address and filename pairs or a flash bundle")
 
     # verify file sizes fit in flash
     flash_end = flash_size_bytes(args.flash_size)
-    for address, argfile in args.addr_filename:
-        argfile.seek(0,2)  # seek to end
-        if address + argfile.tell() > flash_end:
+    total = 0
+    for address, source in sources:
+        if isinstance(source, FlashPart):
+            size, name = len(source.image), source.name
+        else:
+            source.seek(0,2)  # seek to end
+            size, name = source.tell(), source.name
+            source.seek(0)
+        if address + size > flash_end:
             raise FatalError(("File %s (length %d) at offset %d will not fit in %d bytes of flash. " +
                              "Use --flash-size argument, or change flashing address.")
-                             % (argfile.name, argfile.tell(), address, flash_end))
-        argfile.seek(0)
+                             % (name, size, address, flash_end))
+        total += (size + 3) & ~3  # padded to 4 bytes
 
     if args.erase_all:
         erase_flash(esp, args)
 
-    for address, argfile in args.addr_filename:
-        if args.no_stub:
-            print('Erasing flash...')
-        image = pad_to(argfile.read(), 4)
-        if len(image) == 0:
-            print('WARNING: File %s is empty' % argfile.name)
-            continue
-        image = _update_image_flash_params(esp, address, args, image)
-        calcmd5 = hashlib.md5(image).hexdigest()
-        uncsize = len(image)
-        if args.compress:
-            uncimage = image
-            image = zlib.compress(uncimage, 9)
-            ratio = uncsize / len(image)
-            blocks = esp.flash_defl_begin(uncsize, len(image), address)
-        else:
-            ratio = 1.0
-            blocks = esp.flash_begin(uncsize, address)
-        argfile.seek(0)  # in case we need it again
-        seq = 0
-        written = 0
-        t = time.time()
-        while len(image) > 0:
-            print('\rWriting at 0x%08x... (%d %%)' % (address + seq * esp.FLASH_WRITE_SIZE, 100 * (seq + 1) // blocks), end='')
-            if args.callback:
-                args.callback(100 * (seq + 1) // blocks)
-            sys.stdout.flush()
-            block = image[0:esp.FLASH_WRITE_SIZE]
-            if args.compress:
-                esp.flash_defl_block(block, seq, timeout=DEFAULT_TIMEOUT * ratio * 2)
-            else:
-                # Pad the last block
-                block = block + b'\xff' * (esp.FLASH_WRITE_SIZE - len(block))
-                esp.flash_block(block, seq)
-            image = image[esp.FLASH_WRITE_SIZE:]
-            seq += 1
-            written += len(block)
-        t = time.time() - t
-        speed_msg = ""
-        if args.compress:
-            if t > 0.0:
-                speed_msg = " (effective %.1f kbit/s)" % (uncsize / t * 8 / 1000)
-            print('\rWrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s...' % (uncsize, written, address, t, speed_msg))
-        else:
-            if t > 0.0:
-                speed_msg = " (%.1f kbit/s)" % (written / t * 8 / 1000)
-            print('\rWrote %d bytes at 0x%08x in %.1f seconds%s...' % (written, address, t, speed_msg))
-        try:
-            res = esp.flash_md5sum(address, uncsize)
-            if res != calcmd5:
-                print('File  md5: %s' % calcmd5)
-                print('Flash md5: %s' % res)
-                print('MD5 of 0xFF is %s' % (hashlib.md5(b'\xFF' * uncsize).hexdigest()))
-                raise FatalError("MD5 of file does not match data in flash!")
-            else:
-                print('Hash of data verified.')
-        except NotImplementedInROMError:
-            pass
+    progress = _progress_reporter(args)
+    progress.start('write', total)
+    retries = getattr(args, 'retries', WRITE_FLASH_RETRIES)
+    # read and compress the next image while the current one is being written
+    preparer = multiprocessing.pool.ThreadPool(1)
+    try:
+        pending = preparer.apply_async(_prepare_flash_part, (esp, args) + tuple(sources[0]))
+        for i in range(len(sources)):
+            parts = pending.get()
+            if i + 1 < len(sources):
+                pending = preparer.apply_async(_prepare_flash_part, (esp, args) + tuple(sources[i + 1]))
+            for part in parts:
+                esp = _write_flash_part(esp, args, part, progress, retries)
+    finally:
+        preparer.terminate()
+    progress.finish()
 
     print('\nLeaving...')
 
@@ -2201,11 +2888,250 @@ def write_flash(esp, args):
     if args.verify:
         print('Verifying just-written flash...')
         print('(This option is deprecated, flash contents are now always read back after flashing.)')
+        if bundle is not None:
+            args.addr_filename = list(args.addr_filename) + bundle.addr_filename()
         verify_flash(esp, args)
+    return esp
+
+
+def prepare_flash_bundle(esp, args):
+    """ Prepare the images of a write_flash call once, as a FlashBundle
+
+    The parts hold the images with their flash parameters updated, padded,
+    hashed and compressed. Pass the bundle as args.bundle (with an empty
+    args.addr_filename) to write it to any number of chips of the same kind,
+    without preparing the images again for each of them.
+    """
+    _set_compress_default(args)
+    sources, _ = _flash_sources(args)
+    parts = []
+    for address, source in sources:
+        parts += _prepare_flash_part(esp, args, address, source)
+    return FlashBundle(parts)
+
+
+def _set_compress_default(args):
+    # set args.compress based on default behaviour:
+    # -> if either --compress or --no-compress is set, honour that
+    # -> otherwise, set --compress unless --no-stub is set
+    if args.compress is None and not args.no_compress:
+        args.compress = not args.no_stub
+
+
+def _flash_sources(args):
+    """ (address, file or FlashPart) pairs to write and the loaded flash bundle, if any """
+    # images come from address/filename pairs or from the parts of a flash bundle
+    sources = list(args.addr_filename)
+    bundle = getattr(args, 'bundle', None)
+    if bundle is not None:
+        if not isinstance(bundle, FlashBundle):
+            bundle = FlashBundle.load(bundle)
+        sources += [(part.offset, part) for part in bundle.parts]
+    return sources, bundle
+
+
+def _prepare_flash_part(esp, args, address, source):
+    """ Get the FlashParts to write at address from a file or a flash bundle part
+
+    Updates the flash parameters in the image header and compresses the image if
+    needed, as several regions with --compress-jobs. Only reads loader constants,
+    so it can run while another part is being written. Returns an empty list for
+    an empty file.
+    """
+    if isinstance(source, FlashPart):
+        image, name = source.image, source.name
+    else:
+        image, name = pad_to(source.read(), 4), source.name
+        source.seek(0)  # in case we need it again
+    if len(image) == 0:
+        print('WARNING: File %s is empty' % name)
+        return []
+    updated = _update_image_flash_params(esp, address, args, image)
+    if isinstance(source, FlashPart) and updated == image:
+        parts = [source]  # keep the bundle's precompressed payload
+    elif args.compress:
+        parts = _compress_regions(esp, address, updated, name, getattr(args, 'compress_jobs', 1))
+    else:
+        parts = [FlashPart(address, updated, name=name)]
+    if args.compress:
+        for part in parts:
+            part.compress()
+    return parts
+
+
+def _compress_regions(esp, address, image, name, jobs):
+    """ Split an image at sector boundaries and compress the regions in parallel
+
+    Each region becomes a FlashPart of its own, written as a separate compressed
+    stream. The regions are compressed on jobs threads (zlib releases the GIL
+    while compressing), 0 means one thread per CPU. Images no larger than
+    COMPRESS_REGION_MIN are kept whole.
+    """
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    region = max(COMPRESS_REGION_MIN, (len(image) + jobs - 1) // jobs)
+    region = (region + esp.FLASH_SECTOR_SIZE - 1) & ~(esp.FLASH_SECTOR_SIZE - 1)
+    if jobs <= 1 or len(image) <= region:
+        return [FlashPart(address, image, name=name)]
+    parts = [FlashPart(address + offset, image[offset:offset + region], name='%s+0x%x' % (name, offset))
+             for offset in range(0, len(image), region)]
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(parts)))
+    try:
+        pool.map(FlashPart.compress, parts)
+    finally:
+        pool.terminate()
+    return parts
+
+
+def _write_flash_part(esp, args, part, progress, retries):
+    """ Write a FlashPart and check its digest, resuming after connection trouble
+
+    Returns the loader to carry on with, see _write_flash_resync.
+    """
+    if args.no_stub:
+        print('Erasing flash...')
+    address = part.offset
+    uncsize = len(part.image)
+    written = 0
+    done = progress.done
+    resume = 0  # length of the start of the image known to be in flash already
+    failures = 0
+    t = time.time()
+    while True:
+        try:
+            written += _write_flash_session(esp, args, part, resume, progress, done)
+            try:
+                res = esp.flash_md5sum(address, uncsize)
+                if res != part.md5:
+                    print('File  md5: %s' % part.md5)
+                    print('Flash md5: %s' % res)
+                    print('MD5 of 0xFF is %s' % (hashlib.md5(b'\xFF' * uncsize).hexdigest()))
+                    raise FatalError("MD5 of file does not match data in flash!")
+            except NotImplementedInROMError:
+                res = None
+            break
+        except NotImplementedInROMError:
+            raise
+        except (FatalError, IOError, OSError) as e:
+            # connection trouble, carry on from what is confirmed to be in flash
+            failures += 1
+            if failures > retries:
+                raise
+            print('\nWriting at 0x%08x failed: %s' % (address + progress.done - done, e))
+            esp = _write_flash_resync(esp, args)
+            resume = _flash_confirmed_length(esp, address, part.image, progress.done - done)
+            print('Resuming at 0x%08x (attempt %d of %d)...' % (address + resume, failures + 1, retries + 1))
+            progress.update(done + resume)
+    t = time.time() - t
+    speed_msg = ""
+    if args.compress:
+        if t > 0.0:
+            speed_msg = " (effective %.1f kbit/s)" % (uncsize / t * 8 / 1000)
+        print('\rWrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s...' % (uncsize, written, address, t, speed_msg))
+    else:
+        if t > 0.0:
+            speed_msg = " (%.1f kbit/s)" % (written / t * 8 / 1000)
+        print('\rWrote %d bytes at 0x%08x in %.1f seconds%s...' % (written, address, t, speed_msg))
+    if res is not None:
+        print('Hash of data verified.')
+    return esp
+
+
+def _write_flash_session(esp, args, part, offset, progress, done):
+    """ Write the part's image from offset on to flash in one flash (or compressed flash) session
+
+    A block the loader rejects is sent again, anything else is left to the caller.
+    Returns the number of bytes sent.
+    """
+    address = part.offset
+    uncsize = len(part.image) - offset
+    if uncsize == 0:
+        return 0  # all of it was confirmed in flash already
+    if args.compress:
+        data = part.compress() if offset == 0 else zlib.compress(part.image[offset:], 9)
+        ratio = uncsize / len(data)
+        blocks = esp.flash_defl_begin(uncsize, len(data), address + offset)
+    else:
+        data = part.image[offset:]
+        ratio = 1.0
+        blocks = esp.flash_begin(uncsize, address + offset)
+    written = 0
+    for seq in range(blocks):
+        block = data[seq * esp.FLASH_WRITE_SIZE:(seq + 1) * esp.FLASH_WRITE_SIZE]
+        if not args.compress:
+            # Pad the last block
+            block = block + b'\xff' * (esp.FLASH_WRITE_SIZE - len(block))
+        for attempt in range(WRITE_FLASH_BLOCK_RETRIES + 1):
+            try:
+                if args.compress:
+                    esp.flash_defl_block(block, seq, timeout=DEFAULT_TIMEOUT * ratio * 2)
+                else:
+                    esp.flash_block(block, seq)
+                break
+            except FatalError as e:
+                # a rejected block (bad checksum...) wasn't used, so it can simply be sent again,
+                # a lost response leaves the loader's state unknown
+                if getattr(e, 'result', None) is None or attempt == WRITE_FLASH_BLOCK_RETRIES:
+                    raise
+                esp.trace("Block %d rejected (%s), sending it again", seq, e)
+                esp.flush_input()
+        written += len(block)
+        progress.update(done + offset + uncsize * (seq + 1) // blocks)
+    return written
+
+
+def _write_flash_resync(esp, args):
+    """ Get the loader responding again after a failed write, returns the loader to carry on with
+
+    If the loader doesn't respond, args.reconnect(esp) (if set) has to return a new
+    loader, set up the same way as the old one.
+    """
+    for _ in range(2):
+        try:
+            esp.flush_input()
+            # the first frame may only end a block the loader was part-way through receiving
+            esp.read_reg(esp.UART_DATA_REG_ADDR)
+            return esp
+        except (FatalError, IOError, OSError):
+            pass
+    reconnect = getattr(args, 'reconnect', None)
+    if reconnect is None:
+        raise FatalError("Lost connection to %s" % esp.CHIP_NAME)
+    return reconnect(esp)
+
+
+def _flash_confirmed_length(esp, address, image, estimate):
+    """ Length of the longest whole-sector start of image which is in flash at address
+
+    estimate is how much was acknowledged before a write failed. That much is checked
+    with a single digest, bisecting if it doesn't match, then the following sectors
+    are checked one by one as the loader may have got further.
+    """
+    sector = esp.FLASH_SECTOR_SIZE
+
+    def in_flash(offs, length):
+        return esp.flash_md5sum(address + offs, length) == hashlib.md5(image[offs:offs + length]).hexdigest()
+
+    try:
+        confirmed = min(estimate, len(image)) // sector * sector
+        if confirmed > 0 and not in_flash(0, confirmed):
+            good, bad = 0, confirmed
+            while bad - good > sector:
+                mid = (good + bad) // 2 // sector * sector
+                if in_flash(0, mid):
+                    good = mid
+                else:
+                    bad = mid
+            return good
+        while confirmed < len(image) and in_flash(confirmed, min(sector, len(image) - confirmed)):
+            confirmed += sector
+        return min(confirmed, len(image))
+    except NotImplementedInROMError:
+        return 0  # can't tell, start over
 
 
 def image_info(args):
-    image = LoadFirmwareImage(args.chip, args.filename)
+    image = LoadFirmwareImage(args.chip, args.filename, use_mmap=True)
     print('Image version: %d' % image.version)
     print('Entry point: %08x' % image.entrypoint if image.entrypoint != 0 else 'Entry point not set')
     print('%d segments' % len(image.segments))
@@ -2242,8 +3168,27 @@ def make_image(args):
     image.save(args.output)
 
 
+def make_bundle(args):
+    bundle = FlashBundle()
+    for address, argfile in args.addr_filename:
+        part = bundle.add(address, argfile.read(), os.path.basename(argfile.name))
+        print('Added %s at 0x%08x, %d bytes (%d compressed)' % (part.name, address, len(part.image), len(part.compressed)))
+    bundle.save(args.output)
+    print('Saved flash bundle %s with %d part(s)' % (args.output, len(bundle.parts)))
+
+
 def elf2image(args):
-    e = ELFFile(args.input)
+    inputs = args.input if isinstance(args.input, list) else [args.input]
+    if len(inputs) == 1 and getattr(args, 'manifest', None) is None:
+        args.input = inputs[0]
+        _elf2image_one(args)
+    else:
+        _elf2image_batch(args, inputs)
+
+
+def _elf2image_one(args):
+    """ Convert the single ELF file args.input, returns the output filename """
+    e = ELFFile(args.input, use_cache=getattr(args, 'elf_cache', False))
     if args.chip == 'auto':  # Default to ESP8266 for backwards compatibility
         print("Creating image for ESP8266...")
         args.chip = 'esp8266'
@@ -2270,6 +3215,111 @@ def elf2image(args):
     if args.output is None:
         args.output = image.default_output_name(args.input)
     image.save(args.output)
+    return args.output
+
+
+def _elf2image_worker(args):
+    """ Process pool entry point for batch elf2image, returns (input, output, error message) """
+    try:
+        return args.input, _elf2image_one(args), None
+    except FatalError as e:
+        return args.input, None, str(e)
+    except (IOError, OSError) as e:
+        # an unreadable input or unwritable output only fails this file
+        return args.input, None, str(e)
+
+
+def _elf2image_batch(args, inputs):
+    """ Convert several ELF files on a process pool.
+
+    If args.manifest is set, it names a JSON file recording the SHA-256 of each input and
+    the conversion parameters used. Inputs whose digest and parameters match the manifest,
+    and whose output still exists, are skipped.
+
+    Each image is written next to its input, named after it without the extension. Inputs
+    given more than once are converted once, different inputs which would overwrite each
+    other's images (like app.elf and app.out) are rejected before anything is converted.
+    """
+    if args.output is not None:
+        raise FatalError("--output can't be used when converting several ELF files, images are written next to each input")
+    unique_inputs = []
+    stems = {}
+    for input_file in inputs:
+        path = os.path.abspath(input_file)
+        stem = os.path.splitext(path)[0]
+        if stems.get(stem, path) != path:
+            raise FatalError("%s and %s would both be converted to %s images" % (stems[stem], input_file, stem))
+        if stem not in stems:
+            stems[stem] = path
+            unique_inputs.append(input_file)
+    inputs = unique_inputs
+    if args.chip == 'auto':  # Default to ESP8266 for backwards compatibility
+        print("Creating images for ESP8266...")
+        args.chip = 'esp8266'
+
+    params = dict((name, getattr(args, name)) for name in
+                  ['chip', 'version', 'flash_mode', 'flash_size', 'flash_freq', 'secure_pad', 'elf_sha256_offset'])
+    params['esptool'] = __version__
+
+    manifest = {}
+    if args.manifest is not None and os.path.exists(args.manifest):
+        try:
+            with open(args.manifest, 'r') as f:
+                manifest = json.load(f)
+        except ValueError:
+            print("WARNING: Ignoring invalid manifest %s" % args.manifest)
+
+    def outputs_exist(output):
+        # version 1 ESP8266 images use the output name as a prefix for several files
+        return os.path.exists(output) or os.path.exists(output + '0x00000.bin')
+
+    jobs = []
+    digests = {}
+    failures = []
+    up_to_date = 0
+    for input_file in inputs:
+        try:
+            with open(input_file, 'rb') as f:
+                digests[input_file] = hexify(sha256_file_range(f, 0, os.fstat(f.fileno()).st_size), False)
+        except (IOError, OSError) as e:
+            failures.append("%s: %s" % (input_file, e))
+            continue
+        entry = manifest.get(os.path.abspath(input_file))
+        if entry is not None and entry['sha256'] == digests[input_file] and entry['params'] == params \
+                and outputs_exist(entry['output']):
+            print("%s is up to date (%s)" % (input_file, entry['output']))
+            up_to_date += 1
+            continue
+        job = copy.copy(args)
+        job.input = input_file
+        job.output = None
+        jobs.append(job)
+
+    processes = min(args.jobs or multiprocessing.cpu_count(), len(jobs))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_elf2image_worker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_elf2image_worker(job) for job in jobs]
+
+    for input_file, output, error in results:
+        if error is not None:
+            failures.append("%s: %s" % (input_file, error))
+            continue
+        print("Converted %s to %s" % (input_file, output))
+        manifest[os.path.abspath(input_file)] = {'sha256': digests[input_file], 'params': params,
+                                                 'output': os.path.abspath(output)}
+
+    if args.manifest is not None:
+        with open(args.manifest, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    print("%d image(s) converted, %d up to date" % (len(inputs) - len(failures) - up_to_date, up_to_date))
+    if len(failures) > 0:
+        raise FatalError("Failed to convert %d ELF file(s):\n%s" % (len(failures), "\n".join(failures)))
 
 
 def read_mac(esp, args):
@@ -2315,19 +3365,21 @@ def flash_id(esp, args):
     print('Detected flash size: %s' % (DETECTED_FLASH_SIZES.get(flid_lowbyte, "Unknown")))
 
 
+def _read_flash_kwargs(args):
+    """ Return the ESPLoader.read_flash() tuning keyword arguments set in args """
+    return {
+        'block_size': getattr(args, 'read_block_size', None),
+        'max_in_flight': getattr(args, 'read_max_in_flight', None),
+        'adaptive': getattr(args, 'read_adaptive', False),
+    }
+
+
 def read_flash(esp, args):
-    if args.no_progress:
-        flash_progress = None
-    else:
-        def flash_progress(progress, length):
-            msg = '%d (%d %%)' % (progress, progress * 100.0 / length)
-            padding = '\b' * len(msg)
-            if progress == length:
-                padding = '\n'
-            sys.stdout.write(msg + padding)
-            sys.stdout.flush()
+    progress = _progress_reporter(args)
+    progress.start('read', args.size)
     t = time.time()
-    data = esp.read_flash(args.address, args.size, flash_progress)
+    data = esp.read_flash(args.address, args.size, lambda done, length: progress.update(done),
+                          **_read_flash_kwargs(args))
     t = time.time() - t
     print('\rRead %d bytes at 0x%x in %.1f seconds (%.1f kbit/s)...'
           % (len(data), args.address, t, len(data) / t * 8 / 1000))
@@ -2335,6 +3387,80 @@ def read_flash(esp, args):
         f.write(data)
 
 
+def diff_ranges(a, b, chunk_size=0x1000):
+    """ Return a list of (start, end) ranges where the equal length byte strings a and b differ.
+
+    Data is compared a chunk at a time and only differing chunks are compared byte by
+    byte (vectorised, if NumPy is installed.) Runs of differing bytes are merged into
+    a single range, including across chunk boundaries.
+    """
+    a = memoryview(a)
+    b = memoryview(b)
+    ranges = []
+
+    def add_range(start, end):
+        if len(ranges) > 0 and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    for offs in range(0, len(a), chunk_size):
+        chunk_a = a[offs:offs + chunk_size]
+        chunk_b = b[offs:offs + chunk_size]
+        if chunk_a == chunk_b:
+            continue
+        if numpy is not None:
+            changed = numpy.flatnonzero(numpy.frombuffer(chunk_a, numpy.uint8) != numpy.frombuffer(chunk_b, numpy.uint8))
+            run_starts = numpy.flatnonzero(numpy.diff(changed) != 1) + 1
+            for run in numpy.split(changed, run_starts):
+                add_range(offs + int(run[0]), offs + int(run[-1]) + 1)
+        else:
+            run_start = None
+            for i, (byte_a, byte_b) in enumerate(zip(chunk_a.tobytes(), chunk_b.tobytes())):
+                if byte_a != byte_b:
+                    if run_start is None:
+                        run_start = i
+                elif run_start is not None:
+                    add_range(offs + run_start, offs + i)
+                    run_start = None
+            if run_start is not None:
+                add_range(offs + run_start, offs + len(chunk_a))
+    return ranges
+
+
+def _find_differing_regions(esp, address, image, min_size=ESPLoader.FLASH_SECTOR_SIZE):
+    """ Bisect an image whose flash digest doesn't match, using flash_md5sum on halves of each
+    mismatching range until ranges are min_size or smaller.
+
+    The whole image is assumed to mismatch already. Returns a sorted list of
+    (offset in image, length) pairs, with adjacent ranges merged.
+    """
+    image = memoryview(image)
+    regions = []
+    mismatched = [(0, len(image))]
+    while len(mismatched) > 0:
+        start, length = mismatched.pop()
+        if length <= min_size:
+            regions.append((start, length))
+            continue
+        # split on a sector boundary (in flash) near the middle, if there is one
+        middle = ((address + start + length // 2) // min_size) * min_size - address
+        if not start < middle < start + length:
+            middle = start + length // 2
+        for part_start, part_end in [(start, middle), (middle, start + length)]:
+            part = image[part_start:part_end]
+            if esp.flash_md5sum(address + part_start, len(part)) != hashlib.md5(part).hexdigest():
+                mismatched.append((part_start, len(part)))
+
+    merged = []
+    for start, length in sorted(regions):
+        if len(merged) > 0 and sum(merged[-1]) == start:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        else:
+            merged.append((start, length))
+    return merged
+
+
 def verify_flash(esp, args):
     differences = False
 
@@ -2354,25 +3480,139 @@ def verify_flash(esp, args):
             continue
         else:
             differences = True
-            if getattr(args, 'diff', 'no') != 'yes':
+            if getattr(args, 'diff', 'no') not in ('yes', 'bisect'):
                 print('-- verify FAILED (digest mismatch)')
                 continue
 
-        flash = esp.read_flash(address, image_size)
-        assert flash != image
-        diff = [i for i in range(image_size) if flash[i] != image[i]]
-        print('-- verify FAILED: %d differences, first @ 0x%08x' % (len(diff), address + diff[0]))
-        for d in diff:
-            flash_byte = flash[d]
-            image_byte = image[d]
-            if PYTHON2:
-                flash_byte = ord(flash_byte)
-                image_byte = ord(image_byte)
-            print('   %08x %02x %02x' % (address + d, flash_byte, image_byte))
+        if args.diff == 'bisect':
+            # narrow the mismatch down with more digests, only read back what differs
+            regions = _find_differing_regions(esp, address, image)
+            print('-- digest mismatch isolated to %d region(s), reading back 0x%x bytes' %
+                  (len(regions), sum(length for _, length in regions)))
+        else:
+            regions = [(0, image_size)]
+
+        diff = []
+        for start, length in regions:
+            flash = esp.read_flash(address + start, length, **_read_flash_kwargs(args))
+            diff += [(start + diff_start, flash[diff_start:diff_end], image[start + diff_start:start + diff_end])
+                     for diff_start, diff_end in diff_ranges(flash, image[start:start + length])]
+        if len(diff) == 0:
+            print('-- verify FAILED (digest mismatch, but flash read back matches)')
+            continue
+        print('-- verify FAILED: %d differing bytes in %d range(s), first @ 0x%08x' %
+              (sum(len(flash_bytes) for _, flash_bytes, _ in diff), len(diff), address + diff[0][0]))
+        limit = getattr(args, 'diff_limit', 0) or len(diff)
+        for d, flash_bytes, image_bytes in diff[:limit]:
+            more = '...' if len(flash_bytes) > 8 else ''
+            print('   %08x-%08x %6d bytes, flash %s%s image %s%s' %
+                  (address + d, address + d + len(flash_bytes) - 1, len(flash_bytes),
+                   hexify(flash_bytes[:8], False), more, hexify(image_bytes[:8], False), more))
+        if len(diff) > limit:
+            print('   ... %d more range(s) not shown, use --diff-limit 0 to show all' % (len(diff) - limit))
     if differences:
         raise FatalError("Verify failed.")
 
 
+def _progress_reporter(args):
+    """ ProgressReporter for an operation, passing events to args.progress or printing them unless --no-progress """
+    if getattr(args, 'progress', None):
+        return ProgressReporter(args.progress, getattr(args, 'progress_interval', 0.2))
+    return ProgressReporter(None if getattr(args, 'no_progress', False) else print_progress)
+
+
+def _backup_device_name(esp):
+    """ Name backups of a device by its MAC address """
+    return ''.join('%02x' % b for b in esp.read_mac())
+
+
+def backup_flash(esp, args):
+    address = args.address
+    size = args.size if args.size is not None else flash_size_bytes(args.flash_size) - address
+    if address % esp.FLASH_SECTOR_SIZE != 0 or size % esp.FLASH_SECTOR_SIZE != 0:
+        raise FatalError("Backup address and size must be multiples of 0x%x" % esp.FLASH_SECTOR_SIZE)
+    store = FlashChunkStore(args.store)
+    chunk_size = store.CHUNK_SIZE
+    device = _backup_device_name(esp)
+    print('Backing up 0x%x bytes @ 0x%08x of %s to %s...' % (size, address, device, args.store))
+
+    # digest every chunk in flash, and only read back the ones the store doesn't have
+    t = time.time()
+    digests = []
+    missing = []  # runs of (address, length) to read
+    queued = set()
+    for offs in range(address, address + size, chunk_size):
+        length = min(chunk_size, address + size - offs)
+        digest = esp.flash_md5sum(offs, length)
+        digests.append(digest)
+        if digest in queued or store.has_chunk(digest):
+            continue
+        queued.add(digest)
+        if len(missing) > 0 and sum(missing[-1]) == offs:
+            missing[-1] = (missing[-1][0], missing[-1][1] + length)
+        else:
+            missing.append((offs, length))
+
+    progress = _progress_reporter(args)
+    progress.start('backup', sum(length for _, length in missing))
+    for offs, length in missing:
+        done = progress.done
+        data = esp.read_flash(offs, length, lambda n, _: progress.update(done + n), **_read_flash_kwargs(args))
+        for chunk_offs in range(0, length, chunk_size):
+            expected = digests[(offs + chunk_offs - address) // chunk_size]
+            if store.add_chunk(data[chunk_offs:chunk_offs + chunk_size]) != expected:
+                raise FatalError("Flash contents @ 0x%08x changed during backup" % (offs + chunk_offs))
+    progress.finish()
+
+    path = store.add_backup(device, {
+        'device': device,
+        'chip': esp.CHIP_NAME,
+        'address': address,
+        'size': size,
+        'chunk_size': chunk_size,
+        'chunks': digests,
+    })
+    print('Backup %s complete in %.1f seconds, read 0x%x bytes not already stored' %
+          (path, time.time() - t, sum(length for _, length in missing)))
+    return path
+
+
+def rollback_flash(esp, args):
+    store = FlashChunkStore(args.store)
+    backup = store.load_backup(_backup_device_name(esp), args.backup)
+    address = backup['address']
+    chunk_size = backup['chunk_size']
+    end = address + backup['size']
+
+    # only rewrite the chunks whose digest differs from the backup
+    differing = []
+    for offs in range(address, end, chunk_size):
+        length = min(chunk_size, end - offs)
+        if esp.flash_md5sum(offs, length) == backup['chunks'][(offs - address) // chunk_size]:
+            continue
+        if len(differing) > 0 and sum(differing[-1]) == offs:
+            differing[-1] = (differing[-1][0], differing[-1][1] + length)
+        else:
+            differing.append((offs, length))
+    if len(differing) == 0:
+        print('Flash already matches backup %s' % backup['name'])
+        return
+    print('Restoring 0x%x bytes in %d region(s) from backup %s...' %
+          (sum(length for _, length in differing), len(differing), backup['name']))
+
+    addr_filename = []
+    for offs, length in differing:
+        argfile = io.BytesIO(b''.join(store.read_chunk(backup['chunks'][(chunk_offs - address) // chunk_size])
+                                      for chunk_offs in range(offs, offs + length, chunk_size)))
+        argfile.name = 'backup %s @ 0x%08x' % (backup['name'], offs)
+        addr_filename.append((offs, argfile))
+    write_flash(esp, argparse.Namespace(addr_filename=addr_filename, flash_size=args.flash_size,
+                                        flash_mode='keep', flash_freq='keep', compress=None, no_compress=False,
+                                        no_stub=not esp.IS_STUB, erase_all=False, verify=False,
+                                        progress=getattr(args, 'progress', None),
+                                        no_progress=getattr(args, 'no_progress', False)))
+
+
 def read_flash_status(esp, args):
     print('Status value: 0x%04x' % esp.read_status(args.bytes))
 
@@ -2401,7 +3641,9 @@ def main(custom_commandline=None):
     custom_commandline - Optional override for default arguments parsing (that uses sys.argv), can be a list of custom arguments
     as strings.
     """
-    parser = argparse.ArgumentParser(description='esptool.py v%s - ESP8266 ROM Bootloader Utility' % __version__, prog='esptool')
+    parser = argparse.ArgumentParser(description='esptool.py v%s - ESP8266 ROM Bootloader Utility' % __version__, prog='esptool',
+                                     epilog='Several operations can be run on one connection to the chip, separated by --then, ' +
+                                     'e.g. erase_region 0x9000 0x4000 --then write_flash 0x1000 app.bin --then verify_flash 0x1000 app.bin')
 
     parser.add_argument('--chip', '-c',
                         help='Target chip type',
@@ -2431,6 +3673,12 @@ def main(custom_commandline=None):
         choices=['hard_reset', 'soft_reset', 'no_reset'],
         default=os.environ.get('ESPTOOL_AFTER', 'hard_reset'))
 
+    parser.add_argument(
+        '--low-latency',
+        help='Tune the serial port for a lower command round trip time where the driver allows it, ' +
+        'reporting the round trip before and after',
+        action='store_true')
+
     parser.add_argument(
         '--no-stub',
         help="Disable launching the flasher stub, only talk to ROM bootloader. Some features will not be available.",
@@ -2456,6 +3704,14 @@ def main(custom_commandline=None):
                             'Value can be SPI, HSPI or a comma-separated list of 5 I/O numbers to use for SPI flash (CLK,Q,D,HD,CS).',
                             action=SpiConnectionAction)
 
+    def add_read_flash_args(parent):
+        parent.add_argument('--read-block-size', help='Size of each block the flasher stub sends when reading flash ' +
+                            '(max 0x%x)' % ESPLoader.FLASH_SECTOR_SIZE, type=arg_auto_int, default=None)
+        parent.add_argument('--read-max-in-flight', help='Number of read blocks the flasher stub may send before ' +
+                            'waiting for an acknowledgement', type=arg_auto_int, default=None)
+        parent.add_argument('--read-adaptive', help='Grow the read window while reads succeed, ' +
+                            'shrink and retry it after timeouts or corrupt data', action='store_true')
+
     parser_load_ram = subparsers.add_parser(
         'load_ram',
         help='Download an image to RAM and execute')
@@ -2499,7 +3755,8 @@ def main(custom_commandline=None):
 
     parser_write_flash = subparsers.add_parser('write_flash', help='Write a binary blob to flash')
     parser_write_flash.add_argument('addr_filename', metavar='<address> <filename>', help='Address followed by binary filename, separated by space',
-                                    action=AddrFilenamePairAction)
+                                    action=AddrFilenamePairAction, nargs='*')
+    parser_write_flash.add_argument('--bundle', '-b', help='Also write every part of this flash bundle (see make_bundle)')
     parser_write_flash.add_argument('--erase-all', '-e',
                                     help='Erase all regions of flash (not just write areas) before programming',
                                     action="store_true")
@@ -2508,6 +3765,12 @@ def main(custom_commandline=None):
     parser_write_flash.add_argument('--no-progress', '-p', help='Suppress progress output', action="store_true")
     parser_write_flash.add_argument('--verify', help='Verify just-written data on flash ' +
                                     '(mostly superfluous, data is read back during flashing)', action='store_true')
+    parser_write_flash.add_argument('--retries', help='Times to resume writing a file from the last sector confirmed ' +
+                                    'to be in flash after losing the connection (default: %(default)s)',
+                                    type=int, default=WRITE_FLASH_RETRIES)
+    parser_write_flash.add_argument('--compress-jobs', help='Split large files at sector boundaries and compress ' +
+                                    'the regions on this many threads, 0 for one per CPU (default: %(default)s)',
+                                    type=int, default=1)
 
     compress_args = parser_write_flash.add_mutually_exclusive_group(required=False)
     compress_args.add_argument('--compress', '-z', help='Compress data in transfer (default unless --no-stub is specified)',action="store_true", default=None)
@@ -2530,15 +3793,29 @@ def main(custom_commandline=None):
     parser_make_image.add_argument('--segaddr', '-a', action='append', help='Segment base address', type=arg_auto_int)
     parser_make_image.add_argument('--entrypoint', '-e', help='Address of entry point', type=arg_auto_int, default=0)
 
+    parser_make_bundle = subparsers.add_parser(
+        'make_bundle',
+        help='Create a flash bundle, to write several binary files with a single write_flash')
+    parser_make_bundle.add_argument('output', help='Output bundle file')
+    parser_make_bundle.add_argument('addr_filename', metavar='<address> <filename>', help='Address followed by binary filename, separated by space',
+                                    action=AddrFilenamePairAction)
+
     parser_elf2image = subparsers.add_parser(
         'elf2image',
         help='Create an application image from ELF file')
-    parser_elf2image.add_argument('input', help='Input ELF file')
+    parser_elf2image.add_argument('input', help='Input ELF file(s). Several files are converted in parallel, ' +
+                                  'each image is written next to its input', nargs='+')
     parser_elf2image.add_argument('--output', '-o', help='Output filename prefix (for version 1 image), or filename (for version 2 single image)', type=str)
     parser_elf2image.add_argument('--version', '-e', help='Output image version', choices=['1','2'], default='1')
     parser_elf2image.add_argument('--secure-pad', action='store_true', help='Pad image so once signed it will end on a 64KB boundary. For ESP32 images only.')
     parser_elf2image.add_argument('--elf-sha256-offset', help='If set, insert SHA256 hash (32 bytes) of the input ELF file at specified offset in the binary.',
                                   type=arg_auto_int, default=None)
+    parser_elf2image.add_argument('--elf-cache', help='Cache the parsed ELF section table (in $ESPTOOL_CACHE_DIR, default ' +
+                                  '~/.cache/esptool) to skip parsing unchanged ELF files again', action='store_true')
+    parser_elf2image.add_argument('--jobs', '-j', help='Number of processes used to convert several ELF files ' +
+                                  '(default: number of CPUs)', type=int, default=None)
+    parser_elf2image.add_argument('--manifest', help='JSON file recording inputs and conversion parameters. ' +
+                                  'Inputs which are unchanged since the last conversion are skipped', default=None)
 
     add_spi_flash_subparsers(parser_elf2image, is_elf2image=True)
 
@@ -2579,15 +3856,20 @@ def main(custom_commandline=None):
     parser_read_flash.add_argument('size', help='Size of region to dump', type=arg_auto_int)
     parser_read_flash.add_argument('filename', help='Name of binary dump')
     parser_read_flash.add_argument('--no-progress', '-p', help='Suppress progress output', action="store_true")
+    add_read_flash_args(parser_read_flash)
 
     parser_verify_flash = subparsers.add_parser(
         'verify_flash',
         help='Verify a binary blob against flash')
     parser_verify_flash.add_argument('addr_filename', help='Address and binary file to verify there, separated by space',
                                      action=AddrFilenamePairAction)
-    parser_verify_flash.add_argument('--diff', '-d', help='Show differences',
-                                     choices=['no', 'yes'], default='no')
+    parser_verify_flash.add_argument('--diff', '-d', help='Show differences. "bisect" narrows a digest mismatch down with ' +
+                                     'further digests and only reads back the differing sectors',
+                                     choices=['no', 'yes', 'bisect'], default='no')
+    parser_verify_flash.add_argument('--diff-limit', help='Maximum number of differing ranges to show (0 for no limit)',
+                                     type=int, default=32)
     add_spi_flash_subparsers(parser_verify_flash, is_elf2image=False)
+    add_read_flash_args(parser_verify_flash)
 
     parser_erase_flash = subparsers.add_parser(
         'erase_flash',
@@ -2601,6 +3883,24 @@ def main(custom_commandline=None):
     parser_erase_region.add_argument('address', help='Start address (must be multiple of 4096)', type=arg_auto_int)
     parser_erase_region.add_argument('size', help='Size of region to erase (must be multiple of 4096)', type=arg_auto_int)
 
+    parser_backup_flash = subparsers.add_parser(
+        'backup_flash',
+        help='Back up SPI flash content into a deduplicated chunk store')
+    parser_backup_flash.add_argument('store', help='Chunk store directory')
+    parser_backup_flash.add_argument('--address', help='Start address (default 0)', type=arg_auto_int, default=0)
+    parser_backup_flash.add_argument('--size', help='Size of region to back up (default: rest of the flash)',
+                                     type=arg_auto_int, default=None)
+    add_spi_flash_subparsers(parser_backup_flash, is_elf2image=False)
+    add_read_flash_args(parser_backup_flash)
+
+    parser_rollback_flash = subparsers.add_parser(
+        'rollback_flash',
+        help='Restore SPI flash content from a backup, rewriting only the chunks that differ')
+    parser_rollback_flash.add_argument('store', help='Chunk store directory')
+    parser_rollback_flash.add_argument('--backup', help='Backup name or manifest file (default: latest backup of this device)',
+                                       default=None)
+    add_spi_flash_subparsers(parser_rollback_flash, is_elf2image=False)
+
     subparsers.add_parser(
         'version', help='Print esptool version')
 
@@ -2610,121 +3910,177 @@ def main(custom_commandline=None):
 
     expand_file_arguments()
 
-    args = parser.parse_args(custom_commandline)
+    # several operations can share one connection to the chip, separated by --then
+    commandline = sys.argv[1:] if custom_commandline is None else custom_commandline
+    chain = split_operations(commandline)
+    args = parser.parse_args(chain[0])
+    batch = [args]
+    global_args = vars(parser.parse_args([]))
+    del global_args['operation']
+    for operation_commandline in chain[1:]:
+        # the global options of the first operation apply to all of them
+        op_args = parser.parse_args(operation_commandline, argparse.Namespace(
+            **dict((name, getattr(args, name)) for name in global_args)))
+        for name in global_args:
+            if getattr(op_args, name) != getattr(args, name):
+                parser.error('--%s can only be given before the first operation' % name.replace('_', '-'))
+        batch.append(op_args)
 
     print('esptool.py v%s' % __version__)
 
     # operation function can take 1 arg (args), 2 args (esp, arg)
     # or be a member function of the ESPLoader class.
 
-    if args.operation is None:
+    if any(op_args.operation is None for op_args in batch):
         parser.print_help()
         sys.exit(1)
+    if any(op_args.operation == 'load_ram' for op_args in batch[:-1]):
+        parser.error('load_ram runs the loaded image, it has to be the last operation')
 
-    operation_func = globals()[args.operation]
+    esp = None
+    try:
+        for op_args in batch:
+            operation_func = globals()[op_args.operation]
 
-    if PYTHON2:
-        # This function is depreciated in Python3
-        operation_args = inspect.getargspec(operation_func).args
-    else:
-        operation_args = inspect.getfullargspec(operation_func).args
+            if PYTHON2:
+                # This function is depreciated in Python3
+                operation_args = inspect.getargspec(operation_func).args
+            else:
+                operation_args = inspect.getfullargspec(operation_func).args
 
-    if operation_args[0] == 'esp':  # operation function takes an ESPLoader connection object
-        if args.before != "no_reset_no_sync":
-            initial_baud = min(ESPLoader.ESP_ROM_BAUD, args.baud)  # don't sync faster than the default baud rate
+            if operation_args[0] == 'esp':  # operation function takes an ESPLoader connection object
+                if esp is None:
+                    esp = _connect(args)
+                esp = _run_operation(esp, op_args, operation_func)
+            else:
+                operation_func(op_args)
+
+        if esp is not None:
+            # Handle post-operation behaviour (reset or other)
+            if operation_func == load_ram:
+                # the ESP is now running the loaded image, so let it run
+                print('Exiting immediately.')
+            elif args.after == 'hard_reset':
+                print('Hard resetting via RTS pin...')
+                esp.hard_reset()
+            elif args.after == 'soft_reset':
+                print('Soft resetting...')
+                # flash_finish will trigger a soft reset
+                esp.soft_reset(False)
+            else:
+                print('Staying in bootloader.')
+                if esp.IS_STUB:
+                    esp.soft_reset(True)  # exit stub back to ROM loader
+    finally:
+        if esp is not None:
+            esp._port.close()
+
+
+def split_operations(commandline):
+    """ Split a command line into the command lines of the operations separated by --then """
+    chain = [[]]
+    for arg in commandline:
+        if arg == '--then':
+            chain.append([])
         else:
-            initial_baud = args.baud
+            chain[-1].append(arg)
+    return chain
 
-        if args.port is None:
-            ser_list = sorted(ports.device for ports in list_ports.comports())
-            print("Found %d serial ports" % len(ser_list))
-        else:
-            ser_list = [args.port]
-        esp = None
-        for each_port in reversed(ser_list):
-            print("Serial port %s" % each_port)
-            try:
-                if args.chip == 'auto':
-                    esp = ESPLoader.detect_chip(each_port, initial_baud, args.before, args.trace)
-                else:
-                    chip_class = {
-                        'esp8266': ESP8266ROM,
-                        'esp32': ESP32ROM,
-                    }[args.chip]
-                    esp = chip_class(each_port, initial_baud, args.trace)
-                    esp.connect(args.before)
-                break
-            except (FatalError, OSError) as err:
-                if args.port is not None:
-                    raise
-                print("%s failed to connect: %s" % (each_port, err))
-                esp = None
-        if esp is None:
-            raise FatalError("All of the %d available serial ports could not connect to a Espressif device." % len(ser_list))
 
-        print("Chip is %s" % (esp.get_chip_description()))
+def _connect(args):
+    """ Find and connect to the chip, start the stub and change the baud rate as the global options say """
+    if args.before != "no_reset_no_sync":
+        initial_baud = min(ESPLoader.ESP_ROM_BAUD, args.baud)  # don't sync faster than the default baud rate
+    else:
+        initial_baud = args.baud
 
-        print("Features: %s" % ", ".join(esp.get_chip_features()))
+    if args.port is None:
+        ser_list = sorted(ports.device for ports in list_ports.comports())
+        print("Found %d serial ports" % len(ser_list))
+    else:
+        ser_list = [args.port]
+    esp = None
+    for each_port in reversed(ser_list):
+        print("Serial port %s" % each_port)
+        try:
+            if not args.no_stub and args.before != "no_reset_no_sync":
+                # carry on with a stub left running by an earlier run, it may be at the higher baud rate
+                esp = ESPLoader.detect_stub(each_port, sorted(set([initial_baud, args.baud])), args.trace)
+                if esp is not None and args.chip not in ('auto', esp.CHIP_NAME.lower()):
+                    esp._port.close()
+                    esp = None
+                if esp is not None:
+                    break
+            if args.chip == 'auto':
+                esp = ESPLoader.detect_chip(each_port, initial_baud, args.before, args.trace)
+            else:
+                chip_class = {
+                    'esp8266': ESP8266ROM,
+                    'esp32': ESP32ROM,
+                }[args.chip]
+                esp = chip_class(each_port, initial_baud, args.trace)
+                esp.connect(args.before)
+            break
+        except (FatalError, OSError) as err:
+            if args.port is not None:
+                raise
+            print("%s failed to connect: %s" % (each_port, err))
+            esp = None
+    if esp is None:
+        raise FatalError("All of the %d available serial ports could not connect to a Espressif device." % len(ser_list))
 
-        read_mac(esp, args)
+    print("Chip is %s" % (esp.get_chip_description()))
 
-        if not args.no_stub:
-            esp = esp.run_stub()
+    print("Features: %s" % ", ".join(esp.get_chip_features()))
 
-        if args.override_vddsdio:
-            esp.override_vddsdio(args.override_vddsdio)
+    read_mac(esp, args)
 
-        if args.baud > initial_baud:
-            try:
-                esp.change_baud(args.baud)
-            except NotImplementedInROMError:
-                print("WARNING: ROM doesn't support changing baud rate. Keeping initial baud rate %d" % initial_baud)
-
-        # override common SPI flash parameter stuff if configured to do so
-        if hasattr(args, "spi_connection") and args.spi_connection is not None:
-            if esp.CHIP_NAME != "ESP32":
-                raise FatalError("Chip %s does not support --spi-connection option." % esp.CHIP_NAME)
-            print("Configuring SPI flash mode...")
-            esp.flash_spi_attach(args.spi_connection)
-        elif args.no_stub:
-            print("Enabling default SPI flash mode...")
-            # ROM loader doesn't enable flash unless we explicitly do it
-            esp.flash_spi_attach(0)
-
-        if hasattr(args, "flash_size"):
-            print("Configuring flash size...")
-            detect_flash_size(esp, args)
-            esp.flash_set_parameters(flash_size_bytes(args.flash_size))
+    if not args.no_stub and not esp.IS_STUB:
+        # upload the stub at the higher baud rate already, where the ROM supports it
+        esp = esp.run_stub(baud=args.baud if args.baud > initial_baud else None)
 
-        try:
-            operation_func(esp, args)
-        finally:
-            try:  # Clean up AddrFilenamePairAction files
-                for address, argfile in args.addr_filename:
-                    argfile.close()
-            except AttributeError:
-                pass
-
-        # Handle post-operation behaviour (reset or other)
-        if operation_func == load_ram:
-            # the ESP is now running the loaded image, so let it run
-            print('Exiting immediately.')
-        elif args.after == 'hard_reset':
-            print('Hard resetting via RTS pin...')
-            esp.hard_reset()
-        elif args.after == 'soft_reset':
-            print('Soft resetting...')
-            # flash_finish will trigger a soft reset
-            esp.soft_reset(False)
-        else:
-            print('Staying in bootloader.')
-            if esp.IS_STUB:
-                esp.soft_reset(True)  # exit stub back to ROM loader
+    if args.override_vddsdio:
+        esp.override_vddsdio(args.override_vddsdio)
 
-        esp._port.close()
+    if args.baud > esp._port.baudrate:
+        try:
+            esp.change_baud(args.baud)
+        except NotImplementedInROMError:
+            print("WARNING: ROM doesn't support changing baud rate. Keeping initial baud rate %d" % initial_baud)
+
+    if args.low_latency:
+        tune_latency(esp)
+    return esp
+
+
+def _run_operation(esp, args, operation_func):
+    """ Run one operation on the connected chip, returns the loader to carry on with """
+    # override common SPI flash parameter stuff if configured to do so
+    if hasattr(args, "spi_connection") and args.spi_connection is not None:
+        if esp.CHIP_NAME != "ESP32":
+            raise FatalError("Chip %s does not support --spi-connection option." % esp.CHIP_NAME)
+        print("Configuring SPI flash mode...")
+        esp.flash_spi_attach(args.spi_connection)
+    elif args.no_stub:
+        print("Enabling default SPI flash mode...")
+        # ROM loader doesn't enable flash unless we explicitly do it
+        esp.flash_spi_attach(0)
+
+    if hasattr(args, "flash_size"):
+        print("Configuring flash size...")
+        detect_flash_size(esp, args)
+        esp.flash_set_parameters(flash_size_bytes(args.flash_size))
 
-    else:
-        operation_func(args)
+    try:
+        result = operation_func(esp, args)
+    finally:
+        try:  # Clean up AddrFilenamePairAction files
+            for address, argfile in args.addr_filename:
+                argfile.close()
+        except AttributeError:
+            pass
+    # write_flash may have connected again to carry on after losing the connection
+    return result if isinstance(result, ESPLoader) else esp
 
 
 def expand_file_arguments():
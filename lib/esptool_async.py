@@ -0,0 +1,379 @@
+#
+# asyncio transport and command layer for ESPLoader
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Lets one event loop drive many ESP devices at once.
+
+Connecting, detecting the chip and starting the stub are still done with the
+synchronous ESPLoader, which is then wrapped in an AsyncESPLoader:
+
+    esp = ESPLoader.detect_chip(port).run_stub()
+    async with AsyncESPLoader(esp) as aesp:
+        await aesp.write_flash(0x1000, image)
+
+Both share the SLIP framing and response parsing of esptool, only the I/O
+differs. While an AsyncESPLoader is open the port belongs to it, the
+synchronous loader can be used again once it is closed.
+"""
+
+import asyncio
+import collections
+import hashlib
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.esptool import (DEFAULT_TIMEOUT, ERASE_REGION_TIMEOUT_PER_MB, MAX_TIMEOUT, MD5_TIMEOUT_PER_MB,
+                         FatalError, ProgressReporter, SlipDecoder, command_packet, hexify, parse_response,
+                         slip_encode, stub_and_esp32_function_only, stub_function_only, timeout_per_mb)
+
+
+class SerialTransport(object):
+    """
+    Non-blocking SLIP packet transport over a pyserial port.
+
+    Ports with a file descriptor (serial ports on Linux and macOS) are watched
+    by the event loop itself. Other ports (Windows, RFC2217...) fall back to
+    blocking reads and writes on a reader and a writer thread.
+    """
+    # read timeout of the fallback reader thread, bounds how long close() waits
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, port, trace_function=None):
+        self._port = port
+        self._trace = trace_function
+        self._loop = asyncio.get_event_loop()
+        self._decoder = SlipDecoder(trace_function)
+        self._packets = collections.deque()
+        self._error = None
+        self._waiter = None
+        self._closed = False
+        self._saved_timeout = port.timeout
+        try:
+            self._fd = port.fileno()
+        except (AttributeError, OSError, ValueError):
+            self._fd = None
+
+        if self._fd is not None:
+            self._write_buffer = b''
+            self._drained = None
+            self._loop.add_reader(self._fd, self._on_readable)
+        else:
+            self._readers = ThreadPoolExecutor(1)
+            self._writers = ThreadPoolExecutor(1)
+            port.timeout = self.POLL_INTERVAL
+            self._reader_task = self._loop.create_task(self._read_loop())
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 0x10000)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fail(FatalError('Serial port read failed: %s' % e))
+            return
+        if not data:
+            self._fail(FatalError('Serial port closed'))
+            return
+        self._received(data)
+
+    async def _read_loop(self):
+        while not self._closed:
+            try:
+                data = await self._loop.run_in_executor(self._readers, self._read_blocking)
+            except Exception as e:
+                self._fail(FatalError('Serial port read failed: %s' % e))
+                return
+            if data:
+                self._received(data)
+
+    def _read_blocking(self):
+        waiting = self._port.inWaiting()
+        return self._port.read(1 if waiting == 0 else waiting)
+
+    def _received(self, data):
+        if self._trace:
+            self._trace("Read %d bytes", len(data))
+        try:
+            for packet in self._decoder.feed(data):
+                self._packets.append(packet)
+        except FatalError as e:
+            self._decoder.reset()
+            self._error = e
+        self._wake()
+
+    def _fail(self, error):
+        self._error = error
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def read(self, timeout=DEFAULT_TIMEOUT):
+        """ Read a SLIP packet, raises FatalError on timeout or invalid data """
+        deadline = self._loop.time() + timeout
+        while not self._packets:
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                waiting_for = "header" if self._decoder.idle else "content"
+                raise FatalError("Timed out waiting for packet %s" % waiting_for)
+            self._waiter = self._loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiter = None
+        return self._packets.popleft()
+
+    async def write(self, packet):
+        """ Write a packet while performing SLIP escaping, returns once it has been sent """
+        buf = slip_encode(packet)
+        if self._trace:
+            self._trace("Write %d bytes", len(buf))
+        if self._fd is None:
+            await self._loop.run_in_executor(self._writers, self._port.write, buf)
+            return
+
+        if not self._write_buffer:
+            try:
+                buf = buf[os.write(self._fd, buf):]
+            except (BlockingIOError, InterruptedError):
+                pass
+            if not buf:
+                return
+            self._drained = self._loop.create_future()
+            self._loop.add_writer(self._fd, self._on_writable)
+        self._write_buffer += buf
+        await asyncio.shield(self._drained)
+
+    def _on_writable(self):
+        try:
+            sent = os.write(self._fd, self._write_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            sent = len(self._write_buffer)
+            self._drained.set_exception(FatalError('Serial port write failed: %s' % e))
+        self._write_buffer = self._write_buffer[sent:]
+        if not self._write_buffer:
+            self._loop.remove_writer(self._fd)
+            if not self._drained.done():
+                self._drained.set_result(None)
+
+    def flush_input(self):
+        """ Throw away everything received so far """
+        self._port.flushInput()
+        self._packets.clear()
+        self._decoder.reset()
+        self._error = None
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            if self._write_buffer:
+                self._loop.remove_writer(self._fd)
+                self._write_buffer = b''
+        else:
+            await self._reader_task
+            self._readers.shutdown()
+            self._writers.shutdown()
+            self._port.timeout = self._saved_timeout
+
+
+class AsyncESPLoader(object):
+    """
+    Awaitable ESPLoader commands for a connected ESPLoader or stub loader.
+
+    Chip specific constants and settings (STATUS_BYTES_LENGTH, FLASH_WRITE_SIZE,
+    IS_STUB...) are taken from the wrapped loader, so it must be set up for
+    flashing (stub running, flash parameters set) before it is wrapped.
+    """
+    def __init__(self, esp):
+        self._esp = esp
+        self._transport = SerialTransport(esp._port, esp.trace if esp._trace_enabled else None)
+
+    def __getattr__(self, name):
+        return getattr(self._esp, name)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """ Give the port back to the synchronous loader """
+        await self._transport.close()
+        self._esp.flush_input()
+
+    async def command(self, op=None, data=b"", chk=0, wait_response=True, timeout=DEFAULT_TIMEOUT):
+        """ Send a request and read the response """
+        timeout = min(timeout, MAX_TIMEOUT)
+        if op is not None:
+            await self._transport.write(command_packet(op, data, chk))
+
+        if not wait_response:
+            return
+
+        # skip responses to other (earlier) requests, as the synchronous ESPLoader does
+        for retry in range(100):
+            response = parse_response(await self._transport.read(timeout))
+            if response is None:
+                continue
+            op_ret, val, data = response
+            if op is None or op_ret == op:
+                return val, data
+
+        raise FatalError("Response doesn't match request")
+
+    async def check_command(self, op_description, op=None, data=b'', chk=0, timeout=DEFAULT_TIMEOUT):
+        val, data = await self.command(op, data, chk, timeout=timeout)
+        return self._esp.command_result(op_description, val, data)
+
+    async def read_reg(self, addr):
+        val, data = await self.command(self.ESP_READ_REG, struct.pack('<I', addr))
+        if data[:1] != b'\0':
+            raise FatalError.WithResult("Failed to read register address %08x" % addr, data)
+        return val
+
+    @stub_and_esp32_function_only
+    async def flash_defl_begin(self, size, compsize, offset):
+        """ Start downloading compressed data to Flash, returns number of blocks to write """
+        num_blocks = (compsize + self.FLASH_WRITE_SIZE - 1) // self.FLASH_WRITE_SIZE
+        erase_blocks = (size + self.FLASH_WRITE_SIZE - 1) // self.FLASH_WRITE_SIZE
+        if self.IS_STUB:
+            write_size = size  # stub expects number of bytes here, manages erasing internally
+            timeout = DEFAULT_TIMEOUT
+        else:
+            write_size = erase_blocks * self.FLASH_WRITE_SIZE  # ROM expects rounded up to erase block size
+            timeout = timeout_per_mb(ERASE_REGION_TIMEOUT_PER_MB, write_size)  # ROM performs the erase up front
+        await self.check_command("enter compressed flash mode", self.ESP_FLASH_DEFL_BEGIN,
+                                 struct.pack('<IIII', write_size, num_blocks, self.FLASH_WRITE_SIZE, offset),
+                                 timeout=timeout)
+        return num_blocks
+
+    @stub_and_esp32_function_only
+    async def flash_defl_block(self, data, seq, timeout=DEFAULT_TIMEOUT):
+        """ Write block to flash, send compressed """
+        await self.check_command("write compressed data to flash after seq %d" % seq,
+                                 self.ESP_FLASH_DEFL_DATA, struct.pack('<IIII', len(data), seq, 0, 0) + data,
+                                 self._esp.checksum(data), timeout=timeout)
+
+    @stub_and_esp32_function_only
+    async def flash_defl_finish(self, reboot=False):
+        """ Leave compressed flash mode and run/reboot """
+        if not reboot and not self.IS_STUB:
+            return  # see ESPLoader.flash_defl_finish
+        await self.check_command("leave compressed flash mode", self.ESP_FLASH_DEFL_END,
+                                 struct.pack('<I', int(not reboot)))
+
+    @stub_and_esp32_function_only
+    async def flash_md5sum(self, addr, size):
+        res = await self.check_command('calculate md5sum', self.ESP_SPI_FLASH_MD5,
+                                       struct.pack('<IIII', addr, size, 0, 0),
+                                       timeout=timeout_per_mb(MD5_TIMEOUT_PER_MB, size))
+        if len(res) == 32:
+            return res.decode("utf-8")  # already hex formatted
+        elif len(res) == 16:
+            return hexify(res).lower()
+        else:
+            raise FatalError("MD5Sum command returned unexpected result: %r" % res)
+
+    @stub_function_only
+    async def read_flash(self, offset, length, progress_fn=None, block_size=None, max_in_flight=None):
+        """ Read 'length' bytes of flash starting at 'offset', see ESPLoader.read_flash
+
+        The adaptive mode of the synchronous read_flash is not supported.
+        """
+        if block_size is None:
+            block_size = self.READ_FLASH_BLOCK_SIZE
+        if max_in_flight is None:
+            max_in_flight = self.READ_FLASH_MAX_IN_FLIGHT
+        if not 0 < block_size <= self.FLASH_SECTOR_SIZE:
+            raise FatalError("Read block size must be between 1 and 0x%x bytes" % self.FLASH_SECTOR_SIZE)
+        if max_in_flight < 1:
+            raise FatalError("At least one read block must be allowed in flight")
+
+        # the stub counts its window in bytes
+        await self.check_command("read flash", self.ESP_READ_FLASH,
+                                 struct.pack('<IIII', offset, length, block_size, block_size * max_in_flight))
+        # acknowledge every half window, as the synchronous read_flash does
+        ack_every = max(1, max_in_flight // 2)
+        unacked = 0
+        data = bytearray()
+        while len(data) < length:
+            p = await self._transport.read(DEFAULT_TIMEOUT)
+            data += p
+            if len(data) < length and len(p) < block_size:
+                raise FatalError('Corrupt data, expected 0x%x bytes but received 0x%x bytes' % (block_size, len(p)))
+            unacked += 1
+            if unacked >= ack_every or len(data) >= length:
+                await self._transport.write(struct.pack('<I', len(data)))
+                unacked = 0
+            if progress_fn:
+                progress_fn(len(data), length)
+        if len(data) > length:
+            raise FatalError('Read more than expected')
+        digest_frame = await self._transport.read(DEFAULT_TIMEOUT)
+        if len(digest_frame) != 16:
+            raise FatalError('Expected digest, got: %s' % hexify(digest_frame))
+        expected_digest = hexify(digest_frame).upper()
+        digest = hashlib.md5(data).hexdigest().upper()
+        if digest != expected_digest:
+            raise FatalError('Digest mismatch: expected %s, got %s' % (expected_digest, digest))
+        return bytes(data)
+
+    async def write_flash(self, address, image, progress=None):
+        """ Write a compressed image to flash at address and verify its digest
+
+        progress gets ProgressEvents as write_flash's args.progress does. Unlike the
+        write_flash operation the image is written as is, without updating its header.
+        """
+        loop = asyncio.get_event_loop()
+        if len(image) % 4 != 0:
+            image += b'\xff' * (4 - len(image) % 4)
+        uncsize = len(image)
+        # compressing a few MB takes long enough to stall every other device
+        compressed = await loop.run_in_executor(None, zlib.compress, image, 9)
+        calcmd5 = hashlib.md5(image).hexdigest()
+        ratio = uncsize / len(compressed)
+
+        reporter = ProgressReporter(progress)
+        reporter.start('write', uncsize)
+        blocks = await self.flash_defl_begin(uncsize, len(compressed), address)
+        for seq in range(blocks):
+            block = compressed[seq * self.FLASH_WRITE_SIZE:(seq + 1) * self.FLASH_WRITE_SIZE]
+            await self.flash_defl_block(block, seq, timeout=DEFAULT_TIMEOUT * ratio * 2)
+            reporter.update(uncsize * (seq + 1) // blocks)
+        reporter.finish()
+
+        res = await self.flash_md5sum(address, uncsize)
+        if res != calcmd5:
+            raise FatalError("MD5 of file does not match data in flash!")
+
+    async def finish_write_flash(self):
+        """ End the compressed flash session, leaving the stub in the bootloader as write_flash does """
+        if self.IS_STUB:
+            await self.check_command("enter Flash download mode", self.ESP_FLASH_BEGIN,
+                                     struct.pack('<IIII', 0, 0, self.FLASH_WRITE_SIZE, 0))
+            await self.flash_defl_finish(False)
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoManager headless mode
+
+Updates the SumoFirmware of the connected SumoRobots
+without a display. Progress and results are printed
+to stdout as JSON lines, one event per line. In the
+station mode every SumoRobot plugged in gets a job.
+SumoRobots running SumoFirmware can be updated over Wi-Fi.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+
+# Local lib imports
+from lib.daemon import *
+from lib.station import *
+from lib.scheduler import *
+
+# Events always go to the real stdout, esptool output goes to stderr
+events = sys.stdout
+lock = threading.Lock()
+
+# Print one machine-readable event
+def emit(event, **fields):
+    fields['event'] = event
+    fields['time'] = round(time.time(), 3)
+    events.write(json.dumps(fields, sort_keys=True) + '\n')
+    events.flush()
+
+# Print the scheduler job events
+def job_event(job, event, fields):
+    with lock:
+        if event == 'progress':
+            # Progress is already coalesced, a few events per second
+            for key in ('elapsed', 'rate', 'average_rate', 'eta'):
+                if fields[key] is not None:
+                    fields[key] = round(fields[key], 1)
+        if event in ('done', 'failed'):
+            fields['ok'] = event == 'done'
+            fields['seconds'] = round(job.finished - job.started, 3)
+            if job.flashed is not None:
+                fields['flashed'] = job.flashed
+            if job.error:
+                fields['error'] = job.error
+                fields['details'] = job.details
+        emit(event, job=job.id, kind=job.kind, port=job.port, hub=job.hub, **fields)
+
+# Parse a --hub-limit value, either LIMIT or HUB=LIMIT
+def hub_limit(value):
+    hub, _, limit = value.rpartition('=')
+    try:
+        return (hub or None, int(limit))
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not LIMIT or HUB=LIMIT' % value)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='sumomanager --headless',
+        description='Update the SumoFirmware of the connected SumoRobots')
+    parser.add_argument('--headless', action='store_true',
+        help='Run without the graphical interface')
+    parser.add_argument('--port', '-p', action='append',
+        help='Serial port of the SumoRobot, can be given several times (default: all detected SumoRobots)')
+    parser.add_argument('--firmware', '-f',
+        help='Flash this SumoFirmware binary or esptool flash bundle instead of downloading the latest one')
+    parser.add_argument('--download-to',
+        help='Download the SumoFirmware binary to this path (default: %s)' % FIRMWARE_PATH)
+    parser.add_argument('--job', choices=[kind for kind in JOB_KINDS if kind != 'ota'], default='flash',
+        help='What to do with every SumoRobot (default: flash)')
+    parser.add_argument('--backup', action='store_true',
+        help='Back up the SumoRobot flash before updating')
+    parser.add_argument('--force', action='store_true',
+        help='Flash the SumoFirmware even when the SumoRobot has it already')
+    parser.add_argument('--ota', metavar='ROBOT', action='append', default=[],
+        help='Update this SumoRobot running SumoFirmware over Wi-Fi instead of over USB, '
+        + 'HOST[:PORT] (default port: %d), can be given several times' % OTA_PORT)
+    parser.add_argument('--list', action='store_true',
+        help='Only list the detected SumoRobots')
+    parser.add_argument('--station', action='store_true',
+        help='Keep running and queue a job for every SumoRobot plugged in, until interrupted')
+    parser.add_argument('--jobs', '-j', type=int, default=4,
+        help='Number of SumoRobots handled at once (default: 4)')
+    parser.add_argument('--remote', metavar='STATION', action='append', default=[],
+        help='Also update the SumoRobots of this remote station HOST[:PORT] (default port: %d), '
+        % STATION_PORT + 'can be given several times')
+    parser.add_argument('--serve-station', metavar='[HOST:]PORT', nargs='?', const=str(STATION_PORT),
+        help='Share the SumoRobots plugged into this computer as a remote station, until interrupted')
+    parser.add_argument('--daemon', metavar='SOCKET',
+        help='Keep the SumoRobot connections open and take JSON-RPC commands on this Unix socket, until interrupted')
+    parser.add_argument('--hub-limit', type=hub_limit, action='append', default=[],
+        help='Number of SumoRobots handled at once behind one USB hub, '
+        + 'HUB=LIMIT for one hub or LIMIT for all the other hubs, can be given several times')
+    args = parser.parse_args(argv)
+    if args.ota and (args.station or args.port or args.backup or args.job != 'flash'):
+        parser.error('--ota only updates the given SumoRobots, without --station, --port, --backup or --job')
+
+    # esptool prints its progress to stdout, keep stdout for the events
+    with contextlib.redirect_stdout(sys.stderr):
+        return run(args)
+
+def run(args):
+    if args.serve_station:
+        host, port = station_address(args.serve_station)
+        try:
+            station = Station(host, port, lambda device, e:
+                emit('error', port=device, error='Sharing the SumoRobot failed: %s' % e))
+        except OSError as e:
+            emit('error', error='Starting the station failed: %s' % e)
+            return 2
+        emit('status', stage='station', port=port)
+        try:
+            station.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            station.close()
+        return 0
+
+    if args.daemon:
+        try:
+            serve(args.daemon, args.firmware, args.download_to, args.remote,
+                lambda path: emit('status', stage='daemon', socket=path))
+        except OSError as e:
+            emit('error', error='Starting the daemon failed: %s' % e)
+            return 2
+        return 0
+
+    kind = 'ota' if args.ota else args.job
+    if args.ota:
+        # Network SumoRobots are not behind a USB hub
+        robots = [(robot, None) for robot in args.ota]
+    else:
+        robots = list_sumorobots(args.remote)
+    if args.port:
+        hubs = dict(robots)
+        robots = [(port, hubs.get(port)) for port in args.port]
+    emit('detected', ports=[port for port, hub in robots], hubs=[hub for port, hub in robots])
+    if args.list:
+        return 0
+    if not robots and not args.station:
+        emit('error', error='No SumoRobot connected')
+        return 2
+
+    # Reuse the given SumoFirmware or download the latest one
+    firmware_path = args.firmware
+    if not firmware_path and args.job != 'backup':
+        emit('status', stage='download')
+        try:
+            firmware_path = download_firmware(args.download_to,
+                lambda event: emit('progress', **event.as_dict()))
+        except Exception as e:
+            emit('error', error='Downloading SumoFirmware failed: %s' % e)
+            return 2
+    if firmware_path:
+        emit('firmware', path=firmware_path, size=os.path.getsize(firmware_path))
+
+    hub_limits = dict(args.hub_limit)
+    scheduler = Scheduler(args.jobs, hub_limits, hub_limits.pop(None, None), job_event)
+    scheduler.start()
+    if args.station:
+        emit('status', stage='station')
+        scheduler.watch(args.job, stations=args.remote,
+            firmware_path=firmware_path, backup=args.backup, force=args.force)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    else:
+        for port, hub in robots:
+            scheduler.submit(kind, port, hub, firmware_path=firmware_path, backup=args.backup, force=args.force)
+    scheduler.join()
+    scheduler.stop()
+
+    jobs = [job for job in scheduler.jobs if job.state in ('done', 'failed')]
+    failed = [job for job in jobs if job.state == 'failed']
+    emit('done', ok=not failed, updated=len(jobs) - len(failed), failed=len(failed))
+    return 1 if failed else 0
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoRobot over-the-air updates
+
+Updates SumoRobots which already run SumoFirmware over
+Wi-Fi, so a classroom of SumoRobots can be updated at once
+without USB cables. SumoFirmware serves the update on HTTP:
+
+    GET /ota            {"mac", "md5", "size"} of the running app image
+    PUT /ota            the new app image, its MD5 in the X-MD5 header,
+                        answers {"md5", "size"} of what was written
+    POST /ota/reboot    boot into the new app image
+
+The SumoFirmware binary flashed over USB is a whole flash image,
+bootloader and partition table first. Only the app image at
+OTA_APP_ADDRESS of it goes into the OTA partition of the SumoRobot.
+tests/ota_robot.py is a stand-in SumoRobot serving this protocol.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import json
+import time
+import hashlib
+import http.client
+
+# Local lib imports
+from lib.sumorobot import *
+
+# Where the SumoRobots updated over Wi-Fi are remembered, one HOST[:PORT] per line
+OTA_ROBOTS_PATH = os.path.join(SUMOMANAGER_PATH, 'wifi_sumorobots.txt')
+
+# HTTP port of the SumoFirmware update server
+OTA_PORT = 80
+# Flash address of the app image in the SumoFirmware binary
+OTA_APP_ADDRESS = 0x10000
+# Timeout per network operation, writing the flash
+# on the SumoRobot is slower than the Wi-Fi
+OTA_TIMEOUT = 10
+OTA_CHUNK_SIZE = 0x1000
+# Time for the SumoRobot to reboot and join the Wi-Fi again
+OTA_BOOT_TIMEOUT = 30
+# SumoRobots updated at once by the SumoManager GUI, they share one Wi-Fi access point
+OTA_JOBS = 8
+
+# Split a SumoRobot address HOST[:PORT]
+def ota_address(robot):
+    host, _, port = robot.rpartition(':')
+    if not port.isdigit():
+        return robot, OTA_PORT
+    return host, int(port)
+
+# The remembered SumoRobots updated over Wi-Fi
+def load_ota_robots():
+    try:
+        with open(OTA_ROBOTS_PATH, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    except OSError:
+        return []
+
+def save_ota_robots(robots):
+    os.makedirs(SUMOMANAGER_PATH, exist_ok=True)
+    with open(OTA_ROBOTS_PATH, 'w') as f:
+        f.write(''.join(robot + '\n' for robot in robots))
+
+# Send one request to the SumoRobot, returns the JSON answer
+def ota_request(robot, method, path, body=None, headers={}):
+    connection = http.client.HTTPConnection(*ota_address(robot), timeout=OTA_TIMEOUT)
+    try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise FatalError('SumoRobot %s answered %d %s: %s' % (robot, response.status,
+                response.reason, data.decode('utf-8', 'replace').strip()))
+        return json.loads(data.decode('utf-8')) if data.strip() else {}
+    finally:
+        connection.close()
+
+# The running SumoFirmware of the SumoRobot
+def ota_status(robot):
+    return ota_request(robot, 'GET', '/ota')
+
+# The app image of a SumoFirmware binary, which is written to FIRMWARE_ADDRESS over USB
+def ota_image(firmware_path):
+    # The SumoRobot keeps its own bootloader and partition table
+    if FlashBundle.is_bundle(firmware_path):
+        raise ValueError('Over the air updates take a SumoFirmware binary, not a flash bundle')
+    with open(firmware_path, 'rb') as f:
+        f.seek(OTA_APP_ADDRESS - FIRMWARE_ADDRESS)
+        image = f.read()
+    if image[:1] != bytes([ESPLoader.ESP_IMAGE_MAGIC]):
+        raise ValueError('%s has no app image at 0x%x' % (firmware_path, OTA_APP_ADDRESS))
+    return image
+
+# Update the SumoFirmware of the SumoRobot over Wi-Fi, unless it runs it already
+# Returns whether the SumoFirmware was written, progress gets the ProgressEvents
+def ota_update(robot, firmware_path, progress=None, force=False):
+    image = ota_image(firmware_path)
+    md5 = hashlib.md5(image).hexdigest()
+
+    status = ota_status(robot)
+    if not force and status.get('md5') == md5:
+        return False
+
+    # Stream the app image, the SumoRobot writes it while receiving
+    reporter = ProgressReporter(progress)
+    reporter.start('ota', len(image))
+    def chunks():
+        for offset in range(0, len(image), OTA_CHUNK_SIZE):
+            chunk = image[offset:offset + OTA_CHUNK_SIZE]
+            yield chunk
+            reporter.advance(len(chunk))
+    written = ota_request(robot, 'PUT', '/ota', chunks(), {
+        'Content-Type': 'application/octet-stream',
+        'Content-Length': str(len(image)),
+        'X-MD5': md5})
+    reporter.finish()
+    # Never boot a SumoFirmware which was damaged on the way
+    if written.get('md5') != md5 or written.get('size') != len(image):
+        raise ValueError('SumoRobot %s wrote SumoFirmware with MD5 %s, expected %s'
+            % (robot, written.get('md5'), md5))
+
+    ota_request(robot, 'POST', '/ota/reboot')
+    wait_ota_boot(robot, md5)
+    if status.get('mac'):
+        registry.update(status['mac'], address=robot, ota_md5=md5, flashed=time.time())
+    return True
+
+# Wait for the SumoRobot to come back running the SumoFirmware with the MD5
+def wait_ota_boot(robot, md5):
+    end = time.time() + OTA_BOOT_TIMEOUT
+    while True:
+        # Not answering while rebooting
+        time.sleep(1)
+        try:
+            running = ota_status(robot).get('md5')
+        except (OSError, ValueError, http.client.HTTPException, FatalError):
+            running = None
+        if running == md5:
+            return
+        if time.time() > end:
+            raise FatalError('SumoRobot %s did not boot the new SumoFirmware, it runs %s'
+                % (robot, running or 'nothing reachable'))
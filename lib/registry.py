@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoRobot registry
+
+Remembers every SumoRobot by the MAC address of its ESP:
+the chip, the flash size, the serial settings which worked
+and the SumoFirmware written last. Kept in a JSON file, so
+it survives unplugging the SumoRobot and restarting.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import json
+import time
+import threading
+
+class Registry:
+    """
+    The known SumoRobots, a dict of fields per MAC address. The
+    file is read on first use and written after every change.
+    Safe to use from several threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.robots = None
+        self.lock = threading.Lock()
+
+    # Fields of the SumoRobot, empty when not known
+    def get(self, mac):
+        with self.lock:
+            return dict(self._load().get(mac, {}))
+
+    # Fields of the SumoRobot seen last on the serial port, empty when none
+    def on_port(self, port):
+        with self.lock:
+            robots = [robot for robot in self._load().values() if robot.get('port') == port]
+        return dict(max(robots, key=lambda robot: robot['last_seen'], default={}))
+
+    # Update the fields of the SumoRobot, returns all of its fields
+    def update(self, mac, **fields):
+        with self.lock:
+            robot = self._load().setdefault(mac, {'mac': mac, 'first_seen': time.time()})
+            robot.update(fields)
+            robot['last_seen'] = time.time()
+            self._save()
+            return dict(robot)
+
+    def _load(self):
+        if self.robots is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self.robots = json.load(f)
+            except (OSError, ValueError):
+                # No registry yet or a damaged one, start over
+                self.robots = {}
+        return self.robots
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Never leave a half written registry behind
+        part_path = self.path + '.part'
+        with open(part_path, 'w') as f:
+            json.dump(self.robots, f, indent=2, sort_keys=True)
+        os.replace(part_path, self.path)
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoRobot flashing station scheduler
+
+Keeps a queue of flash, verify, backup and over-the-air
+update jobs and runs them on a bounded pool of worker
+threads. Every running job holds an exclusive lease on its
+serial port, or the network address of the SumoRobot, and
+the number of jobs running behind one USB hub can be limited.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import time
+import itertools
+import threading
+import traceback
+import collections
+
+# Local lib imports
+from lib.ota import *
+
+# Job kinds, ota jobs update SumoRobots running SumoFirmware over Wi-Fi
+JOB_KINDS = ('flash', 'verify', 'backup', 'ota')
+
+class Job:
+    ids = itertools.count(1)
+
+    def __init__(self, kind, port, hub=None, firmware_path=None, backup=False, force=False):
+        if kind not in JOB_KINDS:
+            raise ValueError('Unknown job kind %s' % kind)
+        if kind != 'backup' and not firmware_path:
+            raise ValueError('A %s job needs the SumoFirmware path' % kind)
+        self.id = next(Job.ids)
+        self.kind = kind
+        self.port = port
+        self.hub = hub
+        self.firmware_path = firmware_path
+        self.backup = backup
+        self.force = force
+        # Whether a flash job wrote the SumoFirmware or found it up to date
+        self.flashed = None
+        self.state = 'queued'
+        self.error = None
+        self.details = None
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return '<Job %d %s %s %s>' % (self.id, self.kind, self.port, self.state)
+
+    # Run the job on the SumoRobot, progress gets the esptool ProgressEvents
+    def run(self, progress=None):
+        if self.kind == 'ota':
+            # The port is the network address of the SumoRobot
+            self.flashed = ota_update(self.port, self.firmware_path, progress, self.force)
+            return
+        esp = prepare_sumorobot(self.port)
+        try:
+            if self.kind == 'backup' or self.backup:
+                backup_sumorobot(esp, progress)
+            if self.kind == 'flash':
+                esp, self.flashed = update_firmware(esp, self.firmware_path, progress, self.force)
+            elif self.kind == 'verify':
+                verify_firmware(esp, self.firmware_path)
+            esp.hard_reset()
+        finally:
+            esp._port.close()
+
+class Scheduler:
+    """
+    Runs queued jobs on at most workers threads. A job is only
+    started when its serial port is not leased by another job
+    and its USB hub is below the hub limit. hub_limits maps a hub
+    to its limit, hub_limit is used for the other hubs and None
+    means no limit. on_event(job, event, fields) is called from
+    the worker threads for every state change and progress step.
+    """
+    def __init__(self, workers=4, hub_limits=None, hub_limit=None, on_event=None):
+        self.workers = workers
+        self.hub_limits = dict(hub_limits or {})
+        self.hub_limit = hub_limit
+        self.on_event = on_event
+        self.jobs = []
+        self.queue = collections.deque()
+        # Serial port to the job holding its lease
+        self.leases = {}
+        # Number of running jobs per USB hub
+        self.hub_jobs = collections.Counter()
+        self.condition = threading.Condition()
+        self.running = False
+        self.threads = []
+        self.watcher = None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='sumo-worker-%d' % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Stop picking new jobs, running jobs are finished first
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads + ([self.watcher] if self.watcher else []):
+            thread.join()
+        self.threads = []
+        self.watcher = None
+
+    def submit(self, kind, port, hub=None, **kwargs):
+        job = Job(kind, port, hub, **kwargs)
+        with self.condition:
+            self.jobs.append(job)
+            self.queue.append(job)
+            self.condition.notify_all()
+        self._emit(job, 'queued')
+        return job
+
+    def leased(self, port):
+        with self.condition:
+            return port in self.leases
+
+    # Wait until all the queued jobs have finished
+    def join(self, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.queue or self.leases:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    # Queue a job for every SumoRobot plugged in, here or into the remote stations, until stopped
+    def watch(self, kind, interval=1, stations=(), **kwargs):
+        def run():
+            seen = set()
+            while self.running:
+                robots = list_sumorobots(stations)
+                for port, hub in robots:
+                    if port not in seen:
+                        self.submit(kind, port, hub, **kwargs)
+                # Unplugged ports are picked up again when plugged back in
+                seen = set(port for port, hub in robots)
+                with self.condition:
+                    self.condition.wait_for(lambda: not self.running, interval)
+        self.watcher = threading.Thread(target=run, name='sumo-watcher', daemon=True)
+        self.watcher.start()
+
+    def _emit(self, job, event, **fields):
+        if self.on_event:
+            self.on_event(job, event, fields)
+
+    def _hub_full(self, hub):
+        limit = self.hub_limits.get(hub, self.hub_limit)
+        return limit is not None and self.hub_jobs[hub] >= limit
+
+    # Take the first queued job whose port and hub are free, with the lock held
+    def _take(self):
+        for job in self.queue:
+            if job.port not in self.leases and not self._hub_full(job.hub):
+                self.queue.remove(job)
+                self.leases[job.port] = job
+                self.hub_jobs[job.hub] += 1
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                job = None
+                while self.running:
+                    job = self._take()
+                    if job:
+                        break
+                    self.condition.wait()
+                if not job:
+                    return
+
+            job.state = 'running'
+            job.started = time.time()
+            self._emit(job, 'started')
+            try:
+                job.run(lambda event: self._emit(job, 'progress', **event.as_dict()))
+                job.state = 'done'
+            except Exception as e:
+                job.state = 'failed'
+                job.error = str(e)
+                job.details = traceback.format_exc()
+            job.finished = time.time()
+            self._emit(job, job.state)
+
+            # Release the port lease, so the next job can start
+            with self.condition:
+                del self.leases[job.port]
+                self.hub_jobs[job.hub] -= 1
+                self.condition.notify_all()
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoRobot remote flashing stations
+
+A station runs next to the USB hubs and shares the SumoRobots
+plugged into it over TCP, so one SumoManager can flash SumoRobots
+connected to several computers. Every SumoRobot gets its own RFC
+2217 server (serial port over telnet, with baud rate and DTR/RTS
+control), which serves one SumoManager at a time. The index port
+tells which SumoRobots the station has and on which TCP ports.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import json
+import time
+import socket
+import threading
+import serial.rfc2217
+
+# Local lib imports
+from lib.sumorobot import *
+
+# The serial port of a SumoRobot is read with this timeout, so closing it takes as long
+STATION_READ_TIMEOUT = 0.5
+# A SumoManager connecting while the SumoRobot is leased waits this long for it,
+# reconnecting right after disconnecting finds the serial port still closing
+STATION_LEASE_WAIT = 3 * STATION_READ_TIMEOUT
+
+# Socket options for the SumoRobot connections, command round trips are short
+def tune_socket(connection):
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+class SocketWriter:
+    # The connection interface RFC 2217 PortManager writes its replies to
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.connection.sendall(data)
+
+class RobotServer:
+    """
+    RFC 2217 server for one SumoRobot serial port. Serves one
+    client at a time, the client holds the lease of the SumoRobot
+    until it disconnects. Other clients wait STATION_LEASE_WAIT
+    for the lease, then they are turned away.
+    """
+    def __init__(self, device, hub, host, port):
+        self.device = device
+        self.hub = hub
+        self.port = port
+        self.client = None
+        self.released = threading.Condition()
+        self.running = True
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((host, port))
+            self.listener.listen(1)
+        except OSError:
+            self.listener.close()
+            raise
+        threading.Thread(target=self._accept, name='station-%d' % port, daemon=True).start()
+
+    def status(self):
+        return {'device': self.device, 'hub': self.hub, 'port': self.port,
+            'leased': self.client is not None}
+
+    def close(self):
+        self.running = False
+        self.listener.close()
+
+    def _accept(self):
+        while self.running:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                return
+            with self.released:
+                # The SumoManager may have reconnected before its serial port was closed
+                self.released.wait_for(lambda: self.client is None, STATION_LEASE_WAIT)
+                if self.client is not None:
+                    # Leased by another SumoManager
+                    connection.close()
+                    continue
+                self.client = '%s:%d' % address[:2]
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        tune_socket(connection)
+        try:
+            port = serial.serial_for_url(self.device, do_not_open=True)
+            # The reader checks for the client leaving this often
+            port.timeout = STATION_READ_TIMEOUT
+            port.open()
+        except (OSError, serial.SerialException):
+            connection.close()
+            self._release()
+            return
+
+        # The station port is local, tune it for short command round trips
+        tune_serial_port(port)
+        writer = SocketWriter(connection)
+        manager = serial.rfc2217.PortManager(port, writer)
+        alive = [True]
+        def read_serial():
+            # Send whatever has arrived, big reads while flashing and short replies without delay
+            while alive[0]:
+                try:
+                    data = port.read(port.in_waiting or 1)
+                    if data:
+                        writer.write(b''.join(manager.escape(data)))
+                    manager.check_modem_lines()
+                except (OSError, serial.SerialException):
+                    break
+            alive[0] = False
+            connection.close()
+        reader = threading.Thread(target=read_serial, daemon=True)
+        reader.start()
+
+        try:
+            while alive[0]:
+                data = connection.recv(0x4000)
+                if not data:
+                    break
+                port.write(b''.join(manager.filter(data)))
+        except (OSError, serial.SerialException):
+            pass
+        finally:
+            alive[0] = False
+            reader.join()
+            port.close()
+            self._release()
+
+    def _release(self):
+        with self.released:
+            self.client = None
+            self.released.notify_all()
+
+class Station:
+    """
+    Shares the SumoRobots plugged into this computer. New SumoRobots
+    get the next free TCP port after the index port, a SumoRobot
+    plugged in again gets the same port as before. on_error(device,
+    error) is called when a SumoRobot can not be shared, it is
+    tried again on the next port with the next scan.
+    """
+    def __init__(self, host='', port=STATION_PORT, on_error=None):
+        self.host = host
+        self.port = port
+        self.on_error = on_error
+        self.next_port = port + 1
+        self.robots = {}
+        self.lock = threading.Lock()
+        self.running = True
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(5)
+
+    # Start the servers of the newly plugged in SumoRobots
+    def scan(self):
+        for device, hub in list_sumorobots():
+            with self.lock:
+                if device in self.robots:
+                    continue
+                port = self.next_port
+                self.next_port += 1
+                try:
+                    self.robots[device] = RobotServer(device, hub, self.host, port)
+                except OSError as e:
+                    # The port is taken by another program, skip the SumoRobot for now
+                    if self.on_error:
+                        self.on_error(device, e)
+
+    def index(self):
+        plugged = set(device for device, hub in list_sumorobots())
+        with self.lock:
+            return {'robots': [robot.status() for robot in self.robots.values() if robot.device in plugged]}
+
+    def close(self):
+        self.running = False
+        self.listener.close()
+        with self.lock:
+            for robot in self.robots.values():
+                robot.close()
+
+    # Answer index requests and scan for SumoRobots, until closed
+    def serve(self, interval=1):
+        def scan():
+            while self.running:
+                self.scan()
+                time.sleep(interval)
+        self.scan()
+        threading.Thread(target=scan, name='station-scan', daemon=True).start()
+
+        while self.running:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                return
+            with connection:
+                try:
+                    connection.sendall(json.dumps(self.index()).encode('utf-8') + b'\n')
+                except OSError:
+                    pass
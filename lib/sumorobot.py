@@ -0,0 +1,479 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoRobot firmware update flow
+
+Detects SumoRobots, downloads the SumoFirmware and
+flashes it. Shared by the SumoManager GUI and the
+headless mode, so it must not import PyQt5.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import json
+import time
+import socket
+import struct
+import asyncio
+import hashlib
+import threading
+import argparse
+import contextlib
+import collections
+import http.client
+import urllib.error
+import urllib.request
+import serial.tools.list_ports
+
+# Local lib imports
+from lib.esptool import *
+from lib.registry import Registry
+from lib.esptool_async import AsyncESPLoader
+
+# SumoFirmware repository URL
+SUMOFIRMWARE_URL = 'https://github.com/robokoding/sumorobot-firmware/releases/latest/download/'
+
+# Where SumoManager keeps its files
+SUMOMANAGER_PATH = os.path.join(os.path.expanduser('~'), '.sumomanager')
+# Where SumoRobot flash backups are kept
+BACKUP_PATH = os.path.join(SUMOMANAGER_PATH, 'backups')
+# Where the downloaded SumoFirmware is kept
+FIRMWARE_PATH = os.path.join(SUMOMANAGER_PATH, 'sumofirmware.bin')
+# Where the known SumoRobots are remembered
+REGISTRY_PATH = os.path.join(SUMOMANAGER_PATH, 'sumorobots.json')
+# Where the remote stations are remembered, one HOST[:PORT] per line
+STATIONS_PATH = os.path.join(SUMOMANAGER_PATH, 'stations.txt')
+
+# SumoFirmware download settings, the timeout is per network read
+DOWNLOAD_TIMEOUT = 15
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_CHUNK_SIZE = 0x10000
+
+# Known SumoRobots by MAC address, see prepare_sumorobot and flash_firmware
+registry = Registry(REGISTRY_PATH)
+
+# SumoFirmware prepared for flashing, least recently used first, see shared_firmware
+prepared_firmware = collections.OrderedDict()
+firmware_lock = threading.Lock()
+# Prepared SumoFirmware kept in memory, like a bundle and a plain binary in turns
+PREPARED_FIRMWARE_LIMIT = 4
+
+# TCP port of a remote station index, its SumoRobots get the ports after it
+STATION_PORT = 2217
+# Timeout for connecting to a remote station and reading its index
+STATION_TIMEOUT = 2
+
+# Times to try connecting again to a SumoRobot which dropped off while flashing
+RECONNECT_ATTEMPTS = 5
+
+# SumoFirmware flash layout
+FIRMWARE_ADDRESS = 0x1000
+APP_ADDRESS = 0x10000
+FLASH_SIZE = '4MB'
+# Serial baud rate for flashing, the SumoRobot is detected at the ROM baud rate
+# and flashed at it when nothing gets through at FLASH_BAUD, see start_stub
+FLASH_BAUD = 460800
+
+# Different SumoRobot versions have a
+# different USB to UART IC hardware ID
+# Jiangsu Haoheng CH340 IC and Silicon Labs CP210x IC
+SUMOROBOT_HWIDS = ('1A86:', '10C4:')
+
+# Scan the serialports and the remote stations for SumoRobots, returns (port, hub) pairs
+# Remote SumoRobots have rfc2217:// URLs as ports, unreachable stations are skipped
+def list_sumorobots(stations=()):
+    # TODO: implement with USB event
+    robots = [(p.device, usb_hub(p)) for p in serial.tools.list_ports.comports()
+        if any(hwid in p.hwid for hwid in SUMOROBOT_HWIDS)]
+    for station in stations:
+        try:
+            robots += station_sumorobots(station)
+        except (OSError, ValueError, KeyError):
+            pass
+    return robots
+
+# Scan the serialports and the remote stations for SumoRobots
+def find_sumorobots(stations=()):
+    return [port for port, hub in list_sumorobots(stations)]
+
+# Split a remote station address HOST[:PORT], PORT alone means all the local addresses
+def station_address(station):
+    host, _, port = station.rpartition(':')
+    if not port.isdigit():
+        return station, STATION_PORT
+    return host, int(port)
+
+# The remembered remote stations
+def load_stations():
+    try:
+        with open(STATIONS_PATH, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    except OSError:
+        return []
+
+def save_stations(stations):
+    os.makedirs(SUMOMANAGER_PATH, exist_ok=True)
+    with open(STATIONS_PATH, 'w') as f:
+        f.write(''.join(station + '\n' for station in stations))
+
+# SumoRobots shared by a remote station (see lib/station.py) as (URL, hub) pairs
+def station_sumorobots(station):
+    host, port = station_address(station)
+    with socket.create_connection((host, port), STATION_TIMEOUT) as connection:
+        connection.settimeout(STATION_TIMEOUT)
+        index = json.loads(connection.makefile('rb').readline().decode('utf-8'))
+    # Hubs of different stations are different hubs, unknown hubs stay unknown
+    return [('rfc2217://%s:%d' % (host, robot['port']),
+        '%s/%s' % (host, robot['hub']) if robot.get('hub') is not None else None)
+        for robot in index['robots']]
+
+# USB hub a serialport is plugged into, None when unknown
+def usb_hub(port_info):
+    # The location looks like 1-1.4:1.0, bus 1, hub port 1, port 4
+    location = getattr(port_info, 'location', None)
+    if not location:
+        return None
+    location = location.split(':')[0]
+    if '.' in location:
+        return location.rsplit('.', 1)[0]
+    # Plugged straight into the root hub of the bus
+    return location.split('-')[0]
+
+# Published SHA-256 digest of the latest SumoFirmware binary
+def firmware_sha256():
+    try:
+        response = urllib.request.urlopen(SUMOFIRMWARE_URL + 'sumofirmware.bin.sha256', timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        # Not published for this release, see firmware_intact
+        if e.code == 404:
+            return None
+        raise
+    # Same format as the sha256sum output, digest first
+    return response.read().decode().split()[0].lower()
+
+# SHA-256 digest of a file, read in chunks
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Whether a SumoFirmware downloaded without a published SHA-256 digest is whole:
+# it has the size of the release asset, and the bootloader and app images in it
+# have valid checksums and the SHA-256 digests appended to them
+def firmware_intact(path, size):
+    if not size or os.path.getsize(path) != size:
+        return False
+    with open(path, 'rb') as f:
+        for address in (FIRMWARE_ADDRESS, APP_ADDRESS):
+            f.seek(address - FIRMWARE_ADDRESS)
+            try:
+                image = ESP32FirmwareImage(f)
+            except (FatalError, struct.error, TypeError):
+                return False
+            if image.checksum != image.calculate_checksum():
+                return False
+            if image.append_digest and image.stored_digest != image.calc_digest:
+                return False
+    return True
+
+# Download the latest SumoFirmware binary, returns the file path
+# progress gets the esptool ProgressEvents of the download
+def download_firmware(path=None, progress=None):
+    path = path or FIRMWARE_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    # Keep what has been downloaded so far, when the connection drops
+    part_path = path + '.part'
+    reporter = ProgressReporter(progress)
+    attempt = 0
+    restarted = False
+    while True:
+        try:
+            expected_sha256 = firmware_sha256()
+            # The latest SumoFirmware has been downloaded already
+            if expected_sha256 and os.path.exists(path) and file_sha256(path) == expected_sha256:
+                return path
+            size = download_resumable(SUMOFIRMWARE_URL + 'sumofirmware.bin', part_path, reporter)
+        except (OSError, http.client.HTTPException) as e:
+            attempt += 1
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            # The part is complete or stale, start over
+            if isinstance(e, urllib.error.HTTPError) and e.code == 416:
+                os.remove(part_path)
+            time.sleep(1)
+            continue
+
+        # Never flash a corrupt or tampered SumoFirmware
+        if expected_sha256:
+            intact = file_sha256(part_path) == expected_sha256
+        else:
+            intact = firmware_intact(part_path, size)
+        if intact:
+            os.replace(part_path, path)
+            return path
+        # The part can be left from an older release, download it once more from scratch
+        os.remove(part_path)
+        if restarted:
+            raise ValueError('Downloaded SumoFirmware does not match the published SHA-256 digest'
+                if expected_sha256 else 'Downloaded SumoFirmware is incomplete or corrupt')
+        restarted = True
+
+# Download url into path in chunks, continuing from what is in path already
+# Returns the size of the whole file, 0 when the server did not tell it
+def download_resumable(url, path, reporter):
+    done = os.path.getsize(path) if os.path.exists(path) else 0
+    request = urllib.request.Request(url)
+    if done:
+        request.add_header('Range', 'bytes=%d-' % done)
+    response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+
+    length = int(response.headers.get('Content-Length') or 0)
+    if done and response.status == 206:
+        # Content-Range looks like bytes 1000-4999/5000
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        total = int(total) if total.isdigit() else done + length
+        mode = 'ab'
+    else:
+        # The server ignored the range, start from the beginning
+        done = 0
+        total = length
+        mode = 'wb'
+
+    reporter.start('download', total)
+    reporter.update(done)
+    with open(path, mode) as f:
+        for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+            f.write(chunk)
+            reporter.advance(len(chunk))
+    if total and reporter.done < total:
+        raise http.client.IncompleteRead(b'', total - reporter.done)
+    reporter.finish()
+    return total
+
+# Connect to the SumoRobot and start the flasher stub
+def prepare_sumorobot(port):
+    # Reuse the settings which worked for the SumoRobot last seen on this port
+    known = registry.on_port(port)
+    baud = known.get('baud', FLASH_BAUD)
+
+    # A SumoRobot left in the flasher stub by an
+    # interrupted update is used without a reset
+    esp = ESPLoader.detect_stub(port, tuple(sorted(set([ESPLoader.ESP_ROM_BAUD, FLASH_BAUD, baud]))))
+    if esp is None:
+        esp = start_stub(port, baud, known.get('reset') == 'esp32r0_delay')
+
+    try:
+        esp.flash_set_parameters(flash_size_bytes(FLASH_SIZE))
+
+        esp.mac = ':'.join('%02x' % b for b in esp.read_mac())
+        if sumorobot_known(esp, known):
+            # Seen on this port already, only keep the USB serial latency low
+            tune_serial_port(esp._port)
+        else:
+            # Lower the USB serial latency, a few samples are enough to see the change
+            before, after = tune_latency(esp, samples=5)
+            # The baud rate has been tested by the commands so far
+            remember_sumorobot(esp, port, baud=esp._port.baudrate, round_trip_ms=round(after * 1000, 1))
+    except Exception:
+        # Do not leave the port open for the next job on this SumoRobot
+        esp._port.close()
+        raise
+    return esp
+
+# Reset the SumoRobot into the ROM loader and start the flasher stub at baud,
+# or at the ROM baud rate when nothing gets through at baud, returns the ESP
+def start_stub(port, baud, esp32r0_delay=False):
+    bauds = [baud] if baud == ESPLoader.ESP_ROM_BAUD else [baud, ESPLoader.ESP_ROM_BAUD]
+    for baud in bauds:
+        # Detect the ESP version
+        esp = ESPLoader.detect_chip(port, esp32r0_delay_first=esp32r0_delay)
+        try:
+            # Prepare for flashing, the ESP32 ROM changes
+            # the baud rate already before the stub upload
+            esp.run_stub(baud=baud)
+            esp.IS_STUB = True
+            if esp._port.baudrate != baud:
+                esp.change_baud(baud)
+            esp.STATUS_BYTES_LENGTH = 2
+            esp.FLASH_WRITE_SIZE = 0x4000
+            esp.ESP_FLASH_DEFL_BEGIN = 0x10
+            # Make sure the commands get through at the new baud rate
+            esp.read_reg(ESPLoader.UART_DATA_REG_ADDR)
+            return esp
+        except FatalError:
+            esp._port.close()
+            if baud == bauds[-1]:
+                raise
+            print('Nothing gets through at %d baud, flashing at %d baud' % (baud, bauds[-1]))
+
+# Whether the registry has the SumoRobot on this port with the settings which worked now
+def sumorobot_known(esp, known):
+    if known.get('mac') != esp.mac or known.get('baud') != esp._port.baudrate:
+        return False
+    # Not known when the flasher stub was running already
+    return esp.esp32r0_delay is None or known.get('reset') == ('esp32r0_delay' if esp.esp32r0_delay else 'default')
+
+# Remember the SumoRobot on the port and the reset which worked
+def remember_sumorobot(esp, port, **fields):
+    fields.update(
+        port=port,
+        chip=esp.get_chip_description(),
+        flash_size=DETECTED_FLASH_SIZES.get(esp.flash_id() >> 16))
+    # Not known when the flasher stub was running already
+    if esp.esp32r0_delay is not None:
+        fields['reset'] = 'esp32r0_delay' if esp.esp32r0_delay else 'default'
+    registry.update(esp.mac, **fields)
+
+# Connect again to a SumoRobot which stopped responding while flashing
+def reconnect_sumorobot(esp):
+    port = esp._port.port
+    try:
+        esp._port.close()
+    except Exception:
+        pass
+
+    for attempt in range(RECONNECT_ATTEMPTS):
+        # Give cheap USB hubs time to bring the port back
+        time.sleep(1)
+        try:
+            return prepare_sumorobot(port)
+        except Exception:
+            if attempt == RECONNECT_ATTEMPTS - 1:
+                raise
+
+# Back up the SumoRobot flash, only chunks not stored yet are read
+# progress gets the esptool ProgressEvents, coalesced to a few per second
+def backup_sumorobot(esp, progress=None):
+    backup_flash(esp, argparse.Namespace(
+        store=BACKUP_PATH,
+        address=0,
+        size=None,
+        flash_size=FLASH_SIZE,
+        progress=progress))
+
+# Rewrite the flash chunks which differ from the latest backup
+def restore_sumorobot(esp, progress=None):
+    rollback_flash(esp, argparse.Namespace(
+        store=BACKUP_PATH,
+        backup=None,
+        flash_size=FLASH_SIZE,
+        progress=progress))
+
+# Flash the SumoFirmware image or flash bundle, returns the ESP to carry on with
+# Flashing resumes from the last sector in flash when the connection drops
+def flash_firmware(esp, firmware_path, progress=None):
+    args = firmware_args(progress=progress)
+    args.bundle = shared_firmware(esp, firmware_path, args)
+    esp = write_flash(esp, args)
+    # Remember what was written and the baud rate it worked at
+    if getattr(esp, 'mac', None):
+        registry.update(esp.mac,
+            firmware=firmware_areas(args.bundle),
+            baud=esp._port.baudrate,
+            flashed=time.time())
+    return esp
+
+# Flash the SumoFirmware unless the SumoRobot has it already, returns
+# the ESP to carry on with and whether the SumoFirmware was flashed
+def update_firmware(esp, firmware_path, progress=None, force=False):
+    if not force and firmware_up_to_date(esp, firmware_path):
+        return esp, False
+    return flash_firmware(esp, firmware_path, progress), True
+
+# Whether the SumoFirmware was written last according to the registry
+# and is still in flash, one MD5 check per continuous flash area
+def firmware_up_to_date(esp, firmware_path):
+    areas = firmware_areas(shared_firmware(esp, firmware_path, firmware_args()))
+    if not getattr(esp, 'mac', None) or registry.get(esp.mac).get('firmware') != areas:
+        return False
+    return all(esp.flash_md5sum(address, size) == md5 for address, size, md5 in areas)
+
+# Whether each of the SumoRobots has the SumoFirmware in flash, their
+# MD5 checks run at the same time on one event loop instead of a thread each
+# Returns True, False or the exception raised by the check, per SumoRobot
+def check_sumorobots(esps, firmware_path):
+    async def check(esp):
+        areas = firmware_areas(shared_firmware(esp, firmware_path, firmware_args()))
+        async with AsyncESPLoader(esp) as loader:
+            for address, size, md5 in areas:
+                if await loader.flash_md5sum(address, size) != md5:
+                    return False
+            return True
+    async def check_all():
+        return await asyncio.gather(*[check(esp) for esp in esps], return_exceptions=True)
+    return asyncio.run(check_all())
+
+# Continuous flash areas of a prepared SumoFirmware as [address, size, md5] lists
+def firmware_areas(bundle):
+    areas = []
+    for part in sorted(bundle.parts, key=lambda part: part.offset):
+        if areas and areas[-1][0] + len(areas[-1][1]) == part.offset:
+            areas[-1][1] += part.image
+        else:
+            areas.append([part.offset, bytearray(part.image)])
+    return [[address, len(image), hashlib.md5(image).hexdigest()] for address, image in areas]
+
+# Compare the SumoRobot flash against the SumoFirmware image or flash bundle
+def verify_firmware(esp, firmware_path):
+    args = firmware_args(diff='no')
+    args.addr_filename = shared_firmware(esp, firmware_path, args).addr_filename()
+    verify_flash(esp, args)
+
+# esptool arguments for flashing the SumoFirmware
+def firmware_args(**kwargs):
+    return argparse.Namespace(
+        addr_filename=[],
+        bundle=None,
+        verify=False,
+        compress=None,
+        no_stub=False,
+        erase_all=False,
+        flash_mode='dio',
+        flash_size=FLASH_SIZE,
+        flash_freq='keep',
+        no_compress=False,
+        compress_jobs=0,
+        reconnect=reconnect_sumorobot,
+        **kwargs)
+
+# The SumoFirmware read, padded, hashed and compressed only once
+# and shared by all the SumoRobots being flashed at the same time
+def shared_firmware(esp, firmware_path, args):
+    stat = os.stat(firmware_path)
+    key = (os.path.abspath(firmware_path), stat.st_mtime, stat.st_size,
+        esp.CHIP_NAME, args.flash_mode, args.flash_size, args.flash_freq,
+        args.compress, args.no_compress, args.compress_jobs)
+    # The other jobs wait for the first one to prepare the SumoFirmware
+    with firmware_lock:
+        if key not in prepared_firmware:
+            with firmware_source(firmware_path) as (addr_filename, bundle):
+                bundle = prepare_flash_bundle(esp, argparse.Namespace(**dict(vars(args),
+                    addr_filename=addr_filename, bundle=bundle)))
+            prepared_firmware[key] = bundle
+            # Forget the SumoFirmware used longest ago
+            while len(prepared_firmware) > PREPARED_FIRMWARE_LIMIT:
+                prepared_firmware.popitem(last=False)
+        prepared_firmware.move_to_end(key)
+        return prepared_firmware[key]
+
+# A flash bundle carries its own addresses, a plain image goes to FIRMWARE_ADDRESS
+@contextlib.contextmanager
+def firmware_source(firmware_path):
+    if FlashBundle.is_bundle(firmware_path):
+        yield [], firmware_path
+        return
+    with open(firmware_path, 'rb') as firmware_file:
+        yield [(FIRMWARE_ADDRESS, firmware_file)], None
+
+# Reset the SumoRobot into the new firmware and release the port
+def finish_sumorobot(esp):
+    esp.hard_reset()
+    esp._port.close()
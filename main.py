@@ -16,10 +16,18 @@ Contact: silver@robokoding.com
 import os
 import sys
 import time
-import argparse
+import threading
 import traceback
 import urllib.request
-import serial.tools.list_ports
+
+# Ignore SSL
+import ssl
+ssl._create_default_https_context = ssl._create_unverified_context
+
+# Headless mode does not need PyQt5, so it starts before importing it
+if __name__ == '__main__' and '--headless' in sys.argv[1:]:
+    from lib.headless import main
+    sys.exit(main(sys.argv[1:]))
 
 # pyqt imports
 from PyQt5.QtGui import *
@@ -27,11 +35,8 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 
 # Local lib imports
-from lib.esptool import *
-
-# Ignore SSL
-import ssl
-ssl._create_default_https_context = ssl._create_unverified_context
+from lib.sumorobot import *
+from lib.scheduler import *
 
 # App versioning
 APP_VERSION = '1.0.0'
@@ -40,9 +45,8 @@ APP_TIMESTAMP = '2019.08.14 14:20'
 # App name
 APP_NAME = 'SumoManager v' + APP_VERSION
 
-# SumoFirmware and SumoManager repository URLs
+# SumoManager repository URL
 SUMOMANAGER_URL = 'https://github.com/robokoding/sumorobot-manager/releases/latest/'
-SUMOFIRMWARE_URL = 'https://github.com/robokoding/sumorobot-firmware/releases/latest/download/'
 
 # Define the resource path
 RESOURCE_PATH = 'res'
@@ -66,6 +70,7 @@ class SumoManager(QMainWindow):
     usb_dcon = pyqtSignal()
     usb_con = pyqtSignal(str)
     message = pyqtSignal(str, str)
+    progress = pyqtSignal(object)
     dialog = pyqtSignal(str, str, str)
 
     def __init__(self):
@@ -74,6 +79,9 @@ class SumoManager(QMainWindow):
 
         self.processing = None
         self.connected_port = None
+        self.backup_enabled = False
+        self.stations = load_stations()
+        self.ota_robots = load_ota_robots()
 
     def initUI(self):
         # Load the Orbitron font
@@ -98,6 +106,10 @@ class SumoManager(QMainWindow):
         self.update_btn.setCursor(QCursor(Qt.PointingHandCursor))
         self.update_btn.clicked.connect(self.button_clicked)
 
+        # Flashing progress bar
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFormat('')
+
         # Add the statusbar into a toolbar
         self.tool_bar = self.addToolBar('Main')
         self.status_bar = QStatusBar()
@@ -111,6 +123,7 @@ class SumoManager(QMainWindow):
         vbox.addWidget(self.serial_image)
         vbox.addWidget(update_label)
         vbox.addWidget(self.update_btn)
+        vbox.addWidget(self.progress_bar)
         # Wrap the layout into a widget
         main_widget = QWidget()
         main_widget.setLayout(vbox)
@@ -122,13 +135,29 @@ class SumoManager(QMainWindow):
         app_info = QAction('About SumoManager', self)
         app_info.triggered.connect(self.app_info)
         file_menu.addAction(app_info)
+        # Backup before update item
+        backup_action = QAction('Back up SumoRobot before updating', self, checkable=True)
+        backup_action.toggled.connect(self.backup_toggled)
+        file_menu.addAction(backup_action)
+        # Restore backup item
+        restore_action = QAction('Restore SumoRobot backup', self)
+        restore_action.triggered.connect(self.restore_backup)
+        file_menu.addAction(restore_action)
+        # Remote flashing stations item
+        stations_action = QAction('Remote flashing stations ...', self)
+        stations_action.triggered.connect(self.edit_stations)
+        file_menu.addAction(stations_action)
+        # Over-the-air update item
+        ota_action = QAction('Update SumoRobots over Wi-Fi ...', self)
+        ota_action.triggered.connect(self.ota_update)
+        file_menu.addAction(ota_action)
 
         # Main window style, layout and position
         with open(os.path.join(RESOURCE_PATH, 'main.qss'), 'r') as file:
             self.setStyleSheet(file.read())
         self.setWindowTitle(APP_NAME)
         self.setCentralWidget(main_widget)
-        self.setMinimumSize(400, 310)
+        self.setMinimumSize(400, 360)
         self.show()
         self.center()
         # To lose focus on the textedit field
@@ -155,6 +184,23 @@ class SumoManager(QMainWindow):
         self.status_bar.setStyleSheet(style)
         self.status_bar.showMessage(message)
 
+    @pyqtSlot(object)
+    def show_progress(self, event):
+        # No event resets the progress bar
+        if not event:
+            self.progress_bar.reset()
+            self.progress_bar.setFormat('')
+            return
+
+        text = '%p%'
+        if event.rate > 0:
+            text += f' - {event.rate / 1000:.0f} kB/s'
+        if event.eta is not None and not event.finished:
+            text += f' - {event.eta:.0f} s left'
+        self.progress_bar.setMaximum(event.total or 1)
+        self.progress_bar.setValue(event.done if event.total else 1)
+        self.progress_bar.setFormat(text)
+
     @pyqtSlot()
     @pyqtSlot(str)
     def usb_action(self, data = None):
@@ -204,6 +250,50 @@ class SumoManager(QMainWindow):
             + 'This is the SumoManager app. You can update the SumoFirmware of your '
             + 'SumoRobot with it. Please keep this app up to the date for the best possible experience.<br>', '')
 
+    def backup_toggled(self, checked):
+        self.backup_enabled = checked
+
+    def edit_stations(self, event):
+        text, ok = QInputDialog.getText(self, 'Remote flashing stations',
+            'SumoRobots shared by these computers are found too.\n'
+            + 'Stations as HOST or HOST:PORT, separated by commas:',
+            text=', '.join(self.stations))
+        if ok:
+            self.stations = [station.strip() for station in text.split(',') if station.strip()]
+            save_stations(self.stations)
+
+    def ota_update(self, event):
+        # When some thread is already processing
+        if self.processing:
+            return
+
+        text, ok = QInputDialog.getText(self, 'Update SumoRobots over Wi-Fi',
+            'SumoRobots running SumoFirmware are updated at once.\n'
+            + 'SumoRobots as HOST or HOST:PORT, separated by commas:',
+            text=', '.join(self.ota_robots))
+        if not ok:
+            return
+        self.ota_robots = [robot.strip() for robot in text.split(',') if robot.strip()]
+        save_ota_robots(self.ota_robots)
+
+        # Indicates a background thread process
+        if self.ota_robots:
+            self.processing = 'ota_update'
+
+    def restore_backup(self, event):
+        # When some thread is already processing
+        if self.processing:
+            return
+
+        #SumoRobot is not connected
+        if not self.connected_port:
+            self.show_dialog('Restoring SumoRobot backup',
+                'Please connect your SumoRobot via USB cable first.', '')
+            return
+
+        # Indicates a background thread process
+        self.processing = 'restore_backup'
+
     def update_firmware(self, event):
         # When SumoRobot is connected and update firmware is not running
         if self.connected_port and not self.processing:
@@ -218,50 +308,34 @@ class UpdateFirmware(QThread):
                 time.sleep(1)
                 continue
 
+            window.progress.emit(None)
             window.message.emit('warning', 'Downloading SumoFirmware ...')
             try:
-                # Open the SumoFirmware binary URL
-                firmware_response = urllib.request.urlopen(SUMOFIRMWARE_URL + 'sumofirmware.bin')
-
-                # Write the SumoFirmware binary into a file
-                firmware_file = QTemporaryFile()
-                firmware_file.open()
-                firmware_file.writeData(firmware_response.read())
-                firmware_file.flush()
-
-                # Detect the ESP version
-                esp = ESPLoader.detect_chip(window.connected_port)
-
-                # Prepare for flashing
-                esp.run_stub()
-                esp.IS_STUB = True
-                esp.change_baud(115200)
-                esp.STATUS_BYTES_LENGTH = 2
-                esp.flash_set_parameters(flash_size_bytes('4MB'))
-                esp.FLASH_WRITE_SIZE = 0x4000
-                esp.ESP_FLASH_DEFL_BEGIN = 0x10
-
-                # Callback to show flashing progress in percentage
-                def show_progress(percentage):
-                    window.message.emit('warning', f'Flashing SumoFirmware ... {percentage}%')
-
-                # Flash the SumoFirmware image
-                write_flash(esp, argparse.Namespace(
-                    addr_filename=[(0x1000, open(firmware_file.fileName(), 'rb'))],
-                    verify=False,
-                    compress=None,
-                    no_stub=False,
-                    erase_all=False,
-                    flash_mode='dio',
-                    flash_size='4MB',
-                    flash_freq='keep',
-                    no_compress=False,
-                    callback=show_progress))
-                esp.hard_reset()
-                esp._port.close()
+                # Callback to show the download progress
+                def download_progress(event):
+                    window.message.emit('warning', f'Downloading SumoFirmware ... {event.percent}%')
+                    window.progress.emit(event)
+
+                # Resumes an interrupted download and checks the SumoFirmware hash
+                firmware_path = download_firmware(progress=download_progress)
+
+                esp = prepare_sumorobot(window.connected_port)
+
+                # Only the flash chunks not backed up yet are read
+                if window.backup_enabled:
+                    window.message.emit('warning', 'Backing up SumoRobot ...')
+                    backup_sumorobot(esp, window.progress.emit)
+
+                # Flash the SumoFirmware image, unless it is there already
+                window.message.emit('warning', 'Flashing SumoFirmware ...')
+                esp, flashed = update_firmware(esp, firmware_path, window.progress.emit)
+                finish_sumorobot(esp)
 
                 # All done
-                window.message.emit('info', 'Successfully updated SumoFirmware')
+                if flashed:
+                    window.message.emit('info', 'Successfully updated SumoFirmware')
+                else:
+                    window.message.emit('info', 'SumoFirmware is already up to date')
             except:
                 window.dialog.emit('Error updating SumoFirmware',
                     '* Check your Internet connection<br>'
@@ -273,6 +347,106 @@ class UpdateFirmware(QThread):
             # Indicate that no process is running
             window.processing = None
 
+class RestoreBackup(QThread):
+    def run(self):
+        while True:
+            # Wait until restore backup process is triggered
+            if window.processing != 'restore_backup':
+                time.sleep(1)
+                continue
+
+            window.progress.emit(None)
+            window.message.emit('warning', 'Restoring SumoRobot backup ...')
+            try:
+                esp = prepare_sumorobot(window.connected_port)
+
+                # Rewrite the flash chunks which differ from the latest backup
+                restore_sumorobot(esp, window.progress.emit)
+                finish_sumorobot(esp)
+
+                # All done
+                window.message.emit('info', 'Successfully restored SumoRobot backup')
+            except:
+                window.dialog.emit('Error restoring SumoRobot backup',
+                    '* Check that this SumoRobot has been backed up before<br>'
+                    + '* Try reconnecting the SumoRobot USB cable<br>'
+                    + '* Finally try Restore SumoRobot backup again',
+                    traceback.format_exc())
+                window.message.emit('error', 'Error restoring SumoRobot backup')
+
+            # Indicate that no process is running
+            window.processing = None
+
+class OTAUpdate(QThread):
+    def run(self):
+        while True:
+            # Wait until over-the-air update process is triggered
+            if window.processing != 'ota_update':
+                time.sleep(1)
+                continue
+
+            window.progress.emit(None)
+            window.message.emit('warning', 'Downloading SumoFirmware ...')
+            try:
+                # Callback to show the download progress
+                def download_progress(event):
+                    window.message.emit('warning', f'Downloading SumoFirmware ... {event.percent}%')
+                    window.progress.emit(event)
+
+                firmware_path = download_firmware(progress=download_progress)
+
+                # The progress bar shows all the SumoRobots together
+                robots = window.ota_robots
+                size = len(ota_image(firmware_path))
+                reporter = ProgressReporter(window.progress.emit)
+                reporter.start('ota', size * len(robots))
+                sent = {}
+                lock = threading.Lock()
+                def job_event(job, event, fields):
+                    with lock:
+                        if event == 'progress':
+                            sent[job.id] = fields['done']
+                        elif event in ('done', 'failed'):
+                            sent[job.id] = size
+                        reporter.update(sum(sent.values()))
+                    finished = sum(job.state in ('done', 'failed') for job in scheduler.jobs)
+                    window.message.emit('warning',
+                        f'Updating SumoRobots over Wi-Fi ... {finished}/{len(robots)}')
+
+                window.message.emit('warning', 'Updating SumoRobots over Wi-Fi ...')
+                scheduler = Scheduler(min(len(robots), OTA_JOBS), on_event=job_event)
+                scheduler.start()
+                for robot in robots:
+                    scheduler.submit('ota', robot, firmware_path=firmware_path)
+                scheduler.join()
+                scheduler.stop()
+                reporter.finish()
+
+                # Report every SumoRobot when some failed
+                failed = [job for job in scheduler.jobs if job.state == 'failed']
+                updated = [job for job in scheduler.jobs if job.flashed]
+                if failed:
+                    window.dialog.emit('Error updating SumoRobots over Wi-Fi',
+                        ''.join(f'{job.port}: ' + ('failed' if job.state == 'failed'
+                            else 'updated' if job.flashed else 'already up to date') + '<br>'
+                            for job in scheduler.jobs)
+                        + '<br>* Check that the failed SumoRobots are switched on and connected to the Wi-Fi<br>'
+                        + '* Finally try Update SumoRobots over Wi-Fi again',
+                        '\n'.join(job.details for job in failed))
+                    window.message.emit('error', f'Error updating {len(failed)}/{len(robots)} SumoRobots over Wi-Fi')
+                else:
+                    window.message.emit('info', f'Successfully updated {len(updated)} SumoRobots over Wi-Fi, '
+                        + f'{len(robots) - len(updated)} already up to date')
+            except:
+                window.dialog.emit('Error updating SumoRobots over Wi-Fi',
+                    '* Check your Internet connection<br>'
+                    + '* Finally try Update SumoRobots over Wi-Fi again',
+                    traceback.format_exc())
+                window.message.emit('error', 'Error updating SumoRobots over Wi-Fi')
+
+            # Indicate that no process is running
+            window.processing = None
+
 class PortUpdate(QThread):
     # To update serialport status
     def run(self):
@@ -280,17 +454,9 @@ class PortUpdate(QThread):
             # Wait for a second to pass
             time.sleep(1)
 
-            port = None
-            # Scan the serialports with specific vendor ID
-            # TODO: implement with USB event
-            for p in serial.tools.list_ports.comports():
-                # When vendor ID was found
-                # Different SumoRobot versions have a
-                # different USB to UART IC hardware ID
-                # Jiangsu Haoheng CH304 IC
-                if '1A86:' in p.hwid or '10C4:' in p.hwid:
-                    port = p.device
-                    break
+            # Scan the serialports with specific vendor ID and the remote stations
+            ports = find_sumorobots(window.stations)
+            port = ports[0] if ports else None
 
             # When specific vendor ID was found and it's a new port
             if port and port != window.connected_port:
@@ -313,14 +479,24 @@ if __name__ == '__main__':
     window.usb_con.connect(window.usb_action)
     window.usb_dcon.connect(window.usb_action)
     window.message.connect(window.show_message)
+    window.progress.connect(window.show_progress)
 
     # Start port update thread
-    port_update = PortUpdate()
-    port_update.start()
+    port_update_thread = PortUpdate()
+    port_update_thread.start()
 
     # Start the update firmware thread
-    update_firmware = UpdateFirmware()
-    update_firmware.start()
+    # The thread globals must not shadow the lib.sumorobot functions
+    update_firmware_thread = UpdateFirmware()
+    update_firmware_thread.start()
+
+    # Start the restore backup thread
+    restore_backup_thread = RestoreBackup()
+    restore_backup_thread.start()
+
+    # Start the over-the-air update thread
+    ota_update_thread = OTAUpdate()
+    ota_update_thread.start()
 
     # Check for a newer version of this application
     response = urllib.request.urlopen(SUMOMANAGER_URL)
@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Fake ESP32 SumoRobot for the tests
+
+FakeESP speaks the serial protocol of the ESP32 ROM loader
+and of the flasher stub, behind the auto reset circuit of a
+SumoRobot. Devices are opened by URL like real serial ports,
+fakeesp://NAME, so esptool, the stations and the scheduler
+all run unchanged:
+
+    robot = FakeESP('robot')
+    esp = ESPLoader.detect_chip(robot.url)
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import time
+import zlib
+import struct
+import hashlib
+import threading
+
+import serial
+
+# Local lib imports
+from lib.esptool import ESPLoader
+
+# fakeesp:// URLs are opened by tests/protocol_fakeesp.py
+if 'tests' not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append('tests')
+
+# The devices by name, the ports find their device here
+devices = {}
+
+ROM_BAUD = 115200
+UART_DATA_REG_ADDR = 0x60000078
+DATE_REG_VALUE = 0x15122500
+EFUSE_REG_BASE = 0x6001a000
+SPI_REG_BASE = 0x60002000
+# JEDEC ID of a 4MB Winbond flash chip
+FLASH_ID = 0x1640ef
+
+def slip(packet):
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+class FakeESP:
+    """
+    An ESP32 with flash_size bytes of flash. It starts in the ROM
+    loader, or in the flasher stub when stub is set. Above max_baud
+    the serial link loses everything. fail_block=(offset, seq) drops
+    the response to that compressed flash block once, drop_every
+    shortens every nth read flash frame.
+    """
+    def __init__(self, name, flash_size=0x400000, stub=False, mac=b'\x24\x0a\xc4\x00\x00\x01',
+            max_baud=None, fail_block=None, drop_every=None):
+        self.name = name
+        self.url = 'fakeesp://' + name
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.mode = 'stub' if stub else 'rom'
+        self.baud = ROM_BAUD
+        self.max_baud = max_baud
+        self.fail_block = fail_block
+        self.drop_every = drop_every
+        high, low = struct.unpack('>HI', mac)
+        # Other registers read 0, so SPI flash commands are done at once
+        self.registers = {UART_DATA_REG_ADDR: DATE_REG_VALUE, EFUSE_REG_BASE + 4: low, EFUSE_REG_BASE + 8: high}
+        self.dtr = False
+        self.rts = False
+        self.received = bytearray()
+        self.out = bytearray()
+        self.condition = threading.Condition()
+        # Every command op received, and the bytes the stub had in flight at most
+        self.commands = []
+        self.most_in_flight = 0
+        self.frames = 0
+        self.reading = None
+        self.writing = None
+        devices[name] = self
+
+    # The auto reset circuit: RTS resets, DTR held while booting enters the loader
+    def set_lines(self, dtr, rts):
+        with self.condition:
+            if rts and not self.rts:
+                self.mode = 'reset'
+            elif self.rts and not rts:
+                self.mode = 'rom' if dtr else 'app'
+                self.baud = ROM_BAUD
+                self.reading = self.writing = None
+                self.received = bytearray()
+            self.dtr, self.rts = dtr, rts
+
+    # Bytes sent by the host at baud
+    def receive(self, data, baud):
+        with self.condition:
+            if self.mode in ('reset', 'app') or baud != self.baud or (self.max_baud and baud > self.max_baud):
+                return
+            self.received += data
+            while True:
+                start = self.received.find(b'\xc0')
+                end = self.received.find(b'\xc0', start + 1)
+                if start < 0 or end < 0:
+                    break
+                frame = bytes(self.received[start + 1:end]).replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+                del self.received[:end + 1]
+                if frame:
+                    self.handle(frame)
+            self.condition.notify_all()
+
+    # Bytes for the host, waits up to timeout for them
+    def send(self, size, timeout):
+        end = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while not self.out:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return b''
+                self.condition.wait(remaining)
+            data = bytes(self.out[:size])
+            del self.out[:size]
+            return data
+
+    def reply(self, op, val=0, data=b'', error=0):
+        status = bytes([1 if error else 0, error]) + (b'\0\0' if self.mode == 'rom' else b'')
+        body = data + status
+        self.out += slip(struct.pack('<BBHI', 1, op, len(body), val) + body)
+
+    def handle(self, frame):
+        if self.reading is not None and len(frame) == 4:
+            self.reading['acked'] = struct.unpack('<I', frame)[0]
+            self.send_read_frames()
+            return
+        op, length, checksum = struct.unpack('<xBHI', frame[:8])
+        data = frame[8:]
+        self.commands.append(op)
+        stub = self.mode == 'stub'
+
+        if op == 0x08:
+            # The ROM loader answers a sync eight times, the stub once
+            for i in range(1 if stub else 8):
+                self.reply(op, 0 if stub else 0x20120707)
+        elif op == 0x0a:
+            address, = struct.unpack('<I', data[:4])
+            self.reply(op, self.registers.get(address, 0))
+        elif op == 0x09:
+            address, value, mask, delay = struct.unpack('<IIII', data[:16])
+            self.registers[address] = value
+            if address == SPI_REG_BASE:
+                # The SPI flash command is done at once, the ID is read to W0
+                self.registers[address] = 0
+                if self.registers.get(SPI_REG_BASE + 0x24, 0) & 0xff == 0x9f:
+                    self.registers[SPI_REG_BASE + 0x80] = FLASH_ID
+            self.reply(op)
+        elif op == 0x0f:
+            # Answered at the old baud rate
+            self.reply(op)
+            self.baud, = struct.unpack('<I', data[:4])
+        elif op == 0x05:
+            self.reply(op)
+        elif op == 0x07:
+            self.reply(op)
+        elif op == 0x06:
+            self.reply(op)
+            self.mode = 'stub'
+            self.out += slip(b'OHAI')
+        elif op == 0x13:
+            address, size = struct.unpack('<II', data[:8])
+            digest = hashlib.md5(bytes(self.flash[address:address + size]))
+            self.reply(op, data=digest.digest() if stub else digest.hexdigest().encode())
+        elif op in (0x02, 0x10):
+            size, blocks, block_size, offset = struct.unpack('<IIII', data[:16])
+            self.writing = {'offset': offset, 'position': offset,
+                'inflate': zlib.decompressobj() if op == 0x10 else None}
+            self.reply(op)
+        elif op in (0x03, 0x11):
+            size, seq = struct.unpack('<II', data[:8])
+            if self.fail_block == (self.writing['offset'], seq):
+                # Lost on the way, the host times out
+                self.fail_block = None
+                return
+            block = data[16:16 + size]
+            if self.writing['inflate']:
+                block = self.writing['inflate'].decompress(block)
+            position = self.writing['position']
+            self.flash[position:position + len(block)] = block
+            self.writing['position'] += len(block)
+            self.reply(op)
+        elif op in (0x04, 0x12):
+            self.reply(op)
+            if not struct.unpack('<I', data[:4])[0]:
+                self.mode = 'app'
+        elif op in (0xd0, 0xd1, 0xd2) and not stub:
+            # Only the stub has these
+            self.reply(op, error=5)
+        elif op == 0xd0:
+            self.flash[:] = b'\xff' * len(self.flash)
+            self.reply(op)
+        elif op == 0xd1:
+            offset, size = struct.unpack('<II', data[:8])
+            self.flash[offset:offset + size] = b'\xff' * size
+            self.reply(op)
+        elif op == 0xd2:
+            offset, size, block_size, max_unacked = struct.unpack('<IIII', data[:16])
+            self.reply(op)
+            self.reading = {'offset': offset, 'size': size, 'block_size': block_size,
+                'max_unacked': max_unacked, 'sent': 0, 'acked': 0}
+            self.send_read_frames()
+        else:
+            self.reply(op)
+
+    # Like the stub, send while fewer than max_unacked bytes are not acknowledged
+    def send_read_frames(self):
+        r = self.reading
+        while r['sent'] < r['size'] and r['sent'] - r['acked'] < r['max_unacked']:
+            size = min(r['block_size'], r['size'] - r['sent'])
+            start = r['offset'] + r['sent']
+            frame = bytes(self.flash[start:start + size])
+            self.frames += 1
+            if self.drop_every and self.frames % self.drop_every == 0:
+                frame = frame[:-1]
+            self.out += slip(frame)
+            r['sent'] += size
+            self.most_in_flight = max(self.most_in_flight, r['sent'] - r['acked'])
+        if r['acked'] >= r['size']:
+            self.out += slip(hashlib.md5(bytes(self.flash[r['offset']:r['offset'] + r['size']])).digest())
+            self.reading = None
+
+    def close(self):
+        devices.pop(self.name, None)
+
+# Reset the device into the ROM loader and start the flasher stub, returns the stub loader
+def connect_stub(device):
+    return ESPLoader.detect_chip(device.url).run_stub()
+
+class Serial(serial.SerialBase):
+    """ A serial port with a FakeESP on the other end """
+    def open(self):
+        if self._port is None:
+            raise serial.SerialException('Port must be configured before it can be used.')
+        if self.is_open:
+            raise serial.SerialException('Port is already open.')
+        name = self._port[len('fakeesp://'):]
+        if name not in devices:
+            raise serial.SerialException('could not open port %s: no such device' % self._port)
+        self.device = devices[name]
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def _reconfigure_port(self, force_update=False):
+        pass
+
+    @property
+    def in_waiting(self):
+        return len(self.device.out)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        data = bytearray()
+        end = None if self._timeout is None else time.time() + self._timeout
+        while len(data) < size:
+            remaining = None if end is None else max(0, end - time.time())
+            chunk = self.device.send(size - len(data), remaining)
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        self.device.receive(bytes(data), self._baudrate)
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self.device.condition:
+            self.device.out.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def _update_dtr_state(self):
+        if self.is_open:
+            self.device.set_lines(self._dtr_state, self._rts_state)
+
+    def _update_rts_state(self):
+        if self.is_open:
+            self.device.set_lines(self._dtr_state, self._rts_state)
+
+    @property
+    def cts(self):
+        return False
+
+    @property
+    def dsr(self):
+        return False
+
+    @property
+    def ri(self):
+        return False
+
+    @property
+    def cd(self):
+        return False
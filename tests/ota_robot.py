@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in SumoRobot for over-the-air updates
+
+Serves the SumoFirmware update protocol of lib/ota.py on
+localhost, so the updates can be tried without SumoRobots:
+
+    python3 -m tests.ota_robot --count 30
+
+starts 30 SumoRobots on the ports after 18000. They can
+then be updated with python3 main.py --headless --ota ...
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import http.server
+
+# Local lib imports
+from lib.ota import *
+
+class OTARobot:
+    """
+    A SumoRobot running SumoFirmware with an update server. The
+    written app image only runs after a reboot, which takes
+    boot_time seconds. A corrupt SumoRobot damages what it writes,
+    a rollback SumoRobot boots its old app image again.
+    """
+    def __init__(self, mac, running=b'', host='127.0.0.1', port=0,
+            boot_time=0.2, corrupt=False, rollback=False):
+        self.mac = mac
+        self.running = running
+        self.written = None
+        self.booted = 0
+        self.boot_time = boot_time
+        self.corrupt = corrupt
+        self.rollback = rollback
+        self.requests = []
+        self.server = http.server.ThreadingHTTPServer((host, port), OTAHandler)
+        self.server.daemon_threads = True
+        self.server.robot = self
+        self.address = '%s:%d' % self.server.server_address[:2]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def booting(self):
+        return time.time() < self.booted + self.boot_time
+
+    def status(self):
+        return {'mac': self.mac, 'md5': hashlib.md5(self.running).hexdigest(), 'size': len(self.running)}
+
+    # Write the app image sent, answers what was written
+    def write(self, image, md5):
+        if image[:1] != bytes([ESPLoader.ESP_IMAGE_MAGIC]):
+            return 400, {'error': 'not an app image'}
+        if hashlib.md5(image).hexdigest() != md5:
+            return 400, {'error': 'MD5 does not match'}
+        self.written = image[:-1] + b'\0' if self.corrupt else image
+        return 200, {'md5': hashlib.md5(self.written).hexdigest(), 'size': len(self.written)}
+
+    def reboot(self):
+        if self.written is None:
+            return 409, {'error': 'nothing written'}
+        if not self.rollback:
+            self.running = self.written
+        self.written = None
+        self.booted = time.time()
+        return 200, {}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class OTAHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, code, message):
+        data = json.dumps(message).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_one_request(self):
+        # Rebooting SumoRobots are not on the Wi-Fi
+        if self.server.robot.booting():
+            self.close_connection = True
+            return
+        super().handle_one_request()
+
+    def do_GET(self):
+        self.server.robot.requests.append(('GET', self.path))
+        if self.path != '/ota':
+            return self.answer(404, {'error': 'not found'})
+        self.answer(200, self.server.robot.status())
+
+    def do_PUT(self):
+        self.server.robot.requests.append(('PUT', self.path))
+        if self.path != '/ota' or 'Content-Length' not in self.headers:
+            return self.answer(400, {'error': 'PUT /ota takes the app image with its length'})
+        # Read in chunks, as the flash is written
+        image = bytearray()
+        length = int(self.headers['Content-Length'])
+        while len(image) < length:
+            chunk = self.rfile.read(min(OTA_CHUNK_SIZE, length - len(image)))
+            if not chunk:
+                return
+            image += chunk
+        self.answer(*self.server.robot.write(bytes(image), self.headers.get('X-MD5')))
+
+    def do_POST(self):
+        self.server.robot.requests.append(('POST', self.path))
+        if self.path != '/ota/reboot':
+            return self.answer(404, {'error': 'not found'})
+        self.answer(*self.server.robot.reboot())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m tests.ota_robot',
+        description='Stand-in SumoRobots for over-the-air updates')
+    parser.add_argument('--count', type=int, default=1,
+        help='Number of SumoRobots (default: 1)')
+    parser.add_argument('--port', type=int, default=18000,
+        help='HTTP port of the first SumoRobot, the others get the next ones (default: 18000)')
+    args = parser.parse_args(argv)
+
+    robots = [OTARobot('02:00:00:00:%02x:%02x' % (i >> 8, i & 0xff), port=args.port + i)
+        for i in range(args.count)]
+    print(' '.join('--ota ' + robot.address for robot in robots))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    sys.exit(main())
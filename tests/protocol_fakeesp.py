@@ -0,0 +1,12 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+pyserial URL handler for fakeesp://NAME, see tests/fake_esp.py
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+from tests.fake_esp import Serial
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Flash backup and rollback tests
+
+Backs up fake SumoRobots into a chunk store and rolls
+them back, counting what goes over the serial port.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import argparse
+import tempfile
+import contextlib
+import unittest
+
+# Local lib imports
+from lib.esptool import *
+from tests.fake_esp import FakeESP, connect_stub
+
+CHUNK = FlashChunkStore.CHUNK_SIZE
+
+class BackupTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = directory.name
+        self.data = os.urandom(0x100000)
+
+    def device(self, name, mac):
+        device = FakeESP(name, flash_size=0x100000, mac=mac)
+        self.addCleanup(device.close)
+        device.flash[:] = self.data
+        esp = connect_stub(device)
+        self.addCleanup(esp._port.close)
+        return device, esp
+
+    # Bytes read back from the device by the operation
+    def run_counting(self, device, operation, esp, **kwargs):
+        read = []
+        read_flash = esp.read_flash
+        def counting_read_flash(offset, length, *args, **read_kwargs):
+            read.append(length)
+            return read_flash(offset, length, *args, **read_kwargs)
+        esp.read_flash = counting_read_flash
+        del device.commands[:]
+        with contextlib.redirect_stdout(io.StringIO()):
+            operation(esp, argparse.Namespace(store=self.store, flash_size='1MB', **kwargs))
+        return sum(read)
+
+    def backup(self, device, esp):
+        return self.run_counting(device, backup_flash, esp, address=0, size=None)
+
+    def rollback(self, device, esp, backup=None):
+        return self.run_counting(device, rollback_flash, esp, backup=backup)
+
+    def test_deduplicated(self):
+        first, first_esp = self.device('backup-1', b'\x24\x0a\xc4\x00\x00\x01')
+        self.assertEqual(self.backup(first, first_esp), len(self.data))
+
+        # The same chunks of another SumoRobot are not read or stored again
+        second, second_esp = self.device('backup-2', b'\x24\x0a\xc4\x00\x00\x02')
+        second.flash[0x80010:0x80020] = b'\x00' * 16
+        self.assertEqual(self.backup(second, second_esp), CHUNK)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(os.path.join(self.store, 'chunks'))),
+            len(self.data) // CHUNK + 1)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.store, 'backups'))), ['240ac4000001', '240ac4000002'])
+
+    def test_rollback(self):
+        device, esp = self.device('rollback', b'\x24\x0a\xc4\x00\x00\x03')
+        self.backup(device, esp)
+        device.flash[0x10000:0x10004] = b'abcd'
+        device.flash[0xf0000] ^= 0xff
+        self.rollback(device, esp)
+        self.assertEqual(bytes(device.flash), self.data)
+        # Only the two changed chunks were written
+        self.assertEqual(device.commands.count(ESPLoader.ESP_FLASH_DEFL_BEGIN), 2)
+
+        # Nothing to do when the flash matches the backup
+        self.rollback(device, esp)
+        self.assertNotIn(ESPLoader.ESP_FLASH_DEFL_BEGIN, device.commands)
+
+    def test_missing(self):
+        device, esp = self.device('missing', b'\x24\x0a\xc4\x00\x00\x04')
+        with self.assertRaises(FatalError):
+            self.rollback(device, esp)
+        self.backup(device, esp)
+        with self.assertRaises(FatalError):
+            self.rollback(device, esp, backup='19700101-000000')
+
+    def test_corrupt_chunk(self):
+        device, esp = self.device('corrupt', b'\x24\x0a\xc4\x00\x00\x05')
+        self.backup(device, esp)
+        for directory, _, files in os.walk(os.path.join(self.store, 'chunks')):
+            for name in files:
+                with open(os.path.join(directory, name), 'r+b') as f:
+                    f.write(b'\x00')
+        device.flash[0] ^= 0xff
+        # Never writes a damaged chunk into the flash
+        with self.assertRaises(FatalError):
+            self.rollback(device, esp)
+        self.assertNotIn(ESPLoader.ESP_FLASH_DEFL_BEGIN, device.commands)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Flash bundle tests
+
+Makes bundles with the esptool command line and writes
+them to a fake SumoRobot (tests/fake_esp.py) in one
+loader session.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.sumorobot
+from lib.sumorobot import *
+from tests.fake_esp import FakeESP
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Bootloader, partition table and app image
+        self.parts = [(0x1000, b'\xe9\x03\x00\x20' + os.urandom(0x4ffc)), (0x8000, os.urandom(0xc00)),
+            (0x10000, b'\xe9' + os.urandom(0x20002))]
+        self.files = []
+        for address, image in self.parts:
+            self.files += ['0x%x' % address, os.path.join(self.directory, '0x%x.bin' % address)]
+            with open(self.files[-1], 'wb') as f:
+                f.write(image)
+        self.bundle_path = os.path.join(self.directory, 'sumofirmware.zip')
+        main(['make_bundle', self.bundle_path] + self.files)
+
+        self.robot = FakeESP('bundle')
+        self.addCleanup(self.robot.close)
+
+    def flashed(self, address, size):
+        return bytes(self.robot.flash[address:address + size])
+
+    def test_bundle(self):
+        bundle = FlashBundle.load(self.bundle_path)
+        self.assertEqual([(part.offset, part.image) for part in bundle.parts],
+            [(address, pad_to(image, 4)) for address, image in self.parts])
+        self.assertTrue(FlashBundle.is_bundle(self.bundle_path))
+        self.assertFalse(FlashBundle.is_bundle(self.files[1]))
+
+    def test_write(self):
+        main(['--port', self.robot.url, 'write_flash', '--flash_mode', 'dio', '--bundle', self.bundle_path])
+        # One stub upload, then every part
+        self.assertEqual(self.robot.commands.count(ESPLoader.ESP_MEM_END), 1)
+        self.assertEqual(self.robot.commands.count(ESPLoader.ESP_FLASH_DEFL_BEGIN), 3)
+        # The bootloader header gets the flash mode, the rest is written as is
+        bootloader = self.parts[0][1]
+        self.assertEqual(self.flashed(0x1000, len(bootloader)), bootloader[:2] + b'\x02' + bootloader[3:])
+        for address, image in self.parts[1:]:
+            self.assertEqual(self.flashed(address, len(image)), image)
+
+    def test_extra_image(self):
+        # Images given on the command line are written in the same session
+        extra = os.path.join(self.directory, 'extra.bin')
+        with open(extra, 'wb') as f:
+            f.write(b'sumo' * 0x100)
+        main(['--port', self.robot.url, 'write_flash', '--bundle', self.bundle_path, '0x300000', extra])
+        self.assertEqual(self.robot.commands.count(ESPLoader.ESP_FLASH_DEFL_BEGIN), 4)
+        self.assertEqual(self.flashed(0x300000, 0x400), b'sumo' * 0x100)
+
+    def test_corrupt(self):
+        # Rewrite one part with a payload which does not match its digest
+        corrupt_path = os.path.join(self.directory, 'corrupt.zip')
+        with zipfile.ZipFile(self.bundle_path) as source, zipfile.ZipFile(corrupt_path, 'w') as corrupt:
+            for name in source.namelist():
+                data = source.read(name)
+                corrupt.writestr(name, zlib.compress(b'\x00' * 0xc00) if name == 'part1.zlib' else data)
+        with self.assertRaises(FatalError):
+            main(['--port', self.robot.url, 'write_flash', '--bundle', corrupt_path])
+        self.assertNotIn(ESPLoader.ESP_FLASH_DEFL_BEGIN, self.robot.commands)
+
+    def test_sumorobot(self):
+        # The SumoManager flow takes a bundle in place of the SumoFirmware binary
+        with mock.patch.object(lib.sumorobot, 'registry', Registry(os.path.join(self.directory, 'sumorobots.json'))):
+            esp = prepare_sumorobot(self.robot.url)
+            self.addCleanup(esp._port.close)
+            esp, flashed = update_firmware(esp, self.bundle_path)
+            self.assertTrue(flashed)
+            # Three continuous flash areas, each checked with one MD5 next time
+            self.assertEqual([area[:2] for area in lib.sumorobot.registry.get(esp.mac)['firmware']],
+                [[address, len(pad_to(image, 4))] for address, image in self.parts])
+            self.assertEqual(update_firmware(esp, self.bundle_path)[1], False)
+            verify_firmware(esp, self.bundle_path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoManager daemon tests
+
+Sends JSON-RPC commands over the Unix socket of a daemon
+flashing fake SumoRobots (tests/fake_esp.py).
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import json
+import stat
+import time
+import base64
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.daemon
+import lib.sumorobot
+from lib.daemon import *
+from tests.fake_esp import FakeESP
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(directory.name, 'sumomanager.sock')
+        self.firmware = os.urandom(0x8000)
+        self.firmware_path = os.path.join(directory.name, 'sumofirmware.bin')
+        with open(self.firmware_path, 'wb') as f:
+            f.write(self.firmware)
+
+        patcher = mock.patch.object(lib.sumorobot, 'registry', Registry(os.path.join(directory.name, 'sumorobots.json')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.robots = []
+        for i in range(2):
+            self.robots.append(FakeESP('daemon-%d' % i, mac=b'\x24\x0a\xc4\x00\x02' + bytes([i])))
+            self.addCleanup(self.robots[-1].close)
+        patcher = mock.patch.object(lib.daemon, 'list_sumorobots', lambda stations: [(robot.url, None) for robot in self.robots])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self, firmware_path=None):
+        server = listen(self.path, firmware_path)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.sumo_daemon.close)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def connect(self):
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(self.path)
+        self.addCleanup(client.close)
+        return client.makefile('rwb')
+
+    # Send a request, returns the progress notifications and the response
+    def call(self, connection, method, **params):
+        connection.write(json.dumps({'jsonrpc': '2.0', 'id': 7, 'method': method, 'params': params}).encode() + b'\n')
+        connection.flush()
+        notifications = []
+        while True:
+            message = json.loads(connection.readline().decode())
+            if 'id' in message:
+                return notifications, message
+            notifications.append(message)
+
+    def test_commands(self):
+        self.start(self.firmware_path)
+        connection = self.connect()
+        port = self.robots[0].url
+
+        notifications, response = self.call(connection, 'flash', port=port)
+        self.assertEqual(response['result']['flashed'], True)
+        self.assertTrue(notifications)
+        self.assertEqual(set(n['method'] for n in notifications), {'progress'})
+        self.assertEqual(bytes(self.robots[0].flash[FIRMWARE_ADDRESS:FIRMWARE_ADDRESS + len(self.firmware)]), self.firmware)
+
+        # The stub keeps running between the commands
+        stub_uploads = self.robots[0].commands.count(ESPLoader.ESP_MEM_END)
+        self.assertEqual(self.call(connection, 'flash', port=port)[1]['result']['flashed'], False)
+        self.assertTrue(self.call(connection, 'verify', port=port)[1]['result']['ok'])
+        result = self.call(connection, 'md5', port=port, address=FIRMWARE_ADDRESS, size=len(self.firmware))[1]['result']
+        self.assertEqual(result['md5'], hashlib.md5(self.firmware).hexdigest())
+        result = self.call(connection, 'read', port=port, address=FIRMWARE_ADDRESS, size=0x1000)[1]['result']
+        self.assertEqual(base64.b64decode(result['data']), self.firmware[:0x1000])
+        self.assertEqual(self.robots[0].commands.count(ESPLoader.ESP_MEM_END), stub_uploads)
+
+        status = self.call(connection, 'status')[1]['result']
+        self.assertEqual(status['detected'], [{'port': robot.url, 'hub': None} for robot in self.robots])
+        self.assertEqual([(s['port'], s['connected']) for s in status['sessions']], [(port, True)])
+
+        # Every SumoRobot checked at once, one is not flashed
+        result = self.call(connection, 'check', ports=[robot.url for robot in self.robots] + ['fakeesp://unplugged'])[1]['result']
+        self.assertEqual([robot.get('ok') for robot in result['sumorobots']], [True, False, None])
+        self.assertIn('error', result['sumorobots'][2])
+
+        self.call(connection, 'reset', port=port)
+        self.assertEqual(self.robots[0].mode, 'app')
+
+    def test_errors(self):
+        self.start(self.firmware_path)
+        connection = self.connect()
+        connection.write(b'{"jsonrpc": \n')
+        connection.flush()
+        self.assertEqual(json.loads(connection.readline().decode())['error']['code'], PARSE_ERROR)
+        self.assertEqual(self.call(connection, 'format')[1]['error']['code'], METHOD_NOT_FOUND)
+        self.assertEqual(self.call(connection, 'flash', address=0)[1]['error']['code'], INVALID_PARAMS)
+        response = self.call(connection, 'flash', port='fakeesp://unplugged')[1]
+        self.assertEqual(response['error']['code'], COMMAND_FAILED)
+        self.assertIn('Traceback', response['error']['data']['details'])
+        # The connection carries on after errors
+        self.assertIn('result', self.call(connection, 'status')[1])
+
+    def test_socket(self):
+        self.start()
+        # Only the user can connect
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode) & 0o077, 0)
+        # The socket of a running daemon is left alone
+        with self.assertRaises(FileExistsError):
+            listen(self.path)
+
+    def test_stale_socket(self):
+        # Left behind by a daemon which did not stop cleanly
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(self.path)
+        stale.close()
+        self.start()
+        self.assertIn('result', self.call(self.connect(), 'status')[1])
+
+        other = os.path.join(self.directory, 'other')
+        with open(other, 'w') as f:
+            f.write('not a socket')
+        with self.assertRaises(FileExistsError):
+            listen(other)
+
+    def test_one_download(self):
+        # Without a SumoFirmware given, the latest one is downloaded once at a time
+        running = []
+        most = []
+        def download_firmware(path, progress):
+            running.append(1)
+            most.append(len(running))
+            time.sleep(0.2)
+            running.pop()
+            return self.firmware_path
+        self.start()
+        with mock.patch.object(lib.daemon, 'download_firmware', download_firmware):
+            threads = [threading.Thread(target=self.call, args=(self.connect(), 'flash'), kwargs={'port': robot.url})
+                for robot in self.robots]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(max(most), 1)
+        for robot in self.robots:
+            self.assertEqual(bytes(robot.flash[FIRMWARE_ADDRESS:FIRMWARE_ADDRESS + len(self.firmware)]), self.firmware)
+
+if __name__ == '__main__':
+    unittest.main()
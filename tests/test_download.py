@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoFirmware download tests
+
+Downloads from a release server on localhost which
+drops connections, serves stale or tampered files and
+leaves out the published SHA-256 digest.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import hashlib
+import tempfile
+import threading
+import http.server
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.sumorobot
+from lib.sumorobot import *
+
+class ReleaseHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        name = self.path.lstrip('/')
+        server.requests.append((name, self.headers.get('Range')))
+        if server.failures.get(name):
+            server.failures[name] -= 1
+            self.send_error(503)
+            return
+        if name not in server.files:
+            self.send_error(404)
+            return
+        data = server.files[name]
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        # Drop the connection after some of the SumoFirmware
+        if name == 'sumofirmware.bin' and server.drops:
+            server.drops -= 1
+            self.wfile.write(data[start:start + server.drop_after])
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+# A SumoFirmware binary with valid bootloader and app images
+def firmware_binary():
+    directory = tempfile.TemporaryDirectory()
+    with directory:
+        images = []
+        for address in (0x40080000, 0x40090000):
+            image = ESP32FirmwareImage()
+            image.entrypoint = address + 4
+            image.segments = [ImageSegment(address, os.urandom(0x3000))]
+            image.save(os.path.join(directory.name, 'image.bin'))
+            with open(os.path.join(directory.name, 'image.bin'), 'rb') as f:
+                images.append(f.read())
+    bootloader, app = images
+    return bootloader + b'\xff' * (APP_ADDRESS - FIRMWARE_ADDRESS - len(bootloader)) + app
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'sumofirmware.bin')
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ReleaseHandler)
+        self.server.requests = []
+        self.server.failures = {}
+        self.server.drops = 0
+        self.server.drop_after = 0x4000
+        self.publish(firmware_binary())
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        for name, value in (('SUMOFIRMWARE_URL', 'http://127.0.0.1:%d/' % self.server.server_port),
+                ('DOWNLOAD_CHUNK_SIZE', 0x1000)):
+            patcher = mock.patch.object(lib.sumorobot, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # No waiting between the attempts
+        patcher = mock.patch.object(lib.sumorobot.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def publish(self, firmware, sha256=True):
+        self.firmware = firmware
+        self.server.files = {'sumofirmware.bin': firmware}
+        if sha256:
+            digest = hashlib.sha256(firmware).hexdigest()
+            self.server.files['sumofirmware.bin.sha256'] = (digest + '  sumofirmware.bin\n').encode()
+
+    # Ranges of the SumoFirmware requests
+    def ranges(self):
+        return [header for name, header in self.server.requests if name == 'sumofirmware.bin']
+
+    def check(self):
+        self.assertEqual(download_firmware(self.path), self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.firmware)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_resume(self):
+        self.server.drops = 2
+        events = []
+        self.assertEqual(download_firmware(self.path, events.append), self.path)
+        self.assertEqual(self.ranges(), [None, 'bytes=16384-', 'bytes=32768-'])
+        self.assertEqual(events[-1].done, len(self.firmware))
+        self.check()
+        # Downloaded already, only the digest is fetched
+        self.assertEqual(self.ranges(), [None, 'bytes=16384-', 'bytes=32768-'])
+
+    def test_digest_retried(self):
+        # The digest is fetched again with the other attempts
+        self.server.failures['sumofirmware.bin.sha256'] = DOWNLOAD_ATTEMPTS - 1
+        self.check()
+        self.server.failures['sumofirmware.bin.sha256'] = DOWNLOAD_ATTEMPTS
+        with self.assertRaises(urllib.error.HTTPError):
+            download_firmware(self.path)
+
+    def test_stale_part(self):
+        # Left from an older release, the new one does not match after resuming
+        with open(self.path + '.part', 'wb') as f:
+            f.write(os.urandom(0x8000))
+        self.check()
+        self.assertEqual(self.ranges(), ['bytes=32768-', None])
+
+        # Complete already, the server refuses the range
+        os.remove(self.path)
+        with open(self.path + '.part', 'wb') as f:
+            f.write(os.urandom(len(self.firmware)))
+        self.check()
+        self.assertEqual(self.ranges()[2:], ['bytes=%d-' % len(self.firmware), None])
+
+    def test_tampered(self):
+        self.publish(self.firmware)
+        self.server.files['sumofirmware.bin'] = os.urandom(len(self.firmware))
+        with self.assertRaises(ValueError):
+            download_firmware(self.path)
+        # Downloaded once more from scratch before giving up
+        self.assertEqual(self.ranges(), [None, None])
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_no_digest(self):
+        self.publish(self.firmware, sha256=False)
+        self.server.drops = 1
+        self.check()
+
+        # Damaged app image
+        firmware = bytearray(self.firmware)
+        firmware[APP_ADDRESS - FIRMWARE_ADDRESS + 0x100] ^= 0xff
+        self.publish(bytes(firmware), sha256=False)
+        os.remove(self.path)
+        with self.assertRaises(ValueError):
+            download_firmware(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+asyncio ESPLoader tests
+
+Drives several fake SumoRobots (tests/fake_esp.py) from
+one event loop. Their ports have no file descriptor, so
+the transport runs on its reader and writer threads.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import struct
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.sumorobot
+from lib.sumorobot import *
+from lib.esptool_async import AsyncESPLoader
+from tests.fake_esp import FakeESP, connect_stub
+
+class AsyncLoaderTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def robot(self, name):
+        robot = FakeESP(name)
+        self.addCleanup(robot.close)
+        esp = connect_stub(robot)
+        self.addCleanup(esp._port.close)
+        return robot, esp
+
+    def test_read_write(self):
+        robots = [self.robot('async-%d' % i) for i in range(3)]
+        images = [os.urandom(0x9000) for robot in robots]
+        async def run(esp, image):
+            async with AsyncESPLoader(esp) as loader:
+                await loader.write_flash(0x10000, image)
+                await loader.finish_write_flash()
+                return await loader.read_flash(0x10000, len(image))
+        async def run_all():
+            return await asyncio.gather(*[run(esp, image) for (robot, esp), image in zip(robots, images)])
+        self.assertEqual(asyncio.run(run_all()), images)
+        for (robot, esp), image in zip(robots, images):
+            self.assertEqual(bytes(robot.flash[0x10000:0x10000 + len(image)]), image)
+            # The stub keeps sending while half of its byte window is acknowledged
+            self.assertEqual(robot.most_in_flight, len(image))
+            # The port is back with the synchronous loader
+            self.assertEqual(esp.flash_md5sum(0x10000, len(image)), hashlib.md5(image).hexdigest())
+
+    def test_timeout(self):
+        robot, esp = self.robot('async-timeout')
+        async def run():
+            async with AsyncESPLoader(esp) as loader:
+                # Reset into the app, nothing answers
+                robot.mode = 'app'
+                await loader.command(loader.ESP_READ_REG, struct.pack('<I', 0), timeout=0.2)
+        with self.assertRaises(FatalError):
+            asyncio.run(run())
+
+class CheckTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.firmware = os.urandom(0x8000)
+        self.firmware_path = os.path.join(directory.name, 'sumofirmware.bin')
+        with open(self.firmware_path, 'wb') as f:
+            f.write(self.firmware)
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_check(self):
+        esps = []
+        for i in range(4):
+            robot = FakeESP('check-%d' % i)
+            self.addCleanup(robot.close)
+            robot.flash[FIRMWARE_ADDRESS:FIRMWARE_ADDRESS + len(self.firmware)] = self.firmware
+            if i == 1:
+                robot.flash[FIRMWARE_ADDRESS + 0x4000] ^= 0xff
+            esps.append(connect_stub(robot))
+            self.addCleanup(esps[-1]._port.close)
+        # Dropped off the USB
+        esps[2]._port.close()
+        results = check_sumorobots(esps, self.firmware_path)
+        self.assertEqual(results[:2], [True, False])
+        self.assertIsInstance(results[2], Exception)
+        self.assertEqual(results[3], True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Firmware image tests
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import struct
+import hashlib
+import tempfile
+import contextlib
+import unittest
+from unittest import mock
+
+# Local lib imports
+from lib.esptool import *
+
+# Deterministic segment data
+def pattern(seed, size):
+    return bytes((i * seed + (i >> 8)) & 0xff for i in range(size))
+
+# An Xtensa ELF file with the entry point and PROGBITS sections [(name, address, data)]
+def build_elf(entrypoint, sections):
+    names = b'\0' + b''.join(name.encode() + b'\0' for name, _, _ in sections) + b'.shstrtab\0'
+    body = bytearray()
+    headers = [struct.pack('<10L', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)]
+    name_offs = 1
+    for name, address, data in sections:
+        headers.append(struct.pack('<10L', name_offs, ELFFile.SEC_TYPE_PROGBITS, 0, address,
+            0x34 + len(body), len(data), 0, 0, 4, 0))
+        name_offs += len(name) + 1
+        body += data
+    headers.append(struct.pack('<10L', name_offs, ELFFile.SEC_TYPE_STRTAB, 0, 0,
+        0x34 + len(body), len(names), 0, 0, 1, 0))
+    body += names
+    header = struct.pack('<16sHHLLLLLHHHHHH', b'\x7fELF\x01\x01\x01' + bytes(9), 2, 0x5e, 1,
+        entrypoint, 0, 0x34 + len(body), 0, 0x34, 0, 0, ELFFile.LEN_SEC_HEADER, len(headers), len(headers) - 1)
+    return header + bytes(body) + b''.join(headers)
+
+class ESP32SaveTest(unittest.TestCase):
+    # SHA-256 and size of the images saved by ESP32FirmwareImage.save
+    # before it streamed the segments, for (append_digest, secure_pad)
+    SAVED = {
+        (True, False): ('deb7ea796ccad7be2080f62fc04bfa6986be7ad32b0a2b6f93ba92643e8ca701', 147232),
+        (False, False): ('d0d552d8d6bbe460f945f642e53c54cf842113808d1d09225aa77f33f97bd8de', 147200),
+        (True, True): ('5e92858c9c64dfe8495fc6848fa7c68b67f6b3b162ce4e22f223d7479c316fec', 196528),
+    }
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'image.bin')
+
+    def image(self, append_digest, secure_pad):
+        image = ESP32FirmwareImage()
+        image.entrypoint = 0x40080404
+        image.flash_mode = 2
+        image.flash_size_freq = 0x20
+        image.append_digest = append_digest
+        image.secure_pad = secure_pad
+        # Flash mapped DROM and IROM, RAM segments to pad them with
+        for seed, (addr, size) in enumerate([(0x3f400020, 0x5004), (0x400d0018, 0x12340),
+                (0x3ffb0000, 0x3100), (0x40080000, 0x9a48), (0x40078000, 0x20)], 3):
+            image.segments.append(ImageSegment(addr, pattern(seed, size)))
+        return image
+
+    def test_byte_identical(self):
+        for options, (sha256, size) in self.SAVED.items():
+            image = self.image(*options)
+            segments = [(s.addr, bytes(s.data)) for s in image.segments]
+            image.save(self.path)
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            self.assertEqual((hashlib.sha256(data).hexdigest(), len(data)), (sha256, size), options)
+            # Saving leaves the segments alone
+            self.assertEqual([(s.addr, bytes(s.data)) for s in image.segments], segments)
+
+    def test_load(self):
+        self.image(True, False).save(self.path)
+        with open(self.path, 'rb') as f:
+            image = ESP32FirmwareImage(f)
+        self.assertEqual(image.stored_digest, image.calc_digest)
+        self.assertEqual(image.entrypoint, 0x40080404)
+        # The flash mapped segments on their 64kB aligned offsets
+        for segment in image.segments:
+            if image.is_flash_addr(segment.addr):
+                self.assertEqual((segment.file_offs + image.SEG_HEADER_LEN) % image.IROM_ALIGN, segment.addr % image.IROM_ALIGN)
+
+class ESP8266ImageTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.elf_path = os.path.join(self.directory, 'sumofirmware.elf')
+        self.sections = [('.text', 0x40100000, pattern(3, 0x1234)), ('.data', 0x3ffe8000, pattern(5, 0x310)),
+            ('.irom0.text', 0x40210000, pattern(7, 0x5678))]
+        with open(self.elf_path, 'wb') as f:
+            f.write(build_elf(0x40100004, self.sections))
+        patcher = mock.patch.object(ELFFile, 'CACHE_DIR', os.path.join(self.directory, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def elf2image(self, *options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            main(['--chip', 'esp8266', 'elf2image'] + list(options) + [self.elf_path])
+
+    def test_elf(self):
+        elf = ELFFile(self.elf_path)
+        self.assertEqual(elf.entrypoint, 0x40100004)
+        self.assertEqual([(s.name, s.addr, bytes(s.data)) for s in elf.sections], self.sections)
+        with open(self.elf_path, 'rb') as f:
+            self.assertEqual(elf.sha256(), hashlib.sha256(f.read()).digest())
+
+    def test_elf_cache(self):
+        sha256 = ELFFile(self.elf_path, use_cache=True).sha256()
+        # Parsed and hashed once, unchanged files come from the cache
+        with mock.patch.object(ELFFile, '_read_elf_file', side_effect=AssertionError), \
+                mock.patch.object(hashlib, 'sha256', side_effect=AssertionError):
+            elf = ELFFile(self.elf_path, use_cache=True)
+            self.assertEqual(elf.sha256(), sha256)
+        self.assertEqual([(s.name, s.addr, bytes(s.data)) for s in elf.sections], self.sections)
+
+        # Changed files are parsed again
+        with open(self.elf_path, 'wb') as f:
+            f.write(build_elf(0x40100008, self.sections[:2]))
+        elf = ELFFile(self.elf_path, use_cache=True)
+        self.assertEqual((elf.entrypoint, len(elf.sections)), (0x40100008, 2))
+
+    def check_images(self, path):
+        images = [LoadFirmwareImage('esp8266', path, use_mmap=use_mmap) for use_mmap in (False, True)]
+        plain, mapped = [[(s.addr, bytes(s.data)) for s in image.segments] for image in images]
+        self.assertEqual(mapped, plain)
+        self.assertEqual(images[1].entrypoint, 0x40100004)
+        self.assertEqual(images[1].checksum, images[1].calculate_checksum())
+        return images[1]
+
+    def test_v1(self):
+        prefix = os.path.join(self.directory, 'v1-')
+        self.elf2image('--version', '1', '-o', prefix)
+        image = self.check_images(prefix + '0x00000.bin')
+        self.assertEqual([(s.addr, bytes(s.data)) for s in image.segments], [(a, d) for _, a, d in self.sections[:2]])
+        with open(prefix + '0x10000.bin', 'rb') as f:
+            self.assertEqual(f.read(), self.sections[2][2])
+
+    def test_v2(self):
+        path = os.path.join(self.directory, 'v2.bin')
+        self.elf2image('--version', '2', '-o', path)
+        image = self.check_images(path)
+        self.assertEqual(bytes(image.segments[0].data[:len(self.sections[2][2])]), self.sections[2][2])
+
+    def test_empty(self):
+        path = os.path.join(self.directory, 'empty.bin')
+        open(path, 'wb').close()
+        with self.assertRaises(FatalError):
+            LoadFirmwareImage('esp8266', path, use_mmap=True)
+
+class BatchElf2ImageTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.manifest = os.path.join(self.directory, 'manifest.json')
+        self.inputs = []
+        for i in range(3):
+            self.inputs.append(os.path.join(self.directory, 'app%d.elf' % i))
+            with open(self.inputs[-1], 'wb') as f:
+                f.write(build_elf(0x40080404, [('.iram0.text', 0x40080000, pattern(i + 3, 0x400 * (i + 1)))]))
+
+    def elf2image(self, *inputs):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            main(['--chip', 'esp32', 'elf2image', '--jobs', '2', '--manifest', self.manifest] + list(inputs))
+        return output.getvalue()
+
+    def test_batch(self):
+        self.assertIn('3 image(s) converted, 0 up to date', self.elf2image(*self.inputs))
+        for path in self.inputs:
+            self.assertTrue(os.path.exists(path[:-len('.elf')] + '.bin'))
+
+        # Only the changed ELF file is converted again
+        with open(self.inputs[1], 'wb') as f:
+            f.write(build_elf(0x40080408, [('.iram0.text', 0x40080000, pattern(9, 0x400))]))
+        self.assertIn('1 image(s) converted, 2 up to date', self.elf2image(*self.inputs))
+
+    def test_duplicates(self):
+        # The same input given twice is converted once
+        output = self.elf2image(self.inputs[0], os.path.relpath(self.inputs[0]), self.inputs[1])
+        self.assertIn('2 image(s) converted, 0 up to date', output)
+
+        # Both would be saved as app0.bin
+        other = self.inputs[0][:-len('.elf')] + '.out'
+        with open(self.inputs[0], 'rb') as f, open(other, 'wb') as copy:
+            copy.write(f.read())
+        with self.assertRaises(FatalError):
+            self.elf2image(self.inputs[0], other)
+
+    def test_failures(self):
+        missing = os.path.join(self.directory, 'missing.elf')
+        broken = os.path.join(self.directory, 'broken.elf')
+        with open(broken, 'wb') as f:
+            f.write(b'\x7fELF' + bytes(0x100))
+        output = io.StringIO()
+        with self.assertRaises(FatalError) as raised, contextlib.redirect_stdout(output):
+            main(['--chip', 'esp32', 'elf2image', '--jobs', '2', missing, broken] + self.inputs)
+        self.assertIn('Failed to convert 2 ELF file(s)', str(raised.exception))
+        # The other ELF files are converted anyway
+        self.assertIn('3 image(s) converted', output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Over-the-air update tests
+
+Updates stand-in SumoRobots (tests/ota_robot.py) on
+localhost, one at a time and in parallel.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import hashlib
+import collections
+import tempfile
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.ota
+from lib.scheduler import *
+from tests.ota_robot import OTARobot
+
+# A SumoFirmware binary as flashed over USB: bootloader, partition table and app image
+def firmware_binary(app):
+    image = bytearray(b'\xff' * (OTA_APP_ADDRESS - FIRMWARE_ADDRESS))
+    image[:0x2000] = b'\xe9' + b'\x01' * 0x1fff
+    image[0x8000 - FIRMWARE_ADDRESS:0x8002 - FIRMWARE_ADDRESS] = b'\xaa\x50'
+    return bytes(image) + app
+
+class OTATest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.app = b'\xe9' + os.urandom(0x30000)
+        self.firmware_path = os.path.join(directory.name, 'sumofirmware.bin')
+        with open(self.firmware_path, 'wb') as f:
+            f.write(firmware_binary(self.app))
+
+        # Keep the registry of the user out of the tests
+        patcher = mock.patch.object(lib.ota, 'registry', Registry(os.path.join(directory.name, 'sumorobots.json')))
+        self.registry = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def robot(self, **kwargs):
+        robot = OTARobot('02:00:00:00:00:%02x' % len(kwargs), b'\xe9old', **kwargs)
+        self.addCleanup(robot.close)
+        return robot
+
+    def test_app_image(self):
+        self.assertEqual(ota_image(self.firmware_path), self.app)
+
+        # Only SumoFirmware binaries with an app image go over the air
+        with open(self.firmware_path, 'wb') as f:
+            f.write(firmware_binary(b'\x00' + self.app[1:]))
+        with self.assertRaises(ValueError):
+            ota_image(self.firmware_path)
+
+    def test_update(self):
+        robot = self.robot()
+        events = []
+        self.assertTrue(ota_update(robot.address, self.firmware_path, events.append))
+        self.assertEqual(robot.running, self.app)
+        self.assertEqual(events[-1].done, len(self.app))
+        self.assertEqual(self.registry.get(robot.mac)['ota_md5'], hashlib.md5(self.app).hexdigest())
+
+        # Running the SumoFirmware already
+        del robot.requests[:]
+        self.assertFalse(ota_update(robot.address, self.firmware_path))
+        self.assertEqual(robot.requests, [('GET', '/ota')])
+        self.assertTrue(ota_update(robot.address, self.firmware_path, force=True))
+
+    def test_corrupt(self):
+        robot = self.robot(corrupt=True)
+        with self.assertRaises(ValueError):
+            ota_update(robot.address, self.firmware_path)
+        # Never rebooted into the damaged app image
+        self.assertEqual(robot.running, b'\xe9old')
+        self.assertNotIn(('POST', '/ota/reboot'), robot.requests)
+
+    def test_rollback(self):
+        robot = self.robot(rollback=True)
+        with mock.patch.object(lib.ota, 'OTA_BOOT_TIMEOUT', 2):
+            with self.assertRaises(FatalError):
+                ota_update(robot.address, self.firmware_path)
+
+    def test_unreachable(self):
+        robot = self.robot()
+        robot.close()
+        with self.assertRaises(OSError):
+            ota_update(robot.address, self.firmware_path)
+
+    def test_parallel(self):
+        robots = [self.robot() for i in range(8)]
+        robots.append(self.robot(corrupt=True))
+        progress = collections.defaultdict(list)
+        def on_event(job, event, fields):
+            if event == 'progress':
+                progress[job.port].append(fields['done'])
+
+        scheduler = Scheduler(len(robots), on_event=on_event)
+        scheduler.start()
+        for robot in robots:
+            scheduler.submit('ota', robot.address, firmware_path=self.firmware_path)
+        scheduler.join()
+        scheduler.stop()
+
+        states = [(job.state, job.flashed) for job in scheduler.jobs]
+        self.assertEqual(states, [('done', True)] * 8 + [('failed', None)])
+        for robot in robots[:8]:
+            self.assertEqual(robot.running, self.app)
+            self.assertEqual(progress[robot.address][-1], len(self.app))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+read_flash window tests
+
+The fake flasher stub counts its window in bytes, as the
+real one does, and only sends while the window has room.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import time
+import unittest
+
+# Local lib imports
+from lib.esptool import *
+from tests.fake_esp import FakeESP, connect_stub
+
+class ReadFlashTest(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeESP('read-flash')
+        self.addCleanup(self.device.close)
+        self.data = os.urandom(0x80000)
+        self.device.flash[:len(self.data)] = self.data
+        self.esp = connect_stub(self.device)
+        self.addCleanup(self.esp._port.close)
+
+    def test_default_window(self):
+        started = time.time()
+        self.assertEqual(self.esp.read_flash(0, len(self.data)), self.data)
+        # Never waiting for an acknowledgement until the timeout
+        self.assertLess(time.time() - started, DEFAULT_TIMEOUT)
+        # Half of the window is acknowledged at a time, so the stub keeps sending
+        self.assertEqual(self.device.most_in_flight,
+            self.esp.READ_FLASH_BLOCK_SIZE * self.esp.READ_FLASH_MAX_IN_FLIGHT)
+
+    def test_window(self):
+        for block_size, max_in_flight in ((0x800, 8), (0x1000, 1), (0x100, 3)):
+            self.device.most_in_flight = 0
+            self.assertEqual(self.esp.read_flash(0x100, 0x2345, block_size=block_size,
+                max_in_flight=max_in_flight), self.data[0x100:0x2445])
+            self.assertLessEqual(self.device.most_in_flight, block_size * max_in_flight)
+
+    def test_progress(self):
+        progress = []
+        self.esp.read_flash(0, 0x10000, lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress[-1], (0x10000, 0x10000))
+        self.assertEqual(progress, sorted(progress))
+
+    def test_adaptive(self):
+        # Every 50th frame is cut short, the adaptive read shrinks its window and retries
+        self.device.drop_every = 50
+        self.assertEqual(self.esp.read_flash(0, len(self.data), adaptive=True), self.data)
+        with self.assertRaises(FatalError):
+            self.esp.read_flash(0, len(self.data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoRobot registry tests
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+# Local lib imports
+from lib.registry import *
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'sumomanager', 'sumorobots.json')
+
+    def test_update(self):
+        registry = Registry(self.path)
+        self.assertEqual(registry.get('24:0a:c4:00:00:01'), {})
+        robot = registry.update('24:0a:c4:00:00:01', port='/dev/ttyUSB0', baud=460800)
+        self.assertEqual((robot['mac'], robot['port'], robot['baud']), ('24:0a:c4:00:00:01', '/dev/ttyUSB0', 460800))
+        self.assertLessEqual(robot['first_seen'], robot['last_seen'])
+
+        # Fields are added to, first_seen is kept
+        first_seen = robot['first_seen']
+        robot = registry.update('24:0a:c4:00:00:01', baud=115200)
+        self.assertEqual((robot['port'], robot['baud']), ('/dev/ttyUSB0', 115200))
+        self.assertEqual(robot['first_seen'], first_seen)
+
+        # Copies, changing them leaves the registry alone
+        registry.get('24:0a:c4:00:00:01')['baud'] = 0
+        self.assertEqual(registry.get('24:0a:c4:00:00:01')['baud'], 115200)
+
+    def test_on_port(self):
+        registry = Registry(self.path)
+        with mock.patch('time.time', return_value=1):
+            registry.update('24:0a:c4:00:00:01', port='/dev/ttyUSB0')
+        with mock.patch('time.time', return_value=2):
+            registry.update('24:0a:c4:00:00:02', port='/dev/ttyUSB0')
+            registry.update('24:0a:c4:00:00:03', port='/dev/ttyUSB1')
+        # The SumoRobot seen there last
+        self.assertEqual(registry.on_port('/dev/ttyUSB0')['mac'], '24:0a:c4:00:00:02')
+        self.assertEqual(registry.on_port('/dev/ttyUSB2'), {})
+
+    def test_persistence(self):
+        Registry(self.path).update('24:0a:c4:00:00:01', port='/dev/ttyUSB0')
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertEqual(Registry(self.path).get('24:0a:c4:00:00:01')['port'], '/dev/ttyUSB0')
+        with open(self.path) as f:
+            self.assertIn('24:0a:c4:00:00:01', json.load(f))
+
+    def test_damaged(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{"24:0a:c4:00:00:01": {"po')
+        # Started over
+        registry = Registry(self.path)
+        self.assertEqual(registry.get('24:0a:c4:00:00:01'), {})
+        registry.update('24:0a:c4:00:00:02', port='/dev/ttyUSB0')
+        self.assertEqual(list(Registry(self.path)._load()), ['24:0a:c4:00:00:02'])
+
+if __name__ == '__main__':
+    unittest.main()
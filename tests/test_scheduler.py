@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Flashing station scheduler tests
+
+Flashes fake SumoRobots (tests/fake_esp.py) on the
+scheduler worker threads, checking the port and USB hub
+limits from the job events.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import tempfile
+import threading
+import collections
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.sumorobot
+from lib.scheduler import *
+from tests.fake_esp import FakeESP, connect_stub
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.firmware = os.urandom(0x20000)
+        self.firmware_path = os.path.join(directory.name, 'sumofirmware.bin')
+        with open(self.firmware_path, 'wb') as f:
+            f.write(self.firmware)
+
+        # Keep the registry of the user out of the tests
+        patcher = mock.patch.object(lib.sumorobot, 'registry', Registry(os.path.join(directory.name, 'sumorobots.json')))
+        self.registry = patcher.start()
+        self.addCleanup(patcher.stop)
+        # esptool prints from every worker thread
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Jobs running per port and per hub, and the most at once
+        self.lock = threading.Lock()
+        self.running = collections.Counter()
+        self.most = collections.Counter()
+        self.events = collections.defaultdict(list)
+
+    def robots(self, count):
+        robots = []
+        for i in range(count):
+            robot = FakeESP('scheduler-%d' % i, mac=b'\x24\x0a\xc4\x00\x01' + bytes([i]))
+            self.addCleanup(robot.close)
+            robots.append(robot)
+        return robots
+
+    def on_event(self, job, event, fields):
+        with self.lock:
+            self.events[job.id].append(event)
+            for key in (job.port, ('hub', job.hub)):
+                if event == 'started':
+                    self.running[key] += 1
+                    self.most[key] = max(self.most[key], self.running[key])
+                elif event in ('done', 'failed'):
+                    self.running[key] -= 1
+
+    def run_jobs(self, jobs, workers=4, **kwargs):
+        scheduler = Scheduler(workers, on_event=self.on_event, **kwargs)
+        scheduler.start()
+        for kind, port, hub in jobs:
+            scheduler.submit(kind, port, hub, firmware_path=self.firmware_path)
+        self.assertTrue(scheduler.join(60))
+        scheduler.stop()
+        return scheduler.jobs
+
+    def test_flash(self):
+        robots = self.robots(3)
+        jobs = self.run_jobs([('flash', robot.url, None) for robot in robots])
+        self.assertEqual([(job.state, job.flashed) for job in jobs], [('done', True)] * 3)
+        for robot, job in zip(robots, jobs):
+            self.assertEqual(bytes(robot.flash[FIRMWARE_ADDRESS:FIRMWARE_ADDRESS + len(self.firmware)]), self.firmware)
+            self.assertEqual(self.events[job.id][:2], ['queued', 'started'])
+            self.assertIn('progress', self.events[job.id])
+            self.assertEqual(self.events[job.id][-1], 'done')
+            self.assertEqual(self.registry.on_port(robot.url)['firmware'][0][0], FIRMWARE_ADDRESS)
+
+        # Up to date SumoRobots are not flashed again, but verify
+        jobs = self.run_jobs([('flash', robot.url, None) for robot in robots] +
+            [('verify', robot.url, None) for robot in robots])
+        self.assertEqual([(job.state, job.flashed) for job in jobs], [('done', False)] * 3 + [('done', None)] * 3)
+
+    def test_leases(self):
+        robots = self.robots(2)
+        # One job at a time per port, and per hub with a hub limit
+        jobs = self.run_jobs([('flash', robot.url, 'hub') for robot in robots] * 2 +
+            [('verify', robots[0].url, 'other')], hub_limit=1)
+        self.assertEqual([job.state for job in jobs], ['done'] * 5)
+        self.assertEqual(self.most[robots[0].url], 1)
+        self.assertEqual(self.most[('hub', 'hub')], 1)
+
+    def test_failed(self):
+        robots = self.robots(2)
+        robots[1].flash[FIRMWARE_ADDRESS] ^= 0xff
+        jobs = self.run_jobs([('flash', 'fakeesp://unplugged', None), ('verify', robots[1].url, None),
+            ('flash', robots[0].url, None)])
+        self.assertEqual([job.state for job in jobs], ['failed', 'failed', 'done'])
+        self.assertTrue(all(job.error and job.details for job in jobs[:2]))
+
+class SharedFirmwareTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(lib.sumorobot, 'prepared_firmware', collections.OrderedDict())
+        self.prepared = patcher.start()
+        self.addCleanup(patcher.stop)
+        robot = FakeESP('shared')
+        self.addCleanup(robot.close)
+        self.esp = connect_stub(robot)
+        self.addCleanup(self.esp._port.close)
+
+    def firmware(self, name):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(0x1000))
+        return path
+
+    # firmware_args with other settings
+    def args(self, **kwargs):
+        args = firmware_args()
+        vars(args).update(kwargs)
+        return args
+
+    def test_compression(self):
+        path = self.firmware('sumofirmware.bin')
+        bundle = shared_firmware(self.esp, path, self.args())
+        self.assertIs(shared_firmware(self.esp, path, self.args()), bundle)
+        # Prepared again for other compression settings
+        uncompressed = shared_firmware(self.esp, path, self.args(no_compress=True))
+        self.assertIsNot(uncompressed, bundle)
+        self.assertIsNot(shared_firmware(self.esp, path, self.args(compress_jobs=2)), bundle)
+        self.assertIs(shared_firmware(self.esp, path, self.args(no_compress=True)), uncompressed)
+
+    def test_least_recently_used(self):
+        paths = [self.firmware('sumofirmware-%d.bin' % i) for i in range(PREPARED_FIRMWARE_LIMIT + 1)]
+        bundles = [shared_firmware(self.esp, path, firmware_args()) for path in paths[:-1]]
+        # The first one is used again, the second one is forgotten for the new one
+        self.assertIs(shared_firmware(self.esp, paths[0], firmware_args()), bundles[0])
+        shared_firmware(self.esp, paths[-1], firmware_args())
+        self.assertEqual(len(self.prepared), PREPARED_FIRMWARE_LIMIT)
+        self.assertEqual([key[0] for key in self.prepared], paths[2:-1] + paths[:1] + paths[-1:])
+        self.assertIs(shared_firmware(self.esp, paths[0], firmware_args()), bundles[0])
+        self.assertIsNot(shared_firmware(self.esp, paths[1], firmware_args()), bundles[1])
+
+if __name__ == '__main__':
+    unittest.main()
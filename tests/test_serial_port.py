@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Serial port tuning tests
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.esptool
+from lib.esptool import *
+from tests.fake_esp import FakeESP, connect_stub
+
+class LowLatencyPort:
+    """ A local serial port whose driver keeps the low latency flag, or ignores it """
+    def __init__(self, port, keeps=True):
+        self.port = port
+        self.keeps = keeps
+        self.low_latency = False
+        self.calls = 0
+
+    def set_low_latency_mode(self, low_latency):
+        self.calls += 1
+        self.low_latency = low_latency and self.keeps
+
+class TuneSerialPortTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(lib.esptool, 'serial_low_latency', lambda port: port.low_latency)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_changed_once(self):
+        port = LowLatencyPort('/dev/null')
+        self.assertEqual(tune_serial_port(port), ['low latency mode'])
+        # Tuned already
+        self.assertEqual(tune_serial_port(port), [])
+        self.assertEqual(port.calls, 1)
+
+    def test_not_kept(self):
+        port = LowLatencyPort('/dev/null', keeps=False)
+        self.assertEqual(tune_serial_port(port), [])
+        self.assertEqual(port.calls, 1)
+
+    def test_not_local(self):
+        for url in ('rfc2217://localhost:4000', 'socket://localhost:4000', 'loop://', 'fakeesp://robot'):
+            port = LowLatencyPort(url)
+            self.assertEqual(tune_serial_port(port), [])
+            self.assertEqual(port.calls, 0)
+
+    def test_tune_latency(self):
+        robot = FakeESP('tune-latency')
+        self.addCleanup(robot.close)
+        with mock.patch('sys.stdout', io.StringIO()) as stdout:
+            esp = connect_stub(robot)
+            before, after = tune_latency(esp, samples=3)
+        esp._port.close()
+        # Nothing to tune, measured once
+        self.assertEqual(before, after)
+        self.assertIn('tuned already or not possible', stdout.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Remote flashing station tests
+
+Runs a station on localhost sharing a pyserial loop://
+port as its SumoRobot and talks to it over RFC 2217, the
+same way a SumoManager on another computer does.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import time
+import tempfile
+import socket
+import threading
+import unittest
+from unittest import mock
+
+import serial
+
+# Local lib imports
+import lib.station
+import lib.sumorobot
+from lib.station import *
+from tests.fake_esp import FakeESP
+
+# Wait for condition() to become true, the station works on its own threads
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.05)
+    return True
+
+# A free TCP port on localhost, the station takes the next one too
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class StationTest(unittest.TestCase):
+    def setUp(self):
+        # The station shares a loop:// port instead of the plugged in SumoRobots
+        patcher = mock.patch.object(lib.station, 'list_sumorobots', lambda: [('loop://', '1-1')])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Keep the station side of the loop:// ports to check what reaches them
+        self.devices = []
+        serial_for_url = serial.serial_for_url
+        def station_port(url, *args, **kwargs):
+            port = serial_for_url(url, *args, **kwargs)
+            if url == 'loop://':
+                self.devices.append(port)
+            return port
+        patcher = mock.patch.object(serial, 'serial_for_url', station_port)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.port = free_port()
+        self.station = Station('127.0.0.1', self.port)
+        self.addCleanup(self.station.close)
+        threading.Thread(target=self.station.serve, daemon=True).start()
+        self.assertTrue(wait_for(lambda: self.station.robots))
+        self.url = 'rfc2217://127.0.0.1:%d' % self.station.robots['loop://'].port
+
+    def connect(self):
+        client = serial.serial_for_url(self.url, baudrate=115200, timeout=2)
+        self.addCleanup(client.close)
+        return client
+
+    def leased(self):
+        return self.station.index()['robots'][0]['leased']
+
+    def test_index(self):
+        robots = station_sumorobots('127.0.0.1:%d' % self.port)
+        self.assertEqual(robots, [(self.url, '127.0.0.1/1-1')])
+        self.assertEqual(list_sumorobots(['127.0.0.1:%d' % self.port])[-1], (self.url, '127.0.0.1/1-1'))
+
+    def test_round_trip(self):
+        client = self.connect()
+        client.write(b'\xc0sync\xc0' * 100)
+        self.assertEqual(client.read(600), b'\xc0sync\xc0' * 100)
+
+        # Baud rate and the reset lines reach the SumoRobot port
+        client.baudrate = 460800
+        client.dtr = False
+        client.rts = True
+        device = self.devices[0]
+        self.assertTrue(wait_for(lambda: device.baudrate == 460800))
+        self.assertTrue(wait_for(lambda: not device.dtr and device.rts))
+
+    def test_lease(self):
+        self.connect()
+        self.assertTrue(wait_for(self.leased))
+
+        # Other SumoManagers are turned away while the SumoRobot is leased
+        host, port = self.url[len('rfc2217://'):].split(':')
+        with socket.create_connection((host, int(port)), 2) as other:
+            other.settimeout(STATION_LEASE_WAIT + 2)
+            self.assertEqual(other.recv(1), b'')
+
+    def test_release(self):
+        client = self.connect()
+        self.assertTrue(wait_for(self.leased))
+        client.close()
+        self.assertTrue(wait_for(lambda: not self.leased()))
+
+        # The next SumoManager gets the SumoRobot
+        client = self.connect()
+        client.write(b'again')
+        self.assertEqual(client.read(5), b'again')
+
+    def test_reconnect_immediately(self):
+        client = self.connect()
+        client.write(b'first')
+        self.assertEqual(client.read(5), b'first')
+        client.close()
+
+        # Before the station has closed the serial port of the first connection
+        client = self.connect()
+        client.write(b'again')
+        self.assertEqual(client.read(5), b'again')
+        self.assertTrue(self.leased())
+
+    def test_port_taken(self):
+        errors = []
+        with socket.socket() as taken:
+            taken.bind(('127.0.0.1', 0))
+            taken.listen(1)
+            station = Station('127.0.0.1', free_port(), lambda device, e: errors.append(device))
+            self.addCleanup(station.close)
+            station.next_port = taken.getsockname()[1]
+            station.scan()
+            self.assertEqual((errors, station.robots), (['loop://'], {}))
+
+        # Tried again on the next port
+        station.scan()
+        self.assertIn('loop://', station.robots)
+
+class StationPrepareTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(lib.sumorobot, 'registry', Registry(os.path.join(directory.name, 'sumorobots.json')))
+        self.registry = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # The station shares a fake SumoRobot
+        self.robot = FakeESP('station-prepare')
+        self.addCleanup(self.robot.close)
+        patcher = mock.patch.object(lib.station, 'list_sumorobots', lambda: [(self.robot.url, '1-1')])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        station = Station('127.0.0.1', free_port())
+        self.addCleanup(station.close)
+        station.scan()
+        self.url = 'rfc2217://127.0.0.1:%d' % station.robots[self.robot.url].port
+
+    def test_prepare(self):
+        esp = prepare_sumorobot(self.url)
+        self.addCleanup(esp._port.close)
+        # The flasher stub runs at FLASH_BAUD behind the station
+        self.assertEqual((self.robot.mode, self.robot.baud), ('stub', FLASH_BAUD))
+        self.assertEqual(esp.read_reg(ESPLoader.UART_DATA_REG_ADDR), 0x15122500)
+        known = self.registry.on_port(self.url)
+        self.assertEqual((known['mac'], known['baud']), (esp.mac, FLASH_BAUD))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+SumoRobot preparation tests
+
+Connects to fake SumoRobots (tests/fake_esp.py) the way
+every flashing job does, with a registry of its own.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.sumorobot
+from lib.sumorobot import *
+from tests.fake_esp import FakeESP
+
+class PrepareTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(lib.sumorobot, 'registry', Registry(os.path.join(directory.name, 'sumorobots.json')))
+        self.registry = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def robot(self, name, **kwargs):
+        robot = FakeESP(name, **kwargs)
+        self.addCleanup(robot.close)
+        return robot
+
+    def prepare(self, robot):
+        del robot.commands[:]
+        esp = prepare_sumorobot(robot.url)
+        esp._port.close()
+        return esp
+
+    def test_flash_baud(self):
+        robot = self.robot('prepare-fast')
+        esp = self.prepare(robot)
+        self.assertEqual((esp._port.baudrate, robot.baud), (FLASH_BAUD, FLASH_BAUD))
+        self.assertEqual(self.registry.on_port(robot.url)['baud'], FLASH_BAUD)
+
+    def test_fallback(self):
+        # The USB serial adapter can not keep up with FLASH_BAUD
+        robot = self.robot('prepare-slow', max_baud=ESPLoader.ESP_ROM_BAUD)
+        esp = self.prepare(robot)
+        self.assertEqual(esp._port.baudrate, ESPLoader.ESP_ROM_BAUD)
+        # Only the baud rate which worked is remembered
+        self.assertEqual(self.registry.on_port(robot.url)['baud'], ESPLoader.ESP_ROM_BAUD)
+
+        # And used right away next time
+        robot.mode = 'app'
+        self.prepare(robot)
+        self.assertNotIn(ESPLoader.ESP_CHANGE_BAUDRATE, robot.commands)
+        self.assertEqual(robot.commands.count(ESPLoader.ESP_MEM_END), 1)
+
+    def test_stub_running(self):
+        # Left in the flasher stub at FLASH_BAUD by an interrupted update
+        robot = self.robot('prepare-stub', stub=True)
+        robot.baud = FLASH_BAUD
+        esp = self.prepare(robot)
+        self.assertEqual(esp._port.baudrate, FLASH_BAUD)
+        self.assertNotIn(ESPLoader.ESP_MEM_END, robot.commands)
+
+    def test_known(self):
+        robot = self.robot('prepare-known')
+        self.prepare(robot)
+        known = self.registry.on_port(robot.url)
+
+        # Same SumoRobot on the same port, nothing to find out again
+        robot.mode = 'app'
+        with mock.patch.object(lib.sumorobot, 'tune_latency') as tune_latency:
+            esp = self.prepare(robot)
+        tune_latency.assert_not_called()
+        self.assertEqual(esp.mac, known['mac'])
+        self.assertEqual(self.registry.on_port(robot.url), known)
+
+    def test_swapped(self):
+        robot = self.robot('prepare-swapped')
+        self.prepare(robot)
+        robot.close()
+
+        # Another SumoRobot plugged into the port
+        robot = self.robot('prepare-swapped', mac=b'\x24\x0a\xc4\x00\x00\x02')
+        esp = self.prepare(robot)
+        self.assertEqual(esp.mac, '24:0a:c4:00:00:02')
+        self.assertEqual(self.registry.on_port(robot.url)['mac'], '24:0a:c4:00:00:02')
+        self.assertEqual(self.registry.get('24:0a:c4:00:00:02')['flash_size'], '4MB')
+
+if __name__ == '__main__':
+    unittest.main()
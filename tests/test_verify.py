@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+verify_flash tests
+
+Diffing flash against an image, and bisecting a digest
+mismatch on a fake flasher stub with only flash_md5sum.
+
+Author: RoboKoding LTD
+Website: https://www.robokoding.com
+Contact: silver@robokoding.com
+"""
+
+# python imports
+import io
+import os
+import argparse
+import contextlib
+import unittest
+from unittest import mock
+
+# Local lib imports
+import lib.esptool
+from lib.esptool import *
+from lib.esptool import _find_differing_regions
+from tests.fake_esp import FakeESP, connect_stub
+
+SECTOR = ESPLoader.FLASH_SECTOR_SIZE
+
+class DiffRangesTest(unittest.TestCase):
+    def check(self):
+        a = bytes(0x3000)
+        b = bytearray(a)
+        # Across a chunk boundary, single bytes and the last byte
+        b[0xffe:0x1003] = b'\x01' * 5
+        b[0x1800] = 1
+        b[0x1802] = 1
+        b[-1] = 1
+        self.assertEqual(diff_ranges(a, b), [(0xffe, 0x1003), (0x1800, 0x1801), (0x1802, 0x1803), (0x2fff, 0x3000)])
+        self.assertEqual(diff_ranges(a, b, chunk_size=0x10), diff_ranges(a, b))
+        self.assertEqual(diff_ranges(a, a), [])
+        self.assertEqual(diff_ranges(b'', b''), [])
+
+    def test_numpy(self):
+        if lib.esptool.numpy is None:
+            self.skipTest('NumPy is not installed')
+        self.check()
+
+    def test_python(self):
+        with mock.patch.object(lib.esptool, 'numpy', None):
+            self.check()
+
+class BisectTest(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeESP('verify')
+        self.addCleanup(self.device.close)
+        self.esp = connect_stub(self.device)
+        self.addCleanup(self.esp._port.close)
+        self.address = 0x10000
+        self.image = os.urandom(0x40000)
+        self.device.flash[self.address:self.address + len(self.image)] = self.image
+
+    def damage(self, offset, size=1):
+        offset += self.address
+        self.device.flash[offset:offset + size] = bytes(b ^ 0xff for b in self.device.flash[offset:offset + size])
+
+    def test_regions(self):
+        self.damage(0x1234)
+        self.damage(SECTOR * 5 - 1, 2)
+        regions = _find_differing_regions(self.esp, self.address, self.image)
+        self.assertEqual(regions, [(SECTOR, SECTOR), (SECTOR * 4, SECTOR * 2)])
+
+    def test_unaligned(self):
+        # Halves are split on flash sector boundaries, not on image offsets
+        address = self.address + 0x100
+        self.damage(0x100 + SECTOR * 3)
+        regions = _find_differing_regions(self.esp, address, self.image[0x100:])
+        self.assertEqual(regions, [(SECTOR * 3 - 0x100, SECTOR)])
+
+    def verify(self, diff):
+        argfile = io.BytesIO(self.image)
+        argfile.name = 'image.bin'
+        args = argparse.Namespace(addr_filename=[(self.address, argfile)], diff=diff, diff_limit=32,
+            flash_mode='keep', flash_freq='keep', flash_size='keep')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                verify_flash(self.esp, args)
+            except FatalError:
+                return output.getvalue(), False
+        return output.getvalue(), True
+
+    def test_verify(self):
+        output, ok = self.verify('bisect')
+        self.assertTrue(ok)
+        self.assertIn('verify OK', output)
+
+        self.damage(0x20000, 3)
+        del self.device.commands[:]
+        output, ok = self.verify('bisect')
+        self.assertFalse(ok)
+        self.assertIn('isolated to 1 region(s), reading back 0x%x bytes' % SECTOR, output)
+        self.assertIn('3 differing bytes in 1 range(s), first @ 0x%08x' % (self.address + 0x20000), output)
+        # Only the damaged sector was read back
+        self.assertEqual(self.device.commands.count(ESPLoader.ESP_READ_FLASH), 1)
+        self.assertEqual(self.verify('yes')[0].splitlines()[-1], output.splitlines()[-1])
+
+if __name__ == '__main__':
+    unittest.main()